@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# Compares the memory held by a fully loaded HPackageRegistry between a
+# baseline revision and the working tree. Each side is measured in a fresh
+# interpreter with the snapshot cache pointed at a throwaway directory, so
+# the registry is always parsed from pkgsrc.d.
+#
+#   python benchmarks/registry_memory.py --baseline HEAD~1
+
+MEASURE = '''
+import gc
+import json
+import pickle
+import sys
+import tracemalloc
+
+import toml
+
+sys.argv = ['-m']
+
+from hbuild import registry as hregistry
+
+with open("config.toml") as f:
+    config = toml.load(f)
+config["hbuild"]["cache_dir"] = sys.stdin.readline().strip()
+
+hregistry.toml.load = lambda f: config
+
+gc.collect()
+tracemalloc.start()
+registry = hregistry.HPackageRegistry()
+gc.collect()
+retained, peak = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+
+print(json.dumps({
+    "retained": retained,
+    "peak": peak,
+    "objects": len(registry.sources) + len(registry.tools) + len(registry.packages) + len(registry.stages),
+    "pickled": len(pickle.dumps([registry.sources, registry.tools, registry.packages], protocol=pickle.HIGHEST_PROTOCOL)),
+}))
+'''
+
+def measure(tree: str) -> dict:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        result = subprocess.run([sys.executable, "-c", MEASURE], cwd=tree, input=f"{cache_dir}\n",
+                                env=os.environ | {"PYTHONPATH": tree}, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+def format_size(size: int) -> str:
+    return f"{size / 1024:10.1f} KiB"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--baseline", default="HEAD~1", help="git revision to compare the working tree against")
+    args = parser.parse_args()
+
+    repo = subprocess.run(["git", "rev-parse", "--show-toplevel"], capture_output=True, text=True, check=True).stdout.strip()
+
+    with tempfile.TemporaryDirectory() as worktree:
+        subprocess.run(["git", "-C", repo, "worktree", "add", "--detach", "-q", worktree, args.baseline], check=True)
+        try:
+            baseline = measure(worktree)
+        finally:
+            subprocess.run(["git", "-C", repo, "worktree", "remove", "--force", worktree], check=True)
+
+    current = measure(repo)
+
+    print(f"{'':12} {'baseline':>14} {'working tree':>14}")
+    for key in ("retained", "peak", "pickled"):
+        print(f"{key:12} {format_size(baseline[key])} {format_size(current[key])}")
+    print(f"{'objects':12} {baseline['objects']:14} {current['objects']:14}")
+    print(f"retained per object: {baseline['retained'] / baseline['objects']:.0f} B -> {current['retained'] / current['objects']:.0f} B")
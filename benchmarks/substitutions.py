@@ -0,0 +1,127 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import toml
+
+# Renders every step of every recipe in pkgsrc.d with the old chain of
+# str.replace calls and with the precompiled templates, checks that both
+# produce the same commands, and times them.
+#
+#   python benchmarks/substitutions.py --rounds 200
+
+sys.argv = sys.argv[:1] + ['-m'] + sys.argv[1:]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hbuild import registry as hregistry
+from hbuild.step import Step, StepWorkdirType
+from hbuild.template import CPU_COUNT, make_context
+
+CONTAINER_DIRS = ('/home/hbuild/system_prefix', '/home/hbuild/source_root', '/home/hbuild/build_root',
+                  '/home/hbuild/source', '/home/hbuild/build', '/home/hbuild/package', '/home/hbuild/system_root')
+
+def legacy_substitutions(step: Step, system_prefix, system_targets, sources_dir, builds_dir, source_dir,
+                         build_dir, collect_dir, system_root):
+    replaced_args = []
+    replaced_environ: dict[str, str] = {}
+
+    base_workdir = build_dir
+    if step.workdir_type == StepWorkdirType.BUILDDIR:
+        replaced_workdir = base_workdir
+    else:
+        replaced_workdir = step.workdir
+
+    parallelism = CPU_COUNT
+
+    def replace(value: str) -> str:
+        value = value.replace("@THIS_SOURCE_DIR@", source_dir)
+        value = value.replace("@THIS_COLLECT_DIR@", collect_dir)
+        value = value.replace("@THIS_BUILD_DIR@", base_workdir)
+        value = value.replace("@BUILD_ROOT@", builds_dir)
+        value = value.replace("@SOURCE_ROOT@", sources_dir)
+        value = value.replace("@SYSROOT_DIR@", system_root)
+        value = value.replace("@PREFIX@", system_prefix)
+        value = value.replace("@TARGET@", system_targets["x86_64"])
+        value = value.replace("@PARALLELISM@", str(parallelism))
+        return value
+
+    replaced_workdir = replace(replaced_workdir)
+    for arg in step.args:
+        replaced_args.append(replace(arg))
+
+    for env_var, env_val in step.environ:
+        replaced_environ[env_var] = replace(env_val)
+
+    base_path = "/usr/local/bin:/usr/bin:/bin:/usr/local/games:/usr/games"
+    if "PATH" in replaced_environ:
+        replaced_environ['PATH'] = f"{system_prefix}/bin:{replaced_environ['PATH']}:{base_path}"
+    else:
+        replaced_environ['PATH'] = f"{system_prefix}/bin:{base_path}"
+
+    replaced_environ['ACLOCAL_PATH'] = f"{system_prefix}/share/aclocal"
+    replaced_environ.setdefault('MAKEFLAGS', f"-j{parallelism}")
+
+    return replaced_args, replaced_environ, replaced_workdir
+
+def collect_steps(registry) -> list[Step]:
+    steps = []
+    for source in registry.sources:
+        steps += [*source.acquire_steps, *source.extract_steps, *source.patch_steps, *source.regenerate_steps]
+    for tool in registry.tools:
+        steps += [*tool.configure_steps, *tool.compile_steps, *tool.install_steps]
+    for package in registry.packages:
+        steps += [*package.configure_steps, *package.build_steps]
+    for stage in registry.stages:
+        steps += [*stage.compile_steps, *stage.install_steps, *stage.build_steps]
+
+    return steps
+
+def time_rounds(rounds: int, run) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        run()
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=200, help="times every step is rendered")
+    args = parser.parse_args(sys.argv[2:])
+
+    with open("config.toml") as f:
+        config = toml.load(f)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        config["hbuild"]["cache_dir"] = cache_dir
+        hregistry.toml.load = lambda f: config
+        registry = hregistry.HPackageRegistry()
+
+    steps = collect_steps(registry)
+    system_prefix, sources_dir, builds_dir, source_dir, build_dir, collect_dir, system_root = CONTAINER_DIRS
+    targets = registry.package_config.system_targets
+
+    legacy_args = (system_prefix, targets, sources_dir, builds_dir, source_dir, build_dir, collect_dir, system_root)
+    for step in steps:
+        context = make_context(*legacy_args)
+        if step.do_substitutions(context) != legacy_substitutions(step, *legacy_args):
+            raise SystemExit(f"Template rendering differs from the legacy substitutions for {step}")
+
+    def run_legacy():
+        for step in steps:
+            legacy_substitutions(step, *legacy_args)
+
+    # the context is built once per package invocation, not once per step
+    def run_templates():
+        context = make_context(*legacy_args)
+        for step in steps:
+            step.do_substitutions(context)
+
+    legacy = time_rounds(args.rounds, run_legacy)
+    templates = time_rounds(args.rounds, run_templates)
+    renders = len(steps) * args.rounds
+
+    print(f"{len(steps)} steps, {args.rounds} rounds")
+    print(f"legacy replace chain {legacy * 1e6 / renders:8.2f} us/step")
+    print(f"compiled templates   {templates * 1e6 / renders:8.2f} us/step")
+    print(f"speedup              {legacy / templates:8.2f}x")
@@ -1,6 +1,6 @@
 #!/bin/bash
 
-dirs=("sources" "builds" "system_prefix" "system_files" "tools" "packages" "works" "logs")
+dirs=("sources" "builds" "system_prefix" "system_files" "tools" "packages" "works" "logs" "manifests")
 
 for dir in ${dirs[@]}; do
   rm -fr ${dir}
@@ -1,6 +1,45 @@
+import argparse
+import sys
+import time
+
+import toml
+
 from .registry import HPackageRegistry
 from .dispatch import HBuildDispatch
+from .validate import find_pkgsrc_files, validate_pkgsrc_files
+
+def validate(args) -> int:
+    with open("config.toml") as f:
+        config = toml.load(f)
+
+    paths = args.paths if len(args.paths) > 0 else find_pkgsrc_files(config["hbuild"]["pkgsrc_dir"])
+    workers = args.workers if args.workers is not None else config["hbuild"].get("validate", {}).get("workers", 0)
+
+    start = time.perf_counter()
+    results = validate_pkgsrc_files(config["hbuild"]["schema_dir"], paths, workers=workers, parallel_threshold=0)
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    for result in sorted(results, key=lambda result: result.elapsed, reverse=True):
+        print(result)
+        if result.error is not None:
+            failed += 1
+
+    print(f"validated {len(results)} files in {elapsed * 1000:.2f} ms, {failed} failed")
+    return 1 if failed > 0 else 0
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="hbuild")
+    parser.add_argument("--watch", action="store_true", help="reload pkgsrc.d recipes when they change")
+
+    subparsers = parser.add_subparsers(dest="command")
+    validate_parser = subparsers.add_parser("validate", help="validate pkgsrc files against the schemas")
+    validate_parser.add_argument("--workers", type=int, default=None, help="validation processes, 0 for one per cpu")
+    validate_parser.add_argument("paths", nargs="*", help="pkgsrc files to validate (default: all of pkgsrc_dir)")
+    args = parser.parse_args()
+
+    if args.command == "validate":
+        sys.exit(validate(args))
+
     dispatch = HBuildDispatch()
-    dispatch.run_server()
\ No newline at end of file
+    dispatch.run_server(watch=args.watch)
@@ -0,0 +1,136 @@
+import fcntl
+import hashlib
+import lzma
+import os
+import sqlite3
+import threading
+import time
+from email.utils import formatdate
+
+APT_DB = ".hbuild-apt.db"
+APT_LOCK = ".hbuild-apt.lock"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT NOT NULL,
+    architecture TEXT NOT NULL,
+    version TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    stanza TEXT NOT NULL,
+    PRIMARY KEY (name, architecture)
+);
+"""
+
+initialized_lock = threading.Lock()
+initialized: set[str] = set()
+
+def control_fields(control: str) -> dict[str, str]:
+    fields = {}
+    for line in control.splitlines():
+        # continuation lines belong to the description
+        if line == "" or line[0] in " \t":
+            continue
+        name, _, value = line.partition(":")
+        fields[name.strip()] = value.strip()
+
+    return fields
+
+def file_digests(path: str) -> tuple[int, str, str]:
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+
+    return os.path.getsize(path), md5.hexdigest(), sha256.hexdigest()
+
+class HAptRepository():
+    def __init__(self, repo_dir: str, origin: str = "hbuild", label: str = "hbuild"):
+        # a flat repository, deb [trusted=yes] file:<repo_dir> ./
+        self.repo_dir = repo_dir
+        self.origin = origin
+        self.label = label
+        self.db_file = os.path.join(repo_dir, APT_DB)
+
+        with initialized_lock:
+            if self.db_file not in initialized:
+                os.makedirs(repo_dir, exist_ok=True)
+                with self.connect() as conn:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.executescript(SCHEMA)
+                initialized.add(self.db_file)
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def add(self, control: str, deb_file: str):
+        fields = control_fields(control)
+        size, md5, sha256 = file_digests(deb_file)
+
+        filename = f"./{os.path.relpath(os.path.realpath(deb_file), os.path.realpath(self.repo_dir))}"
+        stanza = f"{control.rstrip()}\nFilename: {filename}\nSize: {size}\nMD5sum: {md5}\nSHA256: {sha256}\n"
+
+        # only the new .deb is read, the rest of the index comes from the db
+        with self.locked():
+            conn = self.connect()
+            try:
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO packages (name, architecture, version, filename, stanza) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 (fields["Package"], fields["Architecture"], fields["Version"], filename, stanza))
+                self.write_index(conn)
+            finally:
+                conn.close()
+
+    def locked(self):
+        return HAptLock(os.path.join(self.repo_dir, APT_LOCK))
+
+    def write_index(self, conn: sqlite3.Connection):
+        rows = conn.execute("SELECT stanza, architecture FROM packages ORDER BY name, architecture").fetchall()
+        packages = "\n".join(stanza for stanza, _ in rows).encode('utf-8')
+
+        files = {
+            "Packages": packages,
+            "Packages.xz": lzma.compress(packages, preset=6),
+        }
+        for name, data in files.items():
+            self.write_file(name, data)
+
+        architectures = sorted({architecture for _, architecture in rows})
+        release = [
+            f"Origin: {self.origin}",
+            f"Label: {self.label}",
+            f"Date: {formatdate(time.time(), usegmt=True)}",
+            f"Architectures: {' '.join(architectures)}",
+            "MD5Sum:",
+            *[f" {hashlib.md5(data).hexdigest()} {len(data)} {name}" for name, data in files.items()],
+            "SHA256:",
+            *[f" {hashlib.sha256(data).hexdigest()} {len(data)} {name}" for name, data in files.items()],
+        ]
+        self.write_file("Release", ("\n".join(release) + "\n").encode('utf-8'))
+
+    def write_file(self, name: str, data: bytes):
+        # apt may be reading the repository while it is updated
+        path = os.path.join(self.repo_dir, name)
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, path)
+
+class HAptLock():
+    # runners on one host share packages_dir, sqlite alone does not keep
+    # their index files in step
+    def __init__(self, lock_file: str):
+        self.lock_file = lock_file
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
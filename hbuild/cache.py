@@ -0,0 +1,369 @@
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from urllib.parse import urlparse
+
+from .package import Package
+from .source import CloneType, SourcePackage, SourceType
+from .stage import Stage
+from .step import Step
+from .tool import ToolPackage
+
+CACHE_FORMAT = 1
+
+# the container side of every bind mount, identical on every runner
+CONTAINER_PATHS = {
+    "system_prefix": "/home/hbuild/system_prefix",
+    "sources_dir": "/home/hbuild/source_root",
+    "builds_dir": "/home/hbuild/build_root",
+    "source_dir": "/home/hbuild/source",
+    "build_dir": "/home/hbuild/build",
+    "system_root": "/home/hbuild/system_root",
+}
+
+def format_steps(steps: list[Step]) -> list:
+    return [[list(step.args), step.workdir, [list(pair) for pair in step.environ], step.shell] for step in steps]
+
+def hash_dir(digest, root_dir: str):
+    if not os.path.isdir(root_dir):
+        return
+
+    for dent, subdirs, files in os.walk(root_dir):
+        subdirs.sort()
+        for file in sorted(files):
+            path = os.path.join(dent, file)
+            with open(path, 'rb') as f:
+                contents = f.read()
+
+            digest.update(f"{os.path.relpath(path, root_dir)}:{len(contents)}:".encode())
+            digest.update(contents)
+
+def git_output(args: list[str]) -> str | None:
+    try:
+        return subprocess.run(["git", *args], capture_output=True, text=True, timeout=120, check=True).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"Failed to run git {' '.join(args)}: {e}")
+        return None
+
+def source_revision(node: SourcePackage, fetched: bool) -> str | None:
+    # a branch or a url names whatever upstream serves today, only the
+    # commit or the tarball that gets built says what is in the tree
+    if node.source_type == SourceType.GIT:
+        if node.clone_type == CloneType.COMMIT:
+            return node.commit
+
+        if fetched:
+            output = git_output(["-c", "safe.directory=*", "-C", node.source_dir, "rev-parse", "HEAD"])
+            return output.strip() if output else None
+
+        ref = f"refs/heads/{node.branch}" if node.clone_type == CloneType.BRANCH else f"refs/tags/{node.tag}"
+        output = git_output(["ls-remote", node.git, ref, f"{ref}^{{}}"])
+        if output is None:
+            return None
+
+        # annotated tags are listed twice, the peeled line names the commit
+        revisions = dict(reversed(line.split("\t", maxsplit=1)) for line in output.splitlines() if "\t" in line)
+        return revisions.get(f"{ref}^{{}}", revisions.get(ref))
+
+    # the acquire step never downloads over a tarball that is already there
+    tarball = os.path.join(node.sources_dir, os.path.basename(urlparse(node.url).path))
+    if not os.path.isfile(tarball):
+        return None
+
+    return file_sha256(tarball)
+
+def node_inputs(node: SourcePackage | ToolPackage | Package | Stage, revision: str | None = None) -> dict:
+    if isinstance(node, SourcePackage):
+        digest = hashlib.sha256()
+        hash_dir(digest, node.patch_dir)
+
+        return {
+            "revision": revision,
+            "version": node.version,
+            "source_type": node.source_type.name,
+            "url": node.url,
+            "format": node.format,
+            "git": node.git,
+            "branch": node.branch,
+            "commit": node.commit,
+            "tag": node.tag,
+            "extract_strip": node.extract_strip,
+            "patch_path_strip": node.patch_path_strip,
+            "patches": digest.hexdigest(),
+            "steps": [format_steps(node.acquire_steps), format_steps(node.extract_steps),
+                      format_steps(node.patch_steps), format_steps(node.regenerate_steps)],
+        }
+
+    stage = node if isinstance(node, Stage) else None
+    package = node.package if stage is not None else node
+    if isinstance(package, ToolPackage):
+        steps = [package.configure_steps,
+                 *([stage.compile_steps, stage.install_steps] if stage is not None
+                   else [package.compile_steps, package.install_steps])]
+    else:
+        steps = [package.configure_steps, stage.build_steps if stage is not None else package.build_steps]
+
+    return {
+        "version": package.version,
+        "stage": stage.name if stage is not None else None,
+        "steps": [format_steps(node_steps) for node_steps in steps],
+    }
+
+def output_dirs(node: ToolPackage | Package | Stage) -> dict[str, str]:
+    # later stages build on top of the build tree of earlier ones
+    if isinstance(node, Stage):
+        package = node.package
+        output_dir = package.tool_dir if isinstance(package, ToolPackage) else package.package_dir
+        return {"output": output_dir, "build": package.build_dir}
+
+    return {"output": node.tool_dir if isinstance(node, ToolPackage) else node.package_dir}
+
+def configure_hash(package: ToolPackage | Package, dep_hashes: dict[str, str | None]) -> str | None:
+    # only what configure itself sees, so every stage of the package agrees
+    deps = {}
+    for dep in package.deps():
+        if dep_hashes.get(dep) is None:
+            return None
+        deps[dep] = dep_hashes[dep]
+
+    inputs = {
+        "format": CACHE_FORMAT,
+        "package": package.name,
+        "version": package.version,
+        "targets": package.system_targets,
+        "paths": CONTAINER_PATHS,
+        "steps": format_steps(package.configure_steps),
+        "deps": dict(sorted(deps.items())),
+    }
+
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+class HCacheEntry():
+    __slots__ = ("input_hash", "output_hash", "lookup_name", "archive_file")
+
+    def __init__(self, input_hash: str, output_hash: str, lookup_name: str, archive_file: str):
+        self.input_hash = input_hash
+        self.output_hash = output_hash
+        self.lookup_name = lookup_name
+        self.archive_file = archive_file
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+class HRemoteCache():
+    def __init__(self, url: str, timeout: float = 60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def artifact_url(self, input_hash: str) -> str:
+        return f"{self.url}/artifacts/{input_hash}"
+
+    def fetch(self, input_hash: str, archive_file: str) -> dict | None:
+        tmp_file = f"{archive_file}.{os.getpid()}.download"
+        try:
+            with urllib.request.urlopen(self.artifact_url(input_hash), timeout=self.timeout) as response:
+                digest = hashlib.sha256()
+                with open(tmp_file, 'wb') as f:
+                    for block in iter(lambda: response.read(1024 * 1024), b''):
+                        digest.update(block)
+                        f.write(block)
+
+                if digest.hexdigest() != response.headers["X-Hbuild-Sha256"]:
+                    print(f"Discarding corrupt artifact {input_hash} from {self.url}")
+                    return None
+
+                os.replace(tmp_file, archive_file)
+                return {
+                    "output_hash": response.headers["X-Hbuild-Output-Hash"],
+                    "lookup_name": response.headers["X-Hbuild-Lookup-Name"],
+                }
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                print(f"Failed to fetch artifact {input_hash} from {self.url}: {e}")
+            return None
+        except (urllib.error.URLError, OSError) as e:
+            print(f"Failed to fetch artifact {input_hash} from {self.url}: {e}")
+            return None
+        finally:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+
+    def exists(self, input_hash: str) -> bool:
+        request = urllib.request.Request(self.artifact_url(input_hash), method="HEAD")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                return True
+        except (urllib.error.URLError, OSError):
+            return False
+
+    def push(self, entry: 'HCacheEntry') -> bool:
+        if self.exists(entry.input_hash):
+            return True
+
+        try:
+            with open(entry.archive_file, 'rb') as f:
+                request = urllib.request.Request(self.artifact_url(entry.input_hash), data=f, method="PUT", headers={
+                    "Content-Type": "application/x-tar",
+                    "Content-Length": str(os.path.getsize(entry.archive_file)),
+                    "X-Hbuild-Sha256": file_sha256(entry.archive_file),
+                    "X-Hbuild-Output-Hash": entry.output_hash,
+                    "X-Hbuild-Lookup-Name": entry.lookup_name,
+                })
+                with urllib.request.urlopen(request, timeout=self.timeout):
+                    return True
+        except (urllib.error.URLError, OSError) as e:
+            print(f"Failed to push artifact {entry.input_hash} to {self.url}: {e}")
+            return False
+
+class HBuildCache():
+    def __init__(self, cache_dir: str, remote: HRemoteCache | None = None):
+        self.cache_dir = Path(cache_dir).resolve().as_posix()
+        self.artifacts_dir = Path(self.cache_dir, "artifacts").as_posix()
+        self.nodes_dir = Path(self.cache_dir, "nodes").as_posix()
+        self.remote = remote
+
+    def input_hash(self, lookup_name: str, node: SourcePackage | ToolPackage | Package | Stage,
+                   dep_hashes: dict[str, str], revision: str | None = None) -> str:
+        package = node.package if isinstance(node, Stage) else node
+        inputs = {
+            "format": CACHE_FORMAT,
+            "node": lookup_name,
+            "targets": package.system_targets,
+            "paths": CONTAINER_PATHS,
+            "inputs": node_inputs(node, revision),
+            "deps": dict(sorted(dep_hashes.items())),
+        }
+
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def entry_paths(self, input_hash: str) -> tuple[str, str]:
+        entry_dir = Path(self.artifacts_dir, input_hash[:2])
+        return Path(entry_dir, f"{input_hash}.tar").as_posix(), Path(entry_dir, f"{input_hash}.json").as_posix()
+
+    def lookup(self, input_hash: str) -> HCacheEntry | None:
+        archive_file, meta_file = self.entry_paths(input_hash)
+        if not os.path.exists(meta_file) or not os.path.exists(archive_file):
+            return self.fetch(input_hash)
+
+        with open(meta_file) as f:
+            meta = json.load(f)
+
+        os.utime(meta_file)
+        return HCacheEntry(input_hash, meta["output_hash"], meta["lookup_name"], archive_file)
+
+    def fetch(self, input_hash: str) -> HCacheEntry | None:
+        if self.remote is None:
+            return None
+
+        archive_file, meta_file = self.entry_paths(input_hash)
+        os.makedirs(os.path.dirname(archive_file), exist_ok=True)
+
+        meta = self.remote.fetch(input_hash, archive_file)
+        if meta is None:
+            return None
+
+        print(f"Fetched artifact {input_hash[:12]} ({meta['lookup_name']}) from {self.remote.url}")
+        self.write_json(meta_file, meta | {"created_at": time.time()})
+        return HCacheEntry(input_hash, meta["output_hash"], meta["lookup_name"], archive_file)
+
+    def store(self, input_hash: str, lookup_name: str, roots: dict[str, str]) -> HCacheEntry:
+        archive_file, meta_file = self.entry_paths(input_hash)
+        os.makedirs(os.path.dirname(archive_file), exist_ok=True)
+
+        digest = hashlib.sha256()
+        tmp_file = f"{archive_file}.{os.getpid()}.tmp"
+        with tarfile.open(tmp_file, 'w') as tar:
+            for root_name, root_dir in sorted(roots.items()):
+                # build trees are only carried along for later stages, the
+                # installed files alone decide what dependents see
+                self.archive_dir(tar, digest if root_name == "output" else hashlib.sha256(), root_name, root_dir)
+        os.replace(tmp_file, archive_file)
+
+        entry = HCacheEntry(input_hash, digest.hexdigest(), lookup_name, archive_file)
+        self.write_json(meta_file, {
+            "output_hash": entry.output_hash,
+            "lookup_name": lookup_name,
+            "created_at": time.time(),
+        })
+
+        if self.remote is not None:
+            self.remote.push(entry)
+
+        return entry
+
+    def archive_dir(self, tar: tarfile.TarFile, digest, root_name: str, root_dir: str):
+        tar.add(root_dir, arcname=root_name, recursive=False)
+
+        for dent, subdirs, files in os.walk(root_dir):
+            subdirs.sort()
+            for name in sorted([*subdirs, *files]):
+                path = os.path.join(dent, name)
+                rel_path = os.path.relpath(path, root_dir)
+                st = os.lstat(path)
+
+                # overlay whiteouts and other special files are never part of an install
+                if stat.S_ISLNK(st.st_mode):
+                    digest.update(f"L:{rel_path}:{os.readlink(path)}\0".encode())
+                elif stat.S_ISDIR(st.st_mode):
+                    digest.update(f"D:{rel_path}:{stat.S_IMODE(st.st_mode):o}\0".encode())
+                elif stat.S_ISREG(st.st_mode):
+                    file_digest = hashlib.sha256()
+                    with open(path, 'rb') as f:
+                        for block in iter(lambda: f.read(1024 * 1024), b''):
+                            file_digest.update(block)
+                    digest.update(f"F:{rel_path}:{stat.S_IMODE(st.st_mode):o}:{file_digest.hexdigest()}\0".encode())
+                else:
+                    continue
+
+                tar.add(path, arcname=os.path.join(root_name, rel_path), recursive=False)
+
+    def restore(self, entry: HCacheEntry, roots: dict[str, str]):
+        with tarfile.open(entry.archive_file, 'r') as tar:
+            for root_name, root_dir in roots.items():
+                if os.path.exists(root_dir):
+                    shutil.rmtree(root_dir)
+
+                members = [member for member in tar.getmembers()
+                           if member.name == root_name or member.name.startswith(f"{root_name}/")]
+                for member in members:
+                    member.name = os.path.relpath(member.name, root_name)
+
+                os.makedirs(root_dir, exist_ok=True)
+                tar.extractall(root_dir, members=members, filter="tar")
+
+    def node_file(self, lookup_name: str) -> str:
+        return Path(self.nodes_dir, f"{lookup_name}.json").as_posix()
+
+    def node_state(self, lookup_name: str) -> dict | None:
+        node_file = self.node_file(lookup_name)
+        if not os.path.exists(node_file):
+            return None
+
+        with open(node_file) as f:
+            return json.load(f)
+
+    def record_node(self, lookup_name: str, input_hash: str, output_hash: str):
+        os.makedirs(self.nodes_dir, exist_ok=True)
+        self.write_json(self.node_file(lookup_name), {
+            "input_hash": input_hash,
+            "output_hash": output_hash,
+        })
+
+    def write_json(self, path: str, value: dict):
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_file, path)
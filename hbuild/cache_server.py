@@ -0,0 +1,208 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ARTIFACT_PATH = re.compile(r"^/artifacts/([0-9a-f]{64})$")
+SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+COPY_BLOCK_SIZE = 1024 * 1024
+
+class HArtifactStore():
+    def __init__(self, root_dir: str, max_size: int):
+        self.root_dir = Path(root_dir).resolve().as_posix()
+        self.tmp_dir = Path(self.root_dir, "tmp").as_posix()
+        self.max_size = max_size
+
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.total_size = 0
+
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        for file in os.listdir(self.tmp_dir):
+            os.unlink(os.path.join(self.tmp_dir, file))
+
+        # least recently used first, by the time of the last read or write
+        found = []
+        for dent, _, files in os.walk(self.root_dir):
+            if dent == self.tmp_dir:
+                continue
+            for file in files:
+                if not file.endswith(".tar"):
+                    continue
+
+                st = os.stat(os.path.join(dent, file))
+                found.append((st.st_mtime, file.removesuffix(".tar"), st.st_size))
+
+        for _, artifact_hash, size in sorted(found):
+            self.entries[artifact_hash] = size
+            self.total_size += size
+
+    def paths(self, artifact_hash: str) -> tuple[str, str]:
+        entry_dir = Path(self.root_dir, artifact_hash[:2])
+        return Path(entry_dir, f"{artifact_hash}.tar").as_posix(), Path(entry_dir, f"{artifact_hash}.json").as_posix()
+
+    def get(self, artifact_hash: str) -> tuple[str, dict] | None:
+        archive_file, meta_file = self.paths(artifact_hash)
+        with self.lock:
+            if artifact_hash not in self.entries:
+                return None
+
+            self.entries.move_to_end(artifact_hash)
+            try:
+                os.utime(archive_file)
+                with open(meta_file) as f:
+                    meta = json.load(f)
+            except FileNotFoundError:
+                self.total_size -= self.entries.pop(artifact_hash)
+                return None
+
+        return archive_file, meta
+
+    def put(self, artifact_hash: str, rfile, length: int, sha256: str, meta: dict) -> bool:
+        fd, tmp_file = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f:
+                remaining = length
+                while remaining > 0:
+                    block = rfile.read(min(COPY_BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    digest.update(block)
+                    f.write(block)
+                    remaining -= len(block)
+
+            if remaining > 0 or digest.hexdigest() != sha256:
+                return False
+
+            archive_file, meta_file = self.paths(artifact_hash)
+            os.makedirs(os.path.dirname(archive_file), exist_ok=True)
+
+            with self.lock:
+                with open(f"{tmp_file}.json", 'w') as f:
+                    json.dump(meta | {"sha256": sha256, "size": length}, f)
+                os.replace(f"{tmp_file}.json", meta_file)
+                os.replace(tmp_file, archive_file)
+
+                self.total_size += length - self.entries.pop(artifact_hash, 0)
+                self.entries[artifact_hash] = length
+                self.evict()
+        finally:
+            for path in (tmp_file, f"{tmp_file}.json"):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+        return True
+
+    def evict(self):
+        while self.total_size > self.max_size and len(self.entries) > 1:
+            artifact_hash, size = self.entries.popitem(last=False)
+            self.total_size -= size
+
+            for path in self.paths(artifact_hash):
+                if os.path.exists(path):
+                    os.unlink(path)
+            print(f"Evicted {artifact_hash} ({size} bytes), {self.total_size} bytes in use")
+
+class HArtifactHandler(BaseHTTPRequestHandler):
+    store: HArtifactStore = None
+
+    def artifact_hash(self) -> str | None:
+        match = ARTIFACT_PATH.match(self.path)
+        if match is None:
+            self.send_error(404)
+            return None
+
+        return match.group(1)
+
+    def send_artifact_headers(self, archive_file: str, meta: dict):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-tar")
+        self.send_header("Content-Length", str(os.path.getsize(archive_file)))
+        self.send_header("X-Hbuild-Sha256", meta["sha256"])
+        self.send_header("X-Hbuild-Output-Hash", meta["output_hash"])
+        self.send_header("X-Hbuild-Lookup-Name", meta["lookup_name"])
+        self.end_headers()
+
+    def do_HEAD(self):
+        artifact_hash = self.artifact_hash()
+        if artifact_hash is None:
+            return
+
+        found = self.store.get(artifact_hash)
+        if found is None:
+            self.send_error(404)
+            return
+
+        self.send_artifact_headers(*found)
+
+    def do_GET(self):
+        artifact_hash = self.artifact_hash()
+        if artifact_hash is None:
+            return
+
+        found = self.store.get(artifact_hash)
+        if found is None:
+            self.send_error(404)
+            return
+
+        archive_file, meta = found
+        try:
+            f = open(archive_file, 'rb')
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+
+        with f:
+            self.send_artifact_headers(archive_file, meta)
+            shutil.copyfileobj(f, self.wfile, COPY_BLOCK_SIZE)
+
+    def do_PUT(self):
+        artifact_hash = self.artifact_hash()
+        if artifact_hash is None:
+            return
+
+        sha256 = self.headers.get("X-Hbuild-Sha256")
+        output_hash = self.headers.get("X-Hbuild-Output-Hash")
+        length = self.headers.get("Content-Length")
+        if sha256 is None or output_hash is None or length is None:
+            self.send_error(400, "Missing Content-Length, X-Hbuild-Sha256 or X-Hbuild-Output-Hash")
+            return
+
+        meta = {
+            "output_hash": output_hash,
+            "lookup_name": self.headers.get("X-Hbuild-Lookup-Name", ""),
+        }
+        if not self.store.put(artifact_hash, self.rfile, int(length), sha256, meta):
+            self.send_error(422, "Upload does not match X-Hbuild-Sha256")
+            return
+
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+def parse_size(size: str) -> int:
+    size = size.strip().upper().removesuffix("B").removesuffix("I")
+    suffix = size[-1] if size[-1] in SIZE_SUFFIXES else ""
+    return int(float(size.removesuffix(suffix)) * SIZE_SUFFIXES[suffix])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="hbuild.cache_server")
+    parser.add_argument("--dir", default="cache/remote", help="directory holding the artifacts")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8470)
+    parser.add_argument("--max-size", default="100G", help="evict least recently used artifacts above this size")
+    args = parser.parse_args()
+
+    HArtifactHandler.store = HArtifactStore(args.dir, parse_size(args.max_size))
+    server = ThreadingHTTPServer((args.host, args.port), HArtifactHandler)
+    print(f"HBuild artifact cache serving {HArtifactHandler.store.root_dir} on {args.host}:{args.port}, "
+          f"{HArtifactHandler.store.total_size} of {HArtifactHandler.store.max_size} bytes in use")
+    server.serve_forever()
@@ -0,0 +1,92 @@
+CGROUP_FILES = ("cpu.stat", "memory.peak", "io.stat")
+
+# one exec reads every file, with a marker line in front of each
+READ_CGROUP = ["/bin/sh", "-c",
+               "for f in " + " ".join(CGROUP_FILES) + "; do echo \"== $f\"; cat /sys/fs/cgroup/$f 2>/dev/null; done"]
+
+class HCgroupStats():
+    __slots__ = ("cpu_user_usec", "cpu_system_usec", "memory_peak", "io_read", "io_write")
+
+    def __init__(self, cpu_user_usec: int, cpu_system_usec: int, memory_peak: int | None,
+                 io_read: int, io_write: int):
+        self.cpu_user_usec = cpu_user_usec
+        self.cpu_system_usec = cpu_system_usec
+        self.memory_peak = memory_peak
+        self.io_read = io_read
+        self.io_write = io_write
+
+def parse_cgroup_stats(output: str) -> HCgroupStats:
+    sections: dict[str, list[str]] = {}
+    current = None
+    for line in output.splitlines():
+        if line.startswith("== "):
+            current = sections.setdefault(line[3:].strip(), [])
+        elif current is not None and line.strip():
+            current.append(line.strip())
+
+    cpu = dict(line.split(maxsplit=1) for line in sections.get("cpu.stat", []))
+    memory_peak = int(sections["memory.peak"][0]) if len(sections.get("memory.peak", [])) > 0 else None
+
+    io_read = 0
+    io_write = 0
+    for line in sections.get("io.stat", []):
+        for field in line.split()[1:]:
+            key, _, value = field.partition("=")
+            if key == "rbytes":
+                io_read += int(value)
+            elif key == "wbytes":
+                io_write += int(value)
+
+    return HCgroupStats(int(cpu.get("user_usec", 0)), int(cpu.get("system_usec", 0)),
+                        memory_peak, io_read, io_write)
+
+def read_cgroup_stats(container) -> HCgroupStats | None:
+    try:
+        exit_code, output = container.exec_run(READ_CGROUP, user='hbuild')
+    except Exception as e:
+        print(f"Failed to read cgroup statistics: {e}")
+        return None
+
+    if exit_code != 0:
+        return None
+
+    return parse_cgroup_stats(output.decode('utf-8', errors='replace'))
+
+class HStepStats():
+    __slots__ = ("package", "stage", "command", "exit_code", "wall_time", "cpu_user", "cpu_system",
+                 "memory_peak", "container_peak", "io_read", "io_write")
+
+    def __init__(self, package: str, stage: str, command: str, exit_code: int,
+                 before: HCgroupStats | None, after: HCgroupStats | None, wall_time: float):
+        self.package = package
+        self.stage = stage
+        self.command = command
+        self.exit_code = exit_code
+        self.wall_time = wall_time
+
+        if before is None or after is None:
+            self.cpu_user = None
+            self.cpu_system = None
+            self.memory_peak = None
+            self.container_peak = None
+            self.io_read = None
+            self.io_write = None
+            return
+
+        self.cpu_user = (after.cpu_user_usec - before.cpu_user_usec) / 1e6
+        self.cpu_system = (after.cpu_system_usec - before.cpu_system_usec) / 1e6
+        # memory.peak is the high-water mark of the container, which lives
+        # across steps and stages, and resets only per open file. A step has
+        # a peak of its own only if it raised the mark
+        self.container_peak = after.memory_peak
+        if after.memory_peak is not None and before.memory_peak is not None \
+                and after.memory_peak > before.memory_peak:
+            self.memory_peak = after.memory_peak
+        else:
+            self.memory_peak = None
+        self.io_read = after.io_read - before.io_read
+        self.io_write = after.io_write - before.io_write
+
+    def as_row(self, history_id: int) -> tuple:
+        return (history_id, self.package, self.stage, self.command[:1024], self.exit_code, self.wall_time,
+                self.cpu_user, self.cpu_system, self.memory_peak, self.container_peak, self.io_read, self.io_write)
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+
+class HCheckpoint():
+    __slots__ = ("checkpoint_file", "key", "roots", "resume_from", "position")
+
+    def __init__(self, checkpoint_file: str, key: str, roots: list[str], resume: bool):
+        self.checkpoint_file = checkpoint_file
+        self.key = key
+        self.roots = roots
+        self.resume_from = 0
+        self.position = 0
+
+        if resume:
+            self.resume_from = self.load()
+
+    def load(self) -> int:
+        if not os.path.exists(self.checkpoint_file):
+            return 0
+
+        with open(self.checkpoint_file) as f:
+            state = json.load(f)
+
+        if state["key"] != self.key:
+            print(f"Checkpoint {self.checkpoint_file} is for other inputs, building from the start")
+            return 0
+
+        # anything touching the trees since the failure makes the finished
+        # steps meaningless, e.g. a clean or a cache restore
+        if state["fingerprint"] != fingerprint_dirs(self.roots):
+            print(f"Build tree changed since checkpoint {self.checkpoint_file}, building from the start")
+            return 0
+
+        print(f"Resuming after {state['completed']} finished steps")
+        return state["completed"]
+
+    # steps run in the same order on every attempt, so a running count is
+    # enough to find the first one that did not finish
+    def skip(self) -> bool:
+        if self.position < self.resume_from:
+            self.position += 1
+            return True
+
+        return False
+
+    # steps that were not needed this time, e.g. an unchanged configure
+    def pass_steps(self, count: int):
+        self.position += count
+
+    def advance(self):
+        self.position += 1
+        self.write(None)
+
+    def fail(self):
+        self.write(fingerprint_dirs(self.roots))
+
+    def finish(self):
+        if os.path.exists(self.checkpoint_file):
+            os.unlink(self.checkpoint_file)
+
+    def write(self, fingerprint: str | None):
+        os.makedirs(os.path.dirname(self.checkpoint_file), exist_ok=True)
+
+        tmp_file = f"{self.checkpoint_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({
+                "key": self.key,
+                "completed": self.position,
+                "fingerprint": fingerprint,
+            }, f)
+        os.replace(tmp_file, self.checkpoint_file)
+
+def fingerprint_dirs(roots: list[str]) -> str:
+    # stat only, a build tree can hold hundreds of thousands of files
+    digest = hashlib.sha256()
+    for root in roots:
+        digest.update(f"{root}\0".encode())
+        if not os.path.isdir(root):
+            continue
+
+        for dent, subdirs, files in os.walk(root):
+            subdirs.sort()
+            for file in sorted(files):
+                path = os.path.join(dent, file)
+                st = os.lstat(path)
+                digest.update(f"{os.path.relpath(path, root)}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+
+    return digest.hexdigest()
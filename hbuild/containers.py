@@ -0,0 +1,71 @@
+import json
+import threading
+
+import podman
+from podman import api
+
+DEFAULT_MAX_POOL_SIZE = 8
+
+client_lock = threading.Lock()
+shared_client: podman.PodmanClient | None = None
+max_pool_size = DEFAULT_MAX_POOL_SIZE
+
+def configure_podman(pool_size: int):
+    global max_pool_size
+    if shared_client is not None:
+        raise RuntimeError("The podman client is already connected, configure it before the first build")
+
+    max_pool_size = pool_size
+
+def podman_client() -> podman.PodmanClient:
+    # created on first use, so processes that never start containers
+    # (the API server, the dispatcher) never touch the podman socket
+    global shared_client
+    if shared_client is None:
+        with client_lock:
+            if shared_client is None:
+                shared_client = podman.from_env(max_pool_size=max_pool_size)
+
+    return shared_client
+
+def container_running(container) -> bool:
+    if container is None:
+        return False
+
+    try:
+        container.reload()
+    except Exception:
+        return False
+
+    return container.status == "running"
+
+def exec_stream(container, cmd: list[str], environment: dict[str, str], workdir: str, user: str):
+    # Container.exec_run(stream=True) drops the exec id, and with it any way
+    # to ask for the exit code of the command once the stream ends
+    data = {
+        "AttachStderr": True,
+        "AttachStdin": False,
+        "AttachStdout": True,
+        "Cmd": cmd,
+        "Env": [f"{k}={v}" for k, v in environment.items()],
+        "Privileged": False,
+        "Tty": True,
+        "WorkingDir": workdir,
+        "User": user,
+    }
+
+    response = container.client.post(f"/containers/{container.name}/exec", data=json.dumps(data))
+    response.raise_for_status()
+    exec_id = response.json()["Id"]
+
+    start_resp = container.client.post(f"/exec/{exec_id}/start", data=json.dumps({"Detach": False, "Tty": True}),
+                                       stream=True)
+    start_resp.raise_for_status()
+
+    return exec_id, api.stream_frames(start_resp)
+
+def exec_exit_code(container, exec_id: str) -> int:
+    response = container.client.get(f"/exec/{exec_id}/json")
+    response.raise_for_status()
+
+    return response.json()["ExitCode"]
@@ -0,0 +1,292 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import stat
+import subprocess
+import tarfile
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# debhelper marks everything a package ships under etc as a conffile
+CONFFILE_DIRS = ("etc/",)
+
+DEFAULT_COMPRESSION = "xz"
+DEFAULT_COMPRESSION_LEVEL = 6
+DEFAULT_PACK_WORKERS = 2
+
+# method -> (member suffix, command), the compressors use every cpu themselves
+COMPRESSORS = {
+    "xz": (".xz", ["xz", "-T0"]),
+    "zstd": (".zst", ["zstd", "-T0", "-q"]),
+    "gzip": (".gz", ["gzip", "-n"]),
+    "none": ("", None),
+}
+
+class HDebCompression():
+    __slots__ = ("method", "level")
+
+    def __init__(self, method: str = DEFAULT_COMPRESSION, level: int = DEFAULT_COMPRESSION_LEVEL):
+        if method not in COMPRESSORS:
+            raise ValueError(f"Unknown .deb compression {method}, expected one of {', '.join(COMPRESSORS)}")
+
+        self.method = method
+        self.level = level
+
+    @property
+    def suffix(self) -> str:
+        return COMPRESSORS[self.method][0]
+
+    def command(self) -> list[str] | None:
+        command = COMPRESSORS[self.method][1]
+        if command is None:
+            return None
+
+        # zstd goes past 19 only with --ultra
+        extra = ["--ultra"] if self.method == "zstd" and self.level > 19 else []
+        return [*command, *extra, f"-{self.level}", "-c"]
+
+    def __str__(self):
+        return f"{self.method}-{self.level}" if self.method != "none" else "none"
+
+class HDebResult():
+    __slots__ = ("deb_file", "compression", "input_bytes", "output_bytes", "elapsed")
+
+    def __init__(self, deb_file: str, compression: str, input_bytes: int, output_bytes: int, elapsed: float):
+        self.deb_file = deb_file
+        self.compression = compression
+        self.input_bytes = input_bytes
+        self.output_bytes = output_bytes
+        self.elapsed = elapsed
+
+    @property
+    def ratio(self) -> float:
+        return self.input_bytes / self.output_bytes if self.output_bytes > 0 else 0.0
+
+    def as_row(self, history_id: int, package: str) -> tuple:
+        return (history_id, package, self.deb_file, self.compression, self.elapsed, self.input_bytes,
+                self.output_bytes, None)
+
+    def __str__(self):
+        return f"{os.path.basename(self.deb_file)} in {self.elapsed:.2f}s with {self.compression}, " \
+               f"{self.input_bytes / (1024 * 1024):.1f} MiB -> {self.output_bytes / (1024 * 1024):.1f} MiB " \
+               f"({self.ratio:.2f}x)"
+
+class HPackageFile():
+    __slots__ = ("path", "st", "md5", "link_target")
+
+    def __init__(self, path: str, st: os.stat_result, md5: str | None, link_target: str | None):
+        self.path = path
+        self.st = st
+        self.md5 = md5
+        self.link_target = link_target
+
+    @property
+    def kind(self) -> str:
+        if stat.S_ISDIR(self.st.st_mode):
+            return "dir"
+        elif stat.S_ISLNK(self.st.st_mode):
+            return "symlink"
+        return "file"
+
+class HPackageManifest():
+    def __init__(self, root_dir: str, files: list[HPackageFile]):
+        self.root_dir = root_dir
+        self.files = files
+
+    @property
+    def dirs(self) -> list[HPackageFile]:
+        return [file for file in self.files if file.kind == "dir"]
+
+    @property
+    def payload_bytes(self) -> int:
+        return sum(file.st.st_size for file in self.files if file.kind == "file")
+
+    @property
+    def installed_size(self) -> int:
+        # in KiB, counted the way dpkg-gencontrol does: regular files by
+        # their rounded up size, directories and symlinks as one each
+        return sum((file.st.st_size + 1023) // 1024 if file.kind == "file" else 1 for file in self.files)
+
+    def md5sums(self) -> str:
+        return "".join(f"{file.md5}  {file.path}\n" for file in self.files if file.md5 is not None)
+
+    def conffiles(self) -> str:
+        return "".join(f"/{file.path}\n" for file in self.files
+                       if file.kind == "file" and file.path.startswith(CONFFILE_DIRS))
+
+    def install_entries(self) -> tuple[list, list]:
+        return [(file.path, file.st) for file in self.files if file.kind == "dir"], \
+               [(file.path, file.st) for file in self.files if file.kind != "dir"]
+
+def file_md5(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def scan_package(root_dir: str, exclude: tuple[str, ...] = ("DEBIAN",)) -> HPackageManifest:
+    files = []
+
+    pending = [""]
+    while len(pending) > 0:
+        rel_dir = pending.pop()
+        with os.scandir(os.path.join(root_dir, rel_dir)) as it:
+            for dent in it:
+                if rel_dir == "" and dent.name in exclude:
+                    continue
+
+                rel_path = os.path.join(rel_dir, dent.name)
+                st = dent.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode):
+                    pending.append(rel_path)
+                    files.append(HPackageFile(rel_path, st, None, None))
+                elif stat.S_ISLNK(st.st_mode):
+                    files.append(HPackageFile(rel_path, st, None, os.readlink(dent.path)))
+                elif stat.S_ISREG(st.st_mode):
+                    files.append(HPackageFile(rel_path, st, file_md5(dent.path), None))
+                # overlay whiteouts and other special files are never part of a package
+
+    # parents before children, the order dpkg unpacks in
+    files.sort(key=lambda file: file.path)
+    return HPackageManifest(root_dir, files)
+
+def tar_info(name: str, st: os.stat_result | None, kind: str, size: int = 0, link_target: str | None = None,
+             mtime: int | None = None) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.mode = stat.S_IMODE(st.st_mode) if st is not None else 0o644
+    info.mtime = int(st.st_mtime) if st is not None else mtime
+    # --root-owner-group
+    info.uid = info.gid = 0
+    info.uname = info.gname = "root"
+
+    if kind == "dir":
+        info.type = tarfile.DIRTYPE
+    elif kind == "symlink":
+        info.type = tarfile.SYMTYPE
+        info.linkname = link_target
+    else:
+        info.type = tarfile.REGTYPE
+        info.size = size
+
+    return info
+
+def compressed(fileobj, compression: HDebCompression):
+    command = compression.command()
+    if command is None:
+        return None
+
+    # tar writes into the compressor, which writes straight to fileobj
+    return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=fileobj)
+
+def finish_compressed(compressor: subprocess.Popen | None, compression: HDebCompression):
+    if compressor is None:
+        return
+
+    compressor.stdin.close()
+    if compressor.wait() != 0:
+        raise RuntimeError(f"{compression.method} exited with {compressor.returncode}")
+
+def data_tar(manifest: HPackageManifest, fileobj, compression: HDebCompression):
+    compressor = compressed(fileobj, compression)
+    try:
+        with tarfile.open(fileobj=compressor.stdin if compressor is not None else fileobj, mode="w|",
+                          format=tarfile.GNU_FORMAT) as tar:
+            tar.addfile(tar_info("./", os.stat(manifest.root_dir), "dir"))
+            for file in manifest.files:
+                name = f"./{file.path}/" if file.kind == "dir" else f"./{file.path}"
+                info = tar_info(name, file.st, file.kind, file.st.st_size, file.link_target)
+                if file.kind == "file":
+                    with open(os.path.join(manifest.root_dir, file.path), 'rb') as f:
+                        tar.addfile(info, f)
+                else:
+                    tar.addfile(info)
+    except BaseException:
+        if compressor is not None:
+            compressor.kill()
+            compressor.wait()
+        raise
+
+    finish_compressed(compressor, compression)
+
+def control_tar(members: dict[str, str], compression: HDebCompression, mtime: int) -> bytes:
+    tar_data = io.BytesIO()
+    with tarfile.open(fileobj=tar_data, mode="w", format=tarfile.GNU_FORMAT) as tar:
+        tar.addfile(tar_info("./", None, "dir", mtime=mtime))
+        for name, text in members.items():
+            data = text.encode('utf-8')
+            tar.addfile(tar_info(f"./{name}", None, "file", len(data), mtime=mtime), io.BytesIO(data))
+
+    command = compression.command()
+    if command is None:
+        return tar_data.getvalue()
+    return subprocess.run(command, input=tar_data.getvalue(), stdout=subprocess.PIPE, check=True).stdout
+
+def ar_member(out, name: str, data: bytes, mtime: int):
+    out.write(f"{name:<16}{mtime:<12}{0:<6}{0:<6}{'100644':<8}{len(data):<10}`\n".encode())
+    out.write(data)
+    if len(data) % 2 == 1:
+        out.write(b"\n")
+
+def deb_filename(name: str, version: str, architecture: str) -> str:
+    # dpkg leaves the epoch out of file names
+    return f"{name}_{version.split(':', 1)[-1]}_{architecture}.deb"
+
+def build_deb(manifest: HPackageManifest, control: str, deb_file: str,
+              compression: HDebCompression | None = None) -> HDebResult:
+    compression = compression or HDebCompression()
+    start = time.monotonic()
+    mtime = int(time.time())
+
+    members = {"control": control, "md5sums": manifest.md5sums()}
+    conffiles = manifest.conffiles()
+    if len(conffiles) > 0:
+        members["conffiles"] = conffiles
+
+    control_data = control_tar(members, compression, mtime)
+
+    tmp_file = f"{deb_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as out:
+        out.write(b"!<arch>\n")
+        ar_member(out, "debian-binary", b"2.0\n", mtime)
+        ar_member(out, f"control.tar{compression.suffix}", control_data, mtime)
+
+        # the data member is the big one, it is spooled to disk rather than
+        # held in memory before its size is known
+        data_file = f"{deb_file}.{os.getpid()}.data"
+        try:
+            with open(data_file, 'w+b') as data:
+                data_tar(manifest, data, compression)
+                # the compressor wrote through its own handle on the file
+                size = data.seek(0, os.SEEK_END)
+                data.seek(0)
+
+                out.write(f"{f'data.tar{compression.suffix}':<16}{mtime:<12}{0:<6}{0:<6}{'100644':<8}{size:<10}`\n".encode())
+                while chunk := data.read(1024 * 1024):
+                    out.write(chunk)
+                if size % 2 == 1:
+                    out.write(b"\n")
+        finally:
+            if os.path.exists(data_file):
+                os.unlink(data_file)
+
+    os.replace(tmp_file, deb_file)
+
+    return HDebResult(deb_file, str(compression), manifest.payload_bytes, os.path.getsize(deb_file),
+                      time.monotonic() - start)
+
+class HDebPackager():
+    def __init__(self, workers: int = DEFAULT_PACK_WORKERS):
+        # the runner is threaded by the time anything is packaged, and
+        # forking a threaded process is not safe
+        self.pool = ProcessPoolExecutor(max_workers=max(1, workers),
+                                        mp_context=multiprocessing.get_context("forkserver"))
+
+    def submit(self, manifest: HPackageManifest, control: str, deb_file: str,
+               compression: HDebCompression) -> Future:
+        return self.pool.submit(build_deb, manifest, control, deb_file, compression)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
@@ -1,18 +1,21 @@
 import json
-import re
 from enum import Enum
 
 import pymysql
 import rustworkx as rx
-from rustworkx import PyDiGraph
 from rustworkx.visualization.graphviz import graphviz_draw
 
 from .package import Package
-from .registry import HPackageRegistry
+from .index import HLookupKind
+from .logs import DEFAULT_MAX_BYTES, DEFAULT_MAX_CHUNKS, DEFAULT_MAX_LATENCY, HLogWriter
+from .registry import HPackageRegistry, HRegistryChange
+from .scheduler import DEFAULT_HEARTBEAT_TIMEOUT, DEFAULT_NODE_WEIGHT, DEFAULT_PLAN_CACHE_SIZE, HBuildPlan, \
+    HBuildScheduler, HPlanCache
 from .source import SourcePackage
 from .sql import HBuildLog
 from .stage import Stage
 from .tool import ToolPackage
+from .watch import HPkgsrcWatcher
 
 import pika as mq
 
@@ -53,10 +56,6 @@ class HBuildDispatch():
     def __init__(self):
         self.registry = HPackageRegistry()
 
-        self.registry.load_sources()
-        self.registry.load_tools()
-        self.registry.load_packages()
-
         self.sql_conn = pymysql.connect(host='localhost',
                                      user='root',
                                      password='sql',
@@ -67,190 +66,341 @@ class HBuildDispatch():
         self.node_indices: dict[int | str, HPackageNode] = {}
         self.graph = rx.PyDiGraph()
 
+        self.dep_dict: dict[str, list[str]] = {}
+        self.system_deps: dict[str, HPackageNode] = {}
+        self.no_deps: set[str] = set()
+
+        # node index -> bitset of the node and everything it depends on
+        self.closures: dict[int, int] = {}
+        self.build_order: list[int] = []
+
+        logs_config = self.registry.config["hbuild"].get("logs", {})
+        self.log_writer = HLogWriter(self.sql_conn,
+                                     logs_config.get("max_chunks", DEFAULT_MAX_CHUNKS),
+                                     logs_config.get("max_bytes", DEFAULT_MAX_BYTES),
+                                     logs_config.get("max_latency", DEFAULT_MAX_LATENCY))
+        self.log_prefetch_count = logs_config.get("prefetch_count", 2 * self.log_writer.max_chunks)
+
+        self.watcher: HPkgsrcWatcher | None = None
+        self.worker: RobustWorker | None = None
+        self.log_queue_names: set[str] = set()
+        dispatch_config = self.registry.config["hbuild"].get("dispatch", {})
+        self.scheduler = HBuildScheduler(dispatch_config.get("heartbeat_timeout", DEFAULT_HEARTBEAT_TIMEOUT))
+        self.plan_cache = HPlanCache(dispatch_config.get("plan_cache_size", DEFAULT_PLAN_CACHE_SIZE))
+
+        # last successful build time of each node, in seconds, and the hash
+        # of what it produced
+        self.default_weight = dispatch_config.get("default_weight", DEFAULT_NODE_WEIGHT)
+        self.durations: dict[str, float] = {}
+        self.output_hashes: dict[str, str] = {}
+        for row in HBuildLog.select_durations(self.sql_conn):
+            if row["duration"] is not None:
+                self.durations[row["package"]] = row["duration"]
+            if row["output_hash"]:
+                self.output_hashes[row["package"]] = row["output_hash"]
+
         self.build_graph()
 
     def add_node(self, package: SourcePackage | ToolPackage | Package | Stage, deps: list[str]):
         lookup_name = format_lookup_name(package)
-        node = HPackageNode(0, package, [])
+        node = HPackageNode(0, package, deps)
         index = self.graph.add_node(node)
         self.node_indices[index] = node
         self.node_indices[lookup_name] = node
         self.graph[index].index = index
 
+    def remove_node(self, lookup_name: str):
+        node = self.node_indices.pop(lookup_name)
+        del self.node_indices[node.index]
+        self.graph.remove_node(node.index)
+
     def lookup(self, name: str) -> Package | ToolPackage | SourcePackage | Stage | None:
-        source_try = self.registry.find_source(name)
-        if source_try is not None:
-            return source_try
-        elif (source_try := self.registry.find_tool(name)) is not None:
-            return source_try
-        elif (source_try := self.registry.find_package(name)) is not None:
-            return source_try
-        elif (matches := re.match('(.+)\\[(.+)]', name)) is not None:
-            parent = self.lookup(matches.group(1))
-            return parent.find_stage(matches.group(2))
+        return self.registry.lookup(name)
+
+    def node_deps(self, lookup_name: str) -> list[str]:
+        handle = self.registry.lookup_handle(lookup_name)
+        if handle.kind == HLookupKind.STAGE:
+            return handle.target.package.stage_deps[lookup_name]
+        elif handle.kind == HLookupKind.SOURCE:
+            return handle.target.deps()
         else:
-            return None
+            return [*handle.target.deps(), *handle.target.stage_deps.keys()]
+
+    def add_edges(self, lookup_name: str):
+        pkg_idx = self.node_indices[lookup_name].index
+
+        for dep in self.dep_dict[lookup_name]:
+            if dep not in self.node_indices:
+                raise Exception(f"Unable to resolve dependency {lookup_name} -> {dep}")
+
+            dep_idx = self.node_indices[dep].index
+            self.graph.add_edge(pkg_idx, dep_idx, None)
+
+        if lookup_name not in self.no_deps and lookup_name not in self.system_deps and self.registry.is_package(lookup_name):
+            for system_dep in self.system_deps.values():
+                self.graph.add_edge(pkg_idx, system_dep.index, None)
 
     def build_graph(self):
-        dep_dict: dict[str, list[str]] = {}
-
-        for source in self.registry.sources:
-            lookup_name = format_lookup_name(source)
-            dep_dict[lookup_name] = source.deps()
-
-            if lookup_name not in self.node_indices:
-                self.add_node(source, source.deps())
-
-            for dep in source.deps():
-                if dep not in self.node_indices:
-                    dep_package = self.lookup(dep)
-                    if dep_package is None:
-                        raise Exception(f"Unable to find dependency {dep.name} for source {source.name}")
-                    self.add_node(dep_package, dep_package.deps())
-
-        for tool in self.registry.tools:
-            lookup_name = format_lookup_name(tool)
-            dep_dict[tool.name] = tool.deps()
-
-            if tool.name not in self.node_indices:
-                self.add_node(tool, tool.deps())
-
-            for dep in tool.deps():
-                if dep not in self.node_indices:
-                    dep_package = self.lookup(dep)
-                    if dep_package is None:
-                        raise Exception(f"Unable to find dependency {dep.name} for tool {tool.name}")
-                    self.add_node(dep_package, dep_package.deps())
-
-            for stage, stage_deps in tool.stage_deps.items():
-                if stage not in self.node_indices:
-                    stage_package = self.lookup(stage)
-                    if stage_package is None:
-                        raise Exception(f"Unable to find stage {stage.name}")
-                    self.add_node(stage_package, stage_deps)
-                    dep_dict[tool.name] = [*dep_dict[tool.name], stage]
-
-                dep_dict[stage] = stage_deps
-                for dep in stage_deps:
-                    if dep not in self.node_indices:
-                        dep_package = self.lookup(dep)
-                        if dep_package is None:
-                            raise Exception(f"Unable to find dependency {dep.name} for stage {stage.name}")
-                        self.add_node(dep_package, dep_package.deps())
-
-        system_deps = {}
-        no_deps = []
+        self.node_indices = {}
+        self.graph = rx.PyDiGraph()
+
+        self.dep_dict = {}
+        self.system_deps = {}
+        self.no_deps = set()
+
+        for lookup_name, handle in self.registry.index.items():
+            self.dep_dict[lookup_name] = self.node_deps(lookup_name)
+            self.add_node(handle.target, self.dep_dict[lookup_name])
 
         for package in self.registry.packages:
-            dep_dict[package.name] = package.deps()
+            if package.system_package is True:
+                self.system_deps[package.name] = self.node_indices[package.name]
+            if package.no_deps:
+                self.no_deps.add(package.name)
+
+        for lookup_name in self.dep_dict:
+            self.add_edges(lookup_name)
+
+        self.build_closures()
+
+    def patch_graph(self, change: HRegistryChange):
+        # every regular package depends on every system package, so a change
+        # to the set of system packages rewires most of the graph anyway
+        if any(name in self.system_deps for name in change.removed) or \
+                any(self.registry.is_package(name) and self.registry.find_package(name).system_package
+                    for name in change.added):
+            self.build_graph()
+            return
+
+        for lookup_name in change.removed:
+            self.remove_node(lookup_name)
+            del self.dep_dict[lookup_name]
+            self.no_deps.discard(lookup_name)
+
+        for lookup_name in change.added:
+            handle = self.registry.lookup_handle(lookup_name)
+            self.dep_dict[lookup_name] = self.node_deps(lookup_name)
+            self.add_node(handle.target, self.dep_dict[lookup_name])
+
+            if handle.kind == HLookupKind.PACKAGE and handle.target.no_deps:
+                self.no_deps.add(lookup_name)
+
+        for lookup_name, deps in self.dep_dict.items():
+            if lookup_name in change.added:
+                self.add_edges(lookup_name)
+                continue
+
+            # edges into replaced nodes went away with them
+            pkg_idx = self.node_indices[lookup_name].index
+            for dep in deps:
+                if dep in change.added:
+                    self.graph.add_edge(pkg_idx, self.node_indices[dep].index, None)
 
-            if package.name not in self.node_indices:
-                self.add_node(package, package.deps())
+        self.build_closures()
 
-            if package.system_package is True and package.name not in system_deps:
-                system_deps[package.name] = self.node_indices[package.name]
+    def reload(self, paths: set[str]) -> HRegistryChange | None:
+        try:
+            change = self.registry.reload_pkgsrc_files(paths)
+        except Exception as e:
+            print(f"Rejected pkgsrc reload of {', '.join(sorted(paths))}: {e}")
+            return None
 
-            if package.no_deps:
-                no_deps.append(package.name)
-
-            for dep in package.deps():
-                if dep not in self.node_indices:
-                    dep_package = self.lookup(dep)
-                    if dep_package is None:
-                        raise Exception(f"Unable to find dependency {dep.name} for package {package.name}")
-                    self.add_node(dep_package, dep_package.deps())
-
-            for stage, stage_deps in package.stage_deps.items():
-                if stage not in self.node_indices:
-                    stage_package = self.lookup(stage)
-                    if stage_package is None:
-                        raise Exception(f"Unable to find stage {stage.name}")
-                    self.add_node(stage_package, stage_deps)
-                    dep_dict[package.name] = [*dep_dict[package.name], stage]
-
-                dep_dict[stage] = stage_deps
-                for dep in stage_deps:
-                    if dep not in self.node_indices:
-                        dep_package = self.lookup(dep)
-                        if dep_package is None:
-                            raise Exception(f"Unable to find dependency {dep.name} for stage {stage.name}")
-                        self.add_node(dep_package, dep_package.deps())
-
-        # TODO: avoid two loops
-
-        for pkg, deps in dep_dict.items():
-            pkg_idx = self.node_indices[pkg].index
+        self.patch_graph(change)
+        print(f"Reloaded package registry, {change}")
 
-            for dep in deps:
-                if dep not in self.node_indices:
-                    raise Exception(f"Unable to resolve dependency {pkg} -> {dep}")
+        # logs of packages new to the registry need their queue as well
+        log_queues = self.log_queues()
+        if self.worker is not None and len(log_queues) > 0:
+            self.worker.add_bulk_queues(log_queues)
+
+        return change
+
+    def poll_watcher(self):
+        changed = self.watcher.poll()
+        if len(changed) == 0:
+            return
+
+        change = self.reload(changed)
+        if change is None:
+            return
+
+        reload_exchange = Exchange("hbuild-reload", type="fanout")
+        pkgsrc_names = self.registry.pkgsrc_names(sorted(change.paths))
+        with Connection(self.rabbit_url) as conn:
+            with conn.channel() as channel:
+                producer = Producer(channel)
+                producer.publish(f"reload:{change.generation}:{json.dumps(pkgsrc_names)}",
+                                 exchange=reload_exchange,
+                                 declare=[reload_exchange])
+
+    def build_closures(self):
+        # dependencies first, so every successor's closure is final before
+        # it is folded into its dependents
+        self.build_order = list(reversed(rx.topological_sort(self.graph)))
+
+        self.closures = {}
+        for idx in self.build_order:
+            closure = 1 << idx
+            for dep_idx in self.graph.successor_indices(idx):
+                closure |= self.closures[dep_idx]
+            self.closures[idx] = closure
+
+        self.plan_cache.clear()
 
-                dep_idx = self.node_indices[dep].index
-                self.graph.add_edge(pkg_idx, dep_idx, None)
+    def select_nodes(self, selection) -> int:
+        selected = 0
+        for lookup_name in selection:
+            selected |= self.closures[self.node_indices[lookup_name].index]
 
-            if pkg not in no_deps and pkg not in system_deps and pkg in self.registry.package_names:
-                for system_dep in system_deps.values():
-                    self.graph.add_edge(pkg_idx, system_dep.index, None)
+        return selected
 
-    def build_subgraph(self, selection) -> tuple[PyDiGraph, dict[int, int]]:
-        subgraph: rx.PyDiGraph | None = None
-        nodemap: dict[int, int] = {}
-        if len(selection) > 0:
-            roots = []
-            descendants = []
-            for package in selection:
-                root_index = self.node_indices[package].index
+    def build_plan(self, selection) -> HBuildPlan:
+        key = (frozenset(selection), self.registry.snapshot.key)
+        plan = self.plan_cache.get(key)
+        if plan is not None:
+            return plan
 
-                roots.append(root_index)
-                root_descendants = rx.descendants(self.graph, root_index)
+        selected = self.select_nodes(selection)
 
-                for descendant in root_descendants:
-                    if descendant not in descendants:
-                        descendants.append(descendant)
+        build_order = [idx for idx in self.build_order if selected >> idx & 1]
+        build_deps = {str(self.graph[idx]): [str(self.graph[dep_idx]) for dep_idx in self.graph.successor_indices(idx)]
+                      for idx in build_order}
 
-            (subgraph, nodemap) = self.graph.subgraph_with_nodemap([*descendants, *roots])
+        build_groups = {str(self.graph[idx]): self.graph[idx].package.package_name
+                        for idx in build_order if isinstance(self.graph[idx].package, Stage)}
 
-        subgraph, tr_nodemap = rx.transitive_reduction(subgraph)
+        plan = HBuildPlan([str(self.graph[idx]) for idx in build_order], build_deps, build_groups)
+        self.plan_cache.put(key, plan)
 
-        # nodemap: new nodes -> old nodes
-        # tr_nodemap: new nodes -> reduced nodes
-        # full_nodemap: reduced nodes -> old nodes
-        full_nodemap = {tr_nodemap[k] : v for k, v in nodemap.items()}
+        return plan
 
-        return subgraph, full_nodemap
+    def dispatch_ready(self):
+        assignments = self.scheduler.assignments()
+        if len(assignments) == 0:
+            return
 
-    def build_indices(self, order_graph: rx.PyDiGraph) -> list[int]:
-        install_order = rx.topological_sort(order_graph)
-        install_order = list(reversed(install_order))
+        # an execute for a runner whose queue is gone comes back instead of
+        # vanishing, confirms make the broker say so before publish returns
+        returned: list[str] = []
+        def on_return(exception, exchange, routing_key, message):
+            returned.append(routing_key)
 
-        return install_order
+        exchange = Exchange("hbuild-exchange", type="direct")
+        with Connection(self.rabbit_url, transport_options={"confirm_publish": True}) as conn:
+            with conn.channel() as channel:
+                producer = Producer(channel, on_return=on_return)
+                for runner, job, lookup_name in assignments:
+                    dep_hashes = {str(self.graph[dep_idx]): self.output_hashes.get(str(self.graph[dep_idx]))
+                                  for dep_idx in self.graph.successor_indices(self.node_indices[lookup_name].index)}
+
+                    print(f"Job {job.id}: {lookup_name} -> {runner}")
+                    mode = "resume" if job.resume else "build"
+                    producer.publish(f"execute:{job.id}:{lookup_name}:{mode}:{json.dumps(dep_hashes)}",
+                                     exchange=exchange,
+                                     routing_key=runner,
+                                     mandatory=True,
+                                     declare=[exchange])
+
+        for runner in set(returned):
+            self.evict_runner(runner, "its queue is gone")
+        if len(returned) > 0:
+            self.dispatch_ready()
+
+    def evict_runner(self, runner: str, reason: str):
+        lost = self.scheduler.evict(runner)
+        print(f"Dropped runner {runner}, {reason}, requeued {len(lost)} nodes")
+
+    def consume_ready(self):
+        # called again after every reconnect
+        self.log_writer.discard()
+        self.announce()
+
+    def announce(self):
+        runners_exchange = Exchange("hbuild-runners", type="fanout")
+        with Connection(self.rabbit_url) as conn:
+            with conn.channel() as channel:
+                producer = Producer(channel)
+                producer.publish("announce",
+                                 exchange=runners_exchange,
+                                 declare=[runners_exchange])
 
     def consume(self, raw_body, message):
         body = raw_body
         objects = body.split(":")
         operation = objects[0]
+        if operation == "log":
+            # acknowledged by the log writer once the batch is committed
+            _, package_name, stage_name, log = body.split(":", maxsplit=3)
+            self.log_writer.append(package_name, stage_name, log, message)
+            return
+
         if operation == "build":
             requested_packages = objects[1].split(",")
-            subgraph, full_nodemap = self.build_subgraph(requested_packages)
+            resume = len(objects) > 2 and objects[2] == "resume"
+
+            # the server checks against its own registry, which may be a
+            # reload behind or ahead of this one
+            unknown = [name for name in requested_packages if name not in self.node_indices]
+            if len(unknown) > 0:
+                error = f"Unknown packages: {', '.join(unknown)}"
+                print(f"Rejected build, {error}")
+                if message.properties.get("reply_to"):
+                    with Connection(self.rabbit_url) as conn:
+                        with conn.channel() as channel:
+                            producer = Producer(channel)
+                            producer.publish(f"result_build:{json.dumps({'error': error})}",
+                                             routing_key=message.properties["reply_to"])
+                message.ack()
+                return
+            job = self.scheduler.submit(self.build_plan(requested_packages), self.durations, self.default_weight,
+                                        resume)
+            print(f"Job {job.id}: scheduled {len(job.plan)} nodes{' to resume' if resume else ''}, "
+                  f"critical path {job.critical_path:.0f}s")
+
+            self.dispatch_ready()
+        elif operation == "ready":
+            runner, slots, busy = objects[1:4]
+            self.scheduler.runner_ready(runner, int(slots), int(busy))
+
+            self.dispatch_ready()
+        elif operation == "result":
+            runner, job_id, lookup_name, status, duration, origin, output_hash = objects[1:8]
+            if status == "success":
+                if output_hash:
+                    self.output_hashes[lookup_name] = output_hash
+                else:
+                    self.output_hashes.pop(lookup_name, None)
+
+                # a restore says nothing about how long the node takes to build
+                if origin == "built":
+                    self.durations[lookup_name] = float(duration)
+
+                HBuildLog.insert_duration(self.sql_conn, lookup_name, runner, float(duration), output_hash or None,
+                                          origin == "cached")
+
+            job = self.scheduler.complete(runner, job_id, lookup_name, status == "success")
+            if job is not None:
+                print(f"Job {job.id}: {lookup_name} {status} on {runner} in {float(duration):.0f}s"
+                      f"{' from the cache' if origin == 'cached' else ''}")
+                if job.finished:
+                    print(f"Job {job.id}: finished, {job.summary()}")
+
+            self.dispatch_ready()
+        elif operation == "stats":
+            stats = {
+                "plan_cache": self.plan_cache.stats(),
+                "logs": self.log_writer.stats(),
+                "jobs": len(self.scheduler.jobs),
+                "runners": len(self.scheduler.slots),
+                "idle_slots": self.scheduler.idle_slots,
+                "running": len(self.scheduler.running),
+            }
 
-            build_indices = self.build_indices(subgraph)
-            build_order = [str(self.graph[full_nodemap[idx]]) for idx in build_indices]
-
-            exchange = Exchange("hbuild-exchange", type="direct")
             with Connection(self.rabbit_url) as conn:
                 with conn.channel() as channel:
                     producer = Producer(channel)
-                    producer.publish(f"execute:{','.join(build_order)}",
-                                     exchange=exchange,
-                                     routing_key='runners',
-                                     declare=[exchange])
-
-        elif operation == "log":
-            package_name = objects[1]
-            stage_name = objects[2]
-            log = objects[3]
-
-            HBuildLog.insert_log(self.sql_conn, package_name, stage_name, log)
+                    producer.publish(f"result_stats:{json.dumps(stats)}",
+                                     routing_key=message.properties["reply_to"])
         elif operation == "graph":
             edge_list = self.graph.edge_list()
             result_nodes = []
@@ -279,13 +429,46 @@ class HBuildDispatch():
                                                })}",
                                      routing_key=message.properties["reply_to"])
 
+        message.ack()
+
+    def on_iteration(self):
+        self.log_writer.flush_due()
+
+        stale = self.scheduler.stale_runners()
+        for runner in stale:
+            self.evict_runner(runner, f"no heartbeat in {self.scheduler.heartbeat_timeout:.0f}s")
+        if len(stale) > 0:
+            self.dispatch_ready()
+
+        if self.watcher is not None:
+            self.poll_watcher()
 
-    def run_server(self):
+    def log_queues(self) -> list[Queue]:
+        # one per package, only those without one yet
         exchange = Exchange("hbuild-exchange", type="direct")
-        queues: list[Queue] = [Queue("dispatch", exchange, routing_key="dispatch")]
+        queues: list[Queue] = []
         for package in self.registry.packages + self.registry.tools + self.registry.sources:
-            queues.append(Queue(format_lookup_name(package), exchange, routing_key="dispatch"))
+            lookup_name = format_lookup_name(package)
+            if lookup_name not in self.log_queue_names:
+                queues.append(Queue(lookup_name, exchange, routing_key=lookup_name))
+                self.log_queue_names.add(lookup_name)
+
+        return queues
+
+    def run_server(self, watch: bool = False):
+        if watch:
+            self.watcher = HPkgsrcWatcher(self.registry.config["hbuild"]["pkgsrc_dir"])
+
+        exchange = Exchange("hbuild-exchange", type="direct")
+        queues: list[Queue] = [Queue("dispatch", exchange, routing_key="dispatch")]
 
+        # logs are acked a batch at a time once MySQL has them, on their own
+        # channel so a slow database cannot starve results and readies
         with Connection(self.rabbit_url) as conn:
-            worker = RobustWorker(conn, queues, self.consume)
-            worker.run()
\ No newline at end of file
+            self.worker = RobustWorker(conn, queues, self.consume,
+                                       on_iteration_callback=self.on_iteration,
+                                       on_ready_callback=self.consume_ready,
+                                       auto_ack=False,
+                                       bulk_queues=self.log_queues(),
+                                       bulk_prefetch_count=self.log_prefetch_count)
+            self.worker.run()
\ No newline at end of file
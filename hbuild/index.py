@@ -0,0 +1,21 @@
+from enum import Enum
+
+class HLookupKind(Enum):
+    SOURCE = 1
+    TOOL = 2
+    PACKAGE = 3
+    STAGE = 4
+
+class HLookupHandle():
+    __slots__ = ("lookup_name", "kind", "target")
+
+    def __init__(self, lookup_name: str, kind: HLookupKind, target):
+        self.lookup_name = lookup_name
+        self.kind = kind
+        self.target = target
+
+    def __str__(self):
+        return self.lookup_name
+
+    def __repr__(self):
+        return f"HLookupHandle({self.lookup_name}, {self.kind.name})"
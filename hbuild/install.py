@@ -0,0 +1,228 @@
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+DEFAULT_INSTALL_WORKERS = 8
+
+# from linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning the filesystem cannot do it, not that the file is bad
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EPERM, errno.EMLINK)
+
+class HInstallMethod(Enum):
+    REFLINK = 1
+    HARDLINK = 2
+    COPY = 3
+
+class HInstallEntry():
+    __slots__ = ("path", "kind", "size")
+
+    def __init__(self, path: str, kind: str, size: int):
+        self.path = path
+        self.kind = kind
+        self.size = size
+
+class HInstallResult():
+    def __init__(self, source_dir: str, target_dir: str):
+        self.source_dir = source_dir
+        self.target_dir = target_dir
+        self.entries: list[HInstallEntry] = []
+
+        self.bytes = 0
+        self.unchanged = 0
+        self.methods = {method: 0 for method in HInstallMethod}
+        self.errors: list[str] = []
+        self.elapsed = 0.0
+
+    @property
+    def files(self) -> int:
+        return sum(1 for entry in self.entries if entry.kind != "dir")
+
+    @property
+    def throughput(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        methods = ", ".join(f"{count} {method.name.lower()}" for method, count in self.methods.items() if count > 0)
+        return f"{self.files} files ({self.bytes / (1024 * 1024):.1f} MiB) into {self.target_dir} " \
+               f"in {self.elapsed:.2f}s, {self.throughput / (1024 * 1024):.1f} MiB/s " \
+               f"[{methods or 'nothing new'}, {self.unchanged} unchanged, {len(self.errors)} failed]"
+
+class HInstaller():
+    def __init__(self, workers: int = DEFAULT_INSTALL_WORKERS, link: bool = True):
+        self.workers = workers
+        self.link = link
+
+        # (source device, target device) -> methods that failed there once
+        self.unsupported: dict[tuple[int, int], set[HInstallMethod]] = {}
+        self.lock = threading.Lock()
+
+    def scan(self, source_dir: str, exclude: tuple[str, ...]) -> tuple[list, list]:
+        dirs = []
+        files = []
+
+        pending = [""]
+        while len(pending) > 0:
+            rel_dir = pending.pop()
+            with os.scandir(os.path.join(source_dir, rel_dir)) as it:
+                for dent in it:
+                    rel_path = os.path.join(rel_dir, dent.name)
+                    if rel_dir == "" and dent.name in exclude:
+                        continue
+
+                    st = dent.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(st.st_mode):
+                        dirs.append((rel_path, st))
+                        pending.append(rel_path)
+                    else:
+                        files.append((rel_path, st))
+
+        # parents before children
+        dirs.sort()
+        return dirs, files
+
+    def install(self, source_dir: str, target_dir: str, exclude: tuple[str, ...] = (),
+                scanned: tuple[list, list] | None = None) -> HInstallResult:
+        result = HInstallResult(source_dir, target_dir)
+        start = time.monotonic()
+
+        # callers that already walked the tree pass (dirs, files) along
+        dirs, files = scanned if scanned is not None else self.scan(source_dir, exclude)
+
+        os.makedirs(target_dir, exist_ok=True)
+        for rel_path, st in dirs:
+            try:
+                os.makedirs(os.path.join(target_dir, rel_path), exist_ok=True)
+            except OSError as e:
+                result.errors.append(f"{rel_path}: {e}")
+                continue
+            result.entries.append(HInstallEntry(rel_path, "dir", 0))
+
+        target_dev = os.stat(target_dir).st_dev
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            outcomes = pool.map(lambda item: self.install_file(source_dir, target_dir, target_dev, *item), files)
+
+            for (rel_path, st), outcome in zip(files, outcomes):
+                kind = "symlink" if stat.S_ISLNK(st.st_mode) else "file"
+                if isinstance(outcome, Exception):
+                    result.errors.append(f"{rel_path}: {outcome}")
+                    continue
+
+                result.entries.append(HInstallEntry(rel_path, kind, st.st_size))
+                if outcome is None:
+                    result.unchanged += 1
+                else:
+                    result.methods[outcome] += 1
+                    result.bytes += st.st_size
+
+        # children change the mtime of their parents, so directories go last
+        for rel_path, st in reversed(dirs):
+            target_path = os.path.join(target_dir, rel_path)
+            # e.g. lib -> usr/lib in the root, leave what it points at alone
+            if os.path.islink(target_path) or not os.path.isdir(target_path):
+                continue
+
+            os.chmod(target_path, stat.S_IMODE(st.st_mode))
+            os.utime(target_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        result.elapsed = time.monotonic() - start
+        return result
+
+    def install_file(self, source_dir: str, target_dir: str, target_dev: int, rel_path: str,
+                     st: os.stat_result) -> HInstallMethod | Exception | None:
+        source_path = os.path.join(source_dir, rel_path)
+        target_path = os.path.join(target_dir, rel_path)
+
+        try:
+            try:
+                target_st = os.lstat(target_path)
+                if target_st.st_ino == st.st_ino and target_st.st_dev == st.st_dev:
+                    return None
+
+                # the same quick check as rsync, copies keep the mtime
+                if stat.S_IFMT(target_st.st_mode) == stat.S_IFMT(st.st_mode) and \
+                        target_st.st_size == st.st_size and target_st.st_mtime_ns == st.st_mtime_ns:
+                    if not stat.S_ISLNK(st.st_mode) or os.readlink(target_path) == os.readlink(source_path):
+                        return None
+            except FileNotFoundError:
+                pass
+
+            # built next to the target and renamed over it, so readers of the
+            # root never see a half written file
+            tmp_path = os.path.join(os.path.dirname(target_path), f".{os.path.basename(target_path)}.hbuild-tmp")
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+
+            if stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(source_path), tmp_path)
+                os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+                os.replace(tmp_path, target_path)
+                return HInstallMethod.COPY
+
+            method = self.place(source_path, tmp_path, (st.st_dev, target_dev))
+            os.replace(tmp_path, target_path)
+            return method
+        except OSError as e:
+            return e
+
+    def place(self, source_path: str, tmp_path: str, devices: tuple[int, int]) -> HInstallMethod:
+        methods = [HInstallMethod.REFLINK, HInstallMethod.HARDLINK] if self.link else []
+        with self.lock:
+            unsupported = set(self.unsupported.get(devices, ()))
+
+        for method in methods:
+            if method in unsupported:
+                continue
+
+            try:
+                if method == HInstallMethod.REFLINK:
+                    self.reflink(source_path, tmp_path)
+                else:
+                    os.link(source_path, tmp_path, follow_symlinks=False)
+                return method
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+
+                if os.path.lexists(tmp_path):
+                    os.unlink(tmp_path)
+                # EMLINK and EPERM can be about this one file, EXDEV and
+                # friends are about the pair of filesystems
+                if e.errno not in (errno.EMLINK, errno.EPERM):
+                    with self.lock:
+                        self.unsupported.setdefault(devices, set()).add(method)
+
+        shutil.copy2(source_path, tmp_path, follow_symlinks=False)
+        return HInstallMethod.COPY
+
+    def reflink(self, source_path: str, tmp_path: str):
+        with open(source_path, 'rb') as source, open(tmp_path, 'wb') as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+        shutil.copystat(source_path, tmp_path, follow_symlinks=False)
+
+installer_lock = threading.Lock()
+shared_installer: HInstaller | None = None
+installer_config = {}
+
+def configure_installer(**kwargs):
+    if shared_installer is not None:
+        raise RuntimeError("The installer is already running, configure it before the first install")
+
+    installer_config.update(kwargs)
+
+def installer() -> HInstaller:
+    global shared_installer
+    if shared_installer is None:
+        with installer_lock:
+            if shared_installer is None:
+                shared_installer = HInstaller(**installer_config)
+
+    return shared_installer
@@ -0,0 +1,88 @@
+import os
+import stat
+import threading
+
+JOBSERVER_PATH = "/home/hbuild/jobserver"
+
+class HJobServer():
+    __slots__ = ("fifo_file", "tokens", "slots", "fd", "lock")
+
+    def __init__(self, fifo_file: str, tokens: int, slots: int = 1):
+        self.fifo_file = fifo_file
+        self.tokens = max(1, tokens)
+        self.slots = slots
+
+        os.makedirs(os.path.dirname(fifo_file), exist_ok=True)
+        if os.path.lexists(fifo_file):
+            if not stat.S_ISFIFO(os.lstat(fifo_file).st_mode):
+                raise ValueError(f"Jobserver path {fifo_file} exists and is not a FIFO")
+        else:
+            os.mkfifo(fifo_file, 0o666)
+
+        # holding both ends open keeps the pipe alive between builds, so the
+        # tokens in it survive while no make is connected
+        self.fd = os.open(fifo_file, os.O_RDWR | os.O_NONBLOCK)
+        self.lock = threading.Lock()
+        self.refill()
+
+    @property
+    def pool_size(self) -> int:
+        # every top level make runs one job on the token it implicitly owns,
+        # so with all slots busy the host runs exactly self.tokens jobs
+        return max(0, self.tokens - self.slots)
+
+    @property
+    def makeflags(self) -> str:
+        return f"-j{self.tokens} --jobserver-auth=fifo:{JOBSERVER_PATH}"
+
+    def drain(self) -> bytes:
+        drained = b""
+        while True:
+            try:
+                chunk = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return drained
+
+            if len(chunk) == 0:
+                return drained
+            drained += chunk
+
+    def refill(self):
+        # a make killed mid build never returns its tokens, only call this
+        # when no build is running on the runner
+        with self.lock:
+            self.drain()
+            os.write(self.fd, b"+" * self.pool_size)
+
+    def close(self):
+        os.close(self.fd)
+
+    def container_volume(self) -> dict:
+        return {
+            self.fifo_file: {
+                'bind': JOBSERVER_PATH,
+                'mode': 'rw',
+                'extended_mode': ['z']
+            }
+        }
+
+jobserver_lock = threading.Lock()
+shared_jobserver: HJobServer | None = None
+
+def configure_jobserver(fifo_file: str, tokens: int, slots: int) -> HJobServer:
+    global shared_jobserver
+    with jobserver_lock:
+        if shared_jobserver is not None:
+            raise RuntimeError("The jobserver is already running")
+
+        shared_jobserver = HJobServer(fifo_file, tokens, slots)
+
+    return shared_jobserver
+
+# None outside of a runner, steps then fall back to one make -jN per build
+def jobserver() -> HJobServer | None:
+    return shared_jobserver
+
+def jobserver_volume() -> dict:
+    server = jobserver()
+    return server.container_volume() if server is not None else {}
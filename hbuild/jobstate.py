@@ -0,0 +1,26 @@
+from podman.domain.containers import Container as PodmanContainer
+
+from .cgroup import HStepStats
+from .checkpoint import HCheckpoint
+from .spool import HLogSpool
+
+class HJobState():
+    # what one build changes as it runs, the recipe objects are shared by
+    # every slot of the runner and stay as the registry loaded them
+    __slots__ = ("container", "log_spool", "checkpoint", "step_stats", "last_return_status")
+
+    def __init__(self, container: PodmanContainer | None = None, log_spool: HLogSpool | None = None):
+        self.container = container
+        self.log_spool = log_spool
+        self.checkpoint: HCheckpoint | None = None
+        self.step_stats: list[HStepStats] = []
+        self.last_return_status = None
+
+    def kill_build(self):
+        self.container.kill(signal='SIGKILL')
+
+    def tidy(self):
+        if self.container is not None:
+            self.container.kill(signal='SIGKILL')
+            self.container.remove(force=True)
+            self.container = None
@@ -0,0 +1,325 @@
+import codecs
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+from kombu import Connection as MQConnection, Exchange, Producer
+from pymysql import Connection
+
+from .spool import HLogSpool
+from .sql import HBuildLog
+
+DEFAULT_MAX_CHUNKS = 500
+DEFAULT_MAX_BYTES = 256 * 1024
+DEFAULT_MAX_LATENCY = 0.5
+
+DEFAULT_PUBLISH_BYTES = 16 * 1024
+DEFAULT_PUBLISH_LATENCY = 0.2
+DEFAULT_MAX_PENDING = 10000
+
+DEFAULT_SAMPLE_INTERVAL = 2.0
+DEFAULT_TAIL_LINES = 20
+
+class HLogWriter():
+    def __init__(self, conn: Connection, max_chunks: int = DEFAULT_MAX_CHUNKS,
+                 max_bytes: int = DEFAULT_MAX_BYTES, max_latency: float = DEFAULT_MAX_LATENCY):
+        self.conn = conn
+        self.max_chunks = max_chunks
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+
+        # (package, stage) -> chunks, in arrival order
+        self.buffers: dict[tuple[str, str], list[str]] = {}
+        self.messages = []
+        self.buffered_bytes = 0
+        self.oldest = 0.0
+
+        self.started = time.monotonic()
+        self.chunks = 0
+        self.rows = 0
+        self.bytes = 0
+        self.flushes = 0
+        self.flush_time = 0.0
+        self.failures = 0
+
+    def append(self, package: str, stage: str, log: str, message):
+        if len(self.messages) == 0:
+            self.oldest = time.monotonic()
+
+        self.buffers.setdefault((package, stage), []).append(log)
+        self.messages.append(message)
+        self.buffered_bytes += len(log)
+
+        if len(self.messages) >= self.max_chunks or self.buffered_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush_due(self):
+        if len(self.messages) > 0 and time.monotonic() - self.oldest >= self.max_latency:
+            self.flush()
+
+    def flush(self):
+        if len(self.messages) == 0:
+            return
+
+        rows = [(package, stage, "".join(chunks)) for (package, stage), chunks in self.buffers.items()]
+
+        start = time.monotonic()
+        try:
+            self.conn.ping(reconnect=True)
+            HBuildLog.insert_logs(self.conn, rows)
+        except Exception as e:
+            # keep everything buffered and unacknowledged, the next flush retries
+            self.failures += 1
+            print(f"Failed to write {len(rows)} log rows: {e}")
+            return
+        self.flush_time += time.monotonic() - start
+
+        # the channel delivers in order and everything else is acked as it
+        # is consumed, so one cumulative ack covers the whole batch
+        self.messages[-1].ack(multiple=True)
+
+        self.chunks += len(self.messages)
+        self.rows += len(rows)
+        self.bytes += self.buffered_bytes
+        self.flushes += 1
+
+        self.buffers = {}
+        self.messages = []
+        self.buffered_bytes = 0
+
+    def discard(self):
+        # unacked deliveries of a closed channel come back on the new one,
+        # writing and acking them now would only insert them twice
+        if len(self.messages) > 0:
+            print(f"Dropping {len(self.messages)} buffered log chunks, the broker redelivers them")
+
+        self.buffers = {}
+        self.messages = []
+        self.buffered_bytes = 0
+
+    def stats(self) -> dict[str, float]:
+        elapsed = time.monotonic() - self.started
+        return {
+            "chunks": self.chunks,
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "buffered_chunks": len(self.messages),
+            "chunks_per_second": self.chunks / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_second": self.bytes / elapsed if elapsed > 0 else 0.0,
+            "average_flush_ms": self.flush_time * 1000 / self.flushes if self.flushes > 0 else 0.0,
+        }
+
+class HLogStream():
+    def __init__(self, publisher: 'HLogPublisher', routing_key: str, lookup_name: str, stage_name: str,
+                 spool: HLogSpool | None = None):
+        self.publisher = publisher
+        self.key = (routing_key, lookup_name, stage_name)
+        self.spool = spool
+
+        # a multibyte character can be split across two reads of the tty
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.partial = ""
+
+        # with a spool the broker only sees the last lines of every interval
+        self.tail: collections.deque[str] = collections.deque(maxlen=publisher.tail_lines)
+        self.unsampled = 0
+        self.sampled = time.monotonic()
+
+    def write(self, chunk: bytes):
+        text = self.partial + self.decoder.decode(chunk)
+
+        end = text.rfind('\n') + 1
+        if end == 0 and len(text) < self.publisher.max_bytes:
+            self.partial = text
+            return
+
+        if end == 0:
+            end = len(text)
+
+        self.partial = text[end:]
+        self.emit(text[:end])
+
+    def emit(self, text: str):
+        if self.spool is None:
+            self.publisher.put(self.key, text)
+            return
+
+        self.spool.write(text)
+
+        lines = text.splitlines(keepends=True)
+        self.tail.extend(lines[-self.publisher.tail_lines:])
+        self.unsampled += len(lines)
+
+        if time.monotonic() - self.sampled >= self.publisher.sample_interval:
+            self.sample()
+
+    def sample(self):
+        self.sampled = time.monotonic()
+        if self.unsampled == 0:
+            return
+
+        # readers of the sample can fetch what was skipped from the spool
+        self.spool.flush()
+
+        skipped = self.unsampled - len(self.tail)
+        marker = f"[hbuild] {skipped} lines only in the build spool\n" if skipped > 0 else ""
+        self.publisher.put(self.key, marker + "".join(self.tail))
+
+        self.tail.clear()
+        self.unsampled = 0
+
+    def close(self):
+        text = self.partial + self.decoder.decode(b'', final=True)
+        self.partial = ""
+        if len(text) > 0:
+            self.emit(text)
+
+        if self.spool is not None:
+            self.sample()
+
+class HLogPublisher():
+    def __init__(self, rabbit_url: str, spool_file: str, max_bytes: int = DEFAULT_PUBLISH_BYTES,
+                 max_latency: float = DEFAULT_PUBLISH_LATENCY, max_pending: int = DEFAULT_MAX_PENDING,
+                 sample_interval: float = DEFAULT_SAMPLE_INTERVAL, tail_lines: int = DEFAULT_TAIL_LINES):
+        self.rabbit_url = rabbit_url
+        self.spool_file = spool_file
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.max_pending = max_pending
+        self.sample_interval = sample_interval
+        self.tail_lines = tail_lines
+
+        self.exchange = Exchange("hbuild-exchange", type="direct")
+        self.connection: MQConnection | None = None
+        self.producer: Producer | None = None
+
+        self.queue: queue.Queue[tuple[tuple[str, str, str], str]] = queue.Queue()
+        # (routing key, lookup name, stage) -> (first chunk time, chunks, size)
+        self.batches: dict[tuple[str, str, str], tuple[float, list[str], int]] = {}
+        self.spooled = os.path.exists(self.spool_file) and os.path.getsize(self.spool_file) > 0
+
+        self.published = 0
+        self.spooled_batches = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stream(self, routing_key: str, lookup_name: str, stage_name: str,
+               spool: HLogSpool | None = None) -> HLogStream:
+        return HLogStream(self, routing_key, lookup_name, stage_name, spool)
+
+    def put(self, key: tuple[str, str, str], text: str):
+        self.queue.put((key, text))
+
+    def run(self):
+        while True:
+            timeout = None
+            if len(self.batches) > 0:
+                oldest = min(first for first, _, _ in self.batches.values())
+                timeout = max(0.0, oldest + self.max_latency - time.monotonic())
+            elif self.spooled:
+                timeout = 1.0
+
+            try:
+                key, text = self.queue.get(timeout=timeout)
+                first, chunks, size = self.batches.get(key, (time.monotonic(), [], 0))
+                chunks.append(text)
+                self.batches[key] = (first, chunks, size + len(text))
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            for key, (first, chunks, size) in list(self.batches.items()):
+                if size >= self.max_bytes or now - first >= self.max_latency:
+                    del self.batches[key]
+                    self.send(key, "".join(chunks))
+
+            if self.spooled and len(self.batches) == 0 and self.queue.empty():
+                self.replay_spool()
+
+    def send(self, key: tuple[str, str, str], text: str):
+        # builds outrunning the broker spill to disk instead of memory
+        if self.spooled or self.queue.qsize() > self.max_pending or not self.publish(key, text):
+            self.spool(key, text)
+
+    def publish(self, key: tuple[str, str, str], text: str) -> bool:
+        routing_key, lookup_name, stage_name = key
+        try:
+            if self.producer is None:
+                self.connection = MQConnection(self.rabbit_url)
+                channel = self.connection.channel()
+                self.exchange(channel).declare()
+                self.producer = Producer(channel)
+
+            self.producer.publish(f"log:{lookup_name}:{stage_name}:{text}",
+                                  exchange=self.exchange,
+                                  routing_key=routing_key)
+        except Exception as e:
+            print(f"Failed to publish logs for {lookup_name}, spooling: {e}")
+            self.disconnect()
+            return False
+
+        self.published += 1
+        return True
+
+    def disconnect(self):
+        if self.connection is not None:
+            try:
+                self.connection.release()
+            except Exception:
+                pass
+
+        self.connection = None
+        self.producer = None
+
+    def spool(self, key: tuple[str, str, str], text: str):
+        os.makedirs(os.path.dirname(self.spool_file), exist_ok=True)
+        with open(self.spool_file, 'a') as f:
+            f.write(json.dumps([*key, text]) + "\n")
+
+        self.spooled = True
+        self.spooled_batches += 1
+
+    def replay_spool(self):
+        replay_file = f"{self.spool_file}.replay"
+        if not os.path.exists(replay_file):
+            os.replace(self.spool_file, replay_file)
+
+        with open(replay_file) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+
+        for sent, (routing_key, lookup_name, stage_name, text) in enumerate(entries):
+            if not self.publish((routing_key, lookup_name, stage_name), text):
+                with open(replay_file, 'w') as f:
+                    f.writelines(json.dumps(entry) + "\n" for entry in entries[sent:])
+                return
+
+        os.unlink(replay_file)
+        self.spooled = os.path.exists(self.spool_file) and os.path.getsize(self.spool_file) > 0
+
+publisher_lock = threading.Lock()
+shared_publisher: HLogPublisher | None = None
+publisher_config = {
+    "rabbit_url": "amqp://mq:mq@localhost:5672",
+    "spool_file": os.path.join("cache", "log-spool", f"{os.getpid()}.jsonl"),
+}
+
+def configure_log_publisher(**kwargs):
+    if shared_publisher is not None:
+        raise RuntimeError("The log publisher is already running, configure it before the first build")
+
+    publisher_config.update(kwargs)
+
+def log_publisher() -> HLogPublisher:
+    global shared_publisher
+    if shared_publisher is None:
+        with publisher_lock:
+            if shared_publisher is None:
+                shared_publisher = HLogPublisher(**publisher_config)
+
+    return shared_publisher
@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import threading
+
+from .install import HInstallEntry
+
+MANIFEST_DB = "manifests.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    owner TEXT NOT NULL,
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (root, owner, path)
+);
+CREATE INDEX IF NOT EXISTS entries_path ON entries (root, path);
+"""
+
+initialized_lock = threading.Lock()
+initialized: set[str] = set()
+
+class HManifestDB():
+    def __init__(self, manifests_dir: str):
+        self.db_file = os.path.join(manifests_dir, MANIFEST_DB)
+
+        with initialized_lock:
+            if self.db_file not in initialized:
+                os.makedirs(manifests_dir, exist_ok=True)
+                with self.connect() as conn:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.executescript(SCHEMA)
+                initialized.add(self.db_file)
+
+    def connect(self) -> sqlite3.Connection:
+        # a connection per call, runners install from several threads
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def record(self, owner: str, root: str, entries: list[HInstallEntry]) -> dict[str, list[str]]:
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM entries WHERE root = ? AND owner = ?", (root, owner))
+                conn.executemany("INSERT INTO entries (owner, root, path, kind, size) VALUES (?, ?, ?, ?, ?)",
+                                 ((owner, root, entry.path, entry.kind, entry.size) for entry in entries))
+
+                return self.shared(conn, owner, root)
+        finally:
+            conn.close()
+
+    def shared(self, conn: sqlite3.Connection, owner: str, root: str) -> dict[str, list[str]]:
+        # directories are shared by design, two owners of one file are not
+        rows = conn.execute("SELECT mine.path, other.owner FROM entries mine "
+                            "JOIN entries other ON other.root = mine.root AND other.path = mine.path "
+                            "AND other.owner != mine.owner "
+                            "WHERE mine.root = ? AND mine.owner = ? AND mine.kind != 'dir'", (root, owner))
+
+        shared: dict[str, list[str]] = {}
+        for path, other_owner in rows:
+            shared.setdefault(path, []).append(other_owner)
+        return shared
+
+    def entries(self, owner: str, root: str) -> list[tuple[str, str]] | None:
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT path, kind FROM entries WHERE root = ? AND owner = ?",
+                                (root, owner)).fetchall()
+        finally:
+            conn.close()
+
+        return rows if len(rows) > 0 else None
+
+    def remove(self, owner: str, root: str) -> dict[str, list[str]]:
+        conn = self.connect()
+        try:
+            with conn:
+                shared = self.shared(conn, owner, root)
+                conn.execute("DELETE FROM entries WHERE root = ? AND owner = ?", (root, owner))
+                return shared
+        finally:
+            conn.close()
+
+def report_shared(owner: str, shared: dict[str, list[str]]):
+    if len(shared) == 0:
+        return
+
+    print(f"{owner} shares {len(shared)} files with other packages:")
+    for path, owners in sorted(shared.items())[:20]:
+        print(f"  {path} (also {', '.join(sorted(owners))})")
+    if len(shared) > 20:
+        print(f"  ... and {len(shared) - 20} more")
+
+def remove_installed(db: HManifestDB, owner: str, root: str) -> bool:
+    entries = db.entries(owner, root)
+    if entries is None:
+        return False
+
+    # a file another package installed too stays, it would break that one
+    shared = db.remove(owner, root)
+    report_shared(owner, shared)
+
+    dirs = set()
+    for path, kind in entries:
+        if kind == "dir":
+            dirs.add(path)
+            continue
+        if path in shared:
+            continue
+
+        target_path = os.path.join(root, path)
+        if os.path.islink(target_path) or (os.path.lexists(target_path) and not os.path.isdir(target_path)):
+            os.unlink(target_path)
+
+    # only the directories this package touched, deepest first, and only
+    # once nothing is left in them
+    for path in sorted(dirs, key=lambda path: path.count("/"), reverse=True):
+        target_path = os.path.join(root, path)
+        if os.path.isdir(target_path) and not os.path.islink(target_path):
+            try:
+                os.rmdir(target_path)
+            except OSError:
+                pass
+
+    return True
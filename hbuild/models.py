@@ -19,6 +19,7 @@ class BuildItem(BaseModel):
 class BuildOrder(BaseModel):
     build_to:  HBuildTo
     packages: list[BuildItem]
+    resume: bool = False
 
 class ResolveOrder(BaseModel):
     packages: list[str]
\ No newline at end of file
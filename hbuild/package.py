@@ -1,51 +1,54 @@
-import math
 import os
 import shutil
-import subprocess
 from pathlib import Path
 
-import podman
 from persistqueue import FIFOSQLiteQueue
-from podman.domain.containers import Container as PodmanContainer
 
 from .config import HPackageConfig
 from .source import SourcePackage
 from .stage import Stage
+from .jobstate import HJobState
 from .step import Step
+from .template import make_context
+from .containers import container_running, podman_client
+from .install import installer
+from .deb import HDebCompression, HDebResult, HPackageManifest, build_deb, deb_filename, scan_package
+from .manifest import HManifestDB, remove_installed, report_shared
+from .jobserver import jobserver_volume
 
 class Package:
-    def __init__(self, config: HPackageConfig):
+    __slots__ = ("config", "pkgsrc_yml", "pkgsrc_path", "name", "version",
+                 "log_dir", "work_dir", "build_dir", "package_dir", "source_dir", "source_name",
+                 "metadata", "compression",
+                 "system_package", "no_deps", "tools_required", "pkgs_required",
+                 "configure_steps", "build_steps", "stages")
+
+    def __init__(self, config: HPackageConfig, pkgsrc_yml: dict, pkgsrc_path: str, source_dir: str):
         self.config = config
+        self.pkgsrc_yml = pkgsrc_yml
+        self.pkgsrc_path = pkgsrc_path
 
-        source_properties = config.pkgsrc_yml
+        source_properties = pkgsrc_yml
 
         self.name = source_properties["name"]
         self.version = source_properties["version"]
 
-        self.logs_dir = config.logs_dir
-        self.sources_dir = config.sources_dir
-        self.builds_dir = config.builds_dir
-        self.packages_dir = config.packages_dir
-        self.works_dir = config.works_dir
-
         self.log_dir = Path(config.logs_dir, self.name).resolve().as_posix()
-        self.work_dir = Path(self.works_dir, self.name).resolve().as_posix()
+        self.work_dir = Path(config.works_dir, self.name).resolve().as_posix()
         self.build_dir = Path(config.builds_dir, self.name).resolve().as_posix()
         self.package_dir = Path(config.packages_dir, self.name).resolve().as_posix()
-        self.system_prefix = config.system_prefix
-        self.system_targets = config.system_targets
-        self.system_root = config.system_root
 
-        self.source_dir = config.source_dir
+        self.source_dir = source_dir
         self.source_name = source_properties["from_source"]
 
-        self.podman_client = podman.from_env()
-        self.podman_container: PodmanContainer = None
-
-        self.last_return_status = None
-
         self.metadata = source_properties["metadata"]
 
+        # how this package's .deb is compressed, over [hbuild.deb]
+        if "compression" in source_properties:
+            self.compression = source_properties["compression"]
+        else:
+            self.compression = {}
+
         if "system-package" in source_properties:
             self.system_package = True
         else:
@@ -66,28 +69,45 @@ class Package:
         else:
             self.pkgs_required = []
 
-        self.configure_ymls: list[dict[str, str]] = []
-        self.build_ymls: list[dict[str, str]] = []
-        self.stage_ymls: list[dict[str, str]] = []
-
         self.configure_steps: list[Step] = []
         self.build_steps: list[Step] = []
         self.stages: list[Stage] = []
 
-        if "configure" in source_properties:
-            configure_properties = source_properties["configure"]
-            for step_yml in configure_properties:
-                self.configure_ymls.append(step_yml)
+    @property
+    def podman_client(self):
+        return podman_client()
 
-        if "build" in source_properties:
-            build_properties = source_properties["build"]
-            for step_yml in build_properties:
-                self.build_ymls.append(step_yml)
+    @property
+    def logs_dir(self):
+        return self.config.logs_dir
+
+    @property
+    def sources_dir(self):
+        return self.config.sources_dir
+
+    @property
+    def builds_dir(self):
+        return self.config.builds_dir
+
+    @property
+    def packages_dir(self):
+        return self.config.packages_dir
+
+    @property
+    def works_dir(self):
+        return self.config.works_dir
+
+    @property
+    def system_prefix(self):
+        return self.config.system_prefix
+
+    @property
+    def system_targets(self):
+        return self.config.system_targets
 
-        if "stages" in source_properties:
-            stages_properties = source_properties["stages"]
-            for stage_yml in stages_properties:
-                self.stage_ymls.append(stage_yml)
+    @property
+    def system_root(self):
+        return self.config.system_root
 
     @property
     def num_stages(self):
@@ -138,10 +158,11 @@ class Package:
         for stage in self.stages:
             stage.link_source(source_package)
 
-    def make_container(self):
-        if self.podman_container is not None:
-            pass
-        self.podman_container = self.podman_client.containers.run(
+    def make_container(self, state: HJobState):
+        # stages of one package run in the same container
+        if container_running(state.container):
+            return
+        state.container = self.podman_client.containers.run(
             'hbuild:latest',
             stdout=True,
             stderr=True,
@@ -193,21 +214,12 @@ class Package:
                     'mode': 'ro',
                     'extended_mode': [ 'z']
                 },
-            },
+            } | jobserver_volume(),
 
             detach=True,
             tty=True
         )
 
-    def kill_build(self):
-        self.podman_container.kill(signal='SIGKILL')
-
-    def tidy(self):
-        if self.podman_container is not None:
-            self.podman_container.kill(signal='SIGKILL')
-            self.podman_container.remove(force=True)
-            self.podman_container = None
-
     def make_dirs(self):
         os.makedirs(self.work_dir, exist_ok=True)
         os.makedirs(self.package_dir, exist_ok = True)
@@ -226,7 +238,8 @@ class Package:
                 os.rmdir(dent)
                 deleted.add(dent)
 
-    def clean_dirs(self):
+    def remove_unrecorded(self):
+        # installs from before manifests were kept
         pkg_root_dir = self.package_dir
 
         for dent, _, files in os.walk(pkg_root_dir):
@@ -243,97 +256,116 @@ class Package:
 
                     if os.path.lexists(f_system_path):
                         os.unlink(f_system_path)
-                        
+
+        self.prune_system()
+
+    def clean_dirs(self):
+        if not remove_installed(HManifestDB(self.config.manifests_dir), self.name, self.system_root):
+            self.remove_unrecorded()
+
         if os.path.exists(self.build_dir):
             shutil.rmtree(self.build_dir)
         if os.path.exists(self.package_dir):
             shutil.rmtree(self.package_dir)
-        self.prune_system()
     
-    def exec_steps(self, steps: list[Step], stage: Stage | None) -> int | Exception:
+    def exec_steps(self, steps: list[Step], stage: Stage | None, state: HJobState) -> int | Exception:
         return_code: int | Exception = None
-        for step in steps:
-            return_code = step.exec(
-                '/home/hbuild/system_prefix',
-                self.system_targets,
-                '/home/hbuild/source_root',
-                '/home/hbuild/build_root',
+        context = make_context('/home/hbuild/system_prefix',
+                               self.system_targets,
+                               '/home/hbuild/source_root',
+                               '/home/hbuild/build_root',
 
-                '/home/hbuild/source',
-                '/home/hbuild/build',
+                               '/home/hbuild/source',
+                               '/home/hbuild/build',
 
-                '/home/hbuild/package',
-                '/home/hbuild/system_root',
+                               '/home/hbuild/package',
+                               '/home/hbuild/system_root')
+        for step in steps:
+            if state.checkpoint is not None and state.checkpoint.skip():
+                continue
 
-                self.podman_container,
-                self,
-                stage
-            )
+            return_code = step.exec(context, state, self, stage)
 
             if isinstance(return_code, Exception):
                 break
+
+            if state.checkpoint is not None:
+                state.checkpoint.advance()
         
         return return_code
 
-    def configure(self) -> int:
-        return self.exec_steps(self.configure_steps, None)
+    def configure(self, state: HJobState) -> int:
+        return self.exec_steps(self.configure_steps, None, state)
 
-    def build(self, stage: Stage = None) -> int:
+    def build(self, stage: Stage | None, state: HJobState) -> int:
         if stage is None:
-            return self.exec_steps(self.build_steps, None)
+            return self.exec_steps(self.build_steps, None, state)
         else:
-            return self.exec_steps(stage.build_steps, stage)
-
-    def files_size(self):
-        total_size = 0
-        for dent, subdir, files in os.walk(self.package_dir):
-            for _ in subdir:
-                total_size += 1024
-            for file in files:
-                total_size += math.ceil(os.path.getsize(os.path.join(dent, file)) / 1024)
-        
-        return total_size
+            return self.exec_steps(stage.build_steps, stage, state)
+
+    @property
+    def architecture(self):
+        return self.metadata.get("architecture", "amd64")
 
-    def copy_system(self):
-        subprocess.run(['rsync', '-aq', '--exclude=DEBIAN',  f"{self.package_dir}/", f"{self.system_root}"])
+    def scan_files(self) -> HPackageManifest:
+        return scan_package(self.package_dir)
+
+    def copy_system(self, manifest: HPackageManifest | None = None):
+        result = installer().install(self.package_dir, self.system_root, exclude=("DEBIAN",),
+                                     scanned=manifest.install_entries() if manifest is not None else None)
+        report_shared(self.name, HManifestDB(self.config.manifests_dir).record(self.name, self.system_root,
+                                                                                result.entries))
+
+        print(f"Installed {self.name}: {result}")
+        for error in result.errors:
+            print(f"Failed to install {self.name} file {error}")
 
     def format_description(self):
         return f"""Description: {self.metadata["summary"]}
  {self.metadata["description"]}"""
 
-    def make_control(self, deps_dict: dict[str, str]):
+    def make_control(self, deps_dict: dict[str, str], installed_size: int):
         if len(deps_dict) > 0:
             deps: list[str] = [f"{name} (>={version})" for name, version in deps_dict.items()]
 
             return f"""Package: {self.name}
 Version: {self.version}
-Architecture: {self.metadata["architecture"] if "metadata" in self.metadata else "amd64"}
+Architecture: {self.architecture}
 {self.format_description()}
 Section: {self.metadata["section"]}
 Maintainer: {self.metadata["maintainer"]}
 Homepage: {self.metadata["website"]}
-Installed-Size: {self.files_size()}
+Installed-Size: {installed_size}
 Depends: {", ".join(deps)}
 """
         else:
             return f"""Package: {self.name}
 Version: {self.version}
-Architecture: {self.metadata["architecture"] if "metadata" in self.metadata else "amd64"}
+Architecture: {self.architecture}
 {self.format_description()}
 Section: {self.metadata["section"]}
 Maintainer: {self.metadata["maintainer"]}
 Homepage: {self.metadata["website"]}
-Installed-Size: {self.files_size()}
+Installed-Size: {installed_size}
 """
 
-    def make_deb(self, deps_dict: dict[str, str]):
-        control_string = self.make_control(deps_dict)
+    @property
+    def deb_file(self):
+        return Path(self.packages_dir, deb_filename(self.name, self.version, self.architecture)).as_posix()
+
+    def deb_compression(self, default: HDebCompression) -> HDebCompression:
+        return HDebCompression(self.compression.get("method", default.method),
+                               self.compression.get("level", default.level))
+
+    def make_deb(self, deps_dict: dict[str, str], manifest: HPackageManifest | None = None,
+                 compression: HDebCompression | None = None) -> HDebResult:
+        if manifest is None:
+            manifest = self.scan_files()
 
-        os.makedirs(os.path.join(self.package_dir, "DEBIAN"), exist_ok=True)
-        with open(os.path.join(self.package_dir, "DEBIAN", "control"), 'w+') as control_file:
-            control_file.write(control_string)
+        control_string = self.make_control(deps_dict, manifest.installed_size)
 
-        subprocess.run(["dpkg-deb", "--root-owner-group", "--build",self.package_dir, self.packages_dir])
+        os.makedirs(self.packages_dir, exist_ok=True)
+        return build_deb(manifest, control_string, self.deb_file, self.deb_compression(compression or HDebCompression()))
 
     def __str__(self):
         return f"Package {self.name}[{self.version}]"
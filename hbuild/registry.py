@@ -3,20 +3,32 @@ from pathlib import Path
 import toml
 import yaml
 
-from copy import deepcopy
-from .config import HPackageConfig
+from copy import copy
+from .config import HPackageConfig, HPkgsrcFile
 from .source import SourcePackage
 from .step import Step
 from .tool import ToolPackage
 from .package import Package
 from .stage import Stage
+from .snapshot import HRegistrySnapshot
+from .index import HLookupKind, HLookupHandle
 
-import json
-from jsonschema import Draft7Validator
 import os
+import sys
 
 from referencing import Registry
-from referencing.jsonschema import DRAFT7
+
+from .validate import HSchemaValidators, PARALLEL_MIN_FILES, find_pkgsrc_files, validate_pkgsrc_files
+
+class HRegistryChange():
+    def __init__(self, generation: int, paths: set[str], removed: set[str], added: set[str]):
+        self.generation = generation
+        self.paths = paths
+        self.removed = removed
+        self.added = added
+
+    def __str__(self):
+        return f"generation {self.generation}: -{len(self.removed)} +{len(self.added)}"
 
 class HPackageRegistry():
     def __init__(self):
@@ -34,6 +46,7 @@ class HPackageRegistry():
         self.packages_dir = Path(self.config["hbuild"]["packages_dir"]).resolve().as_posix()
         self.builds_dir = Path(self.config["hbuild"]["builds_dir"]).resolve().as_posix()
         self.works_dir = Path(self.config["hbuild"]["works_dir"]).resolve().as_posix()
+        self.manifests_dir = Path(self.config["hbuild"].get("manifests_dir", "manifests")).resolve().as_posix()
 
         self.patches_dir = Path(self.config["hbuild"]["patches_dir"]).resolve().as_posix()
 
@@ -42,258 +55,312 @@ class HPackageRegistry():
 
         self.system_targets = self.config["hbuild"]["system"]["targets"]
 
-        self.file_configs: list[HPackageConfig] = []
+        self.package_config = HPackageConfig(
+            self.logs_dir,
+            self.sources_dir,
+            self.patches_dir,
+            self.system_targets,
+            self.system_prefix,
+            self.system_root,
+            self.tools_dir,
+            self.packages_dir,
+            self.builds_dir,
+            self.works_dir,
+            self.manifests_dir
+        )
+
+        self.pkgsrc_files: list[HPkgsrcFile] = []
 
         self.stages: list[Stage] = []
         self.sources: list[SourcePackage] = []
         self.tools: list[ToolPackage] = []
         self.packages: list[Package] = []
 
-        self.load_pkgsrc_dir()
-        self.load_sources()
-        self.load_tools()
-        self.load_packages()
+        self.index: dict[str, HLookupHandle] = {}
+        self.source_index: dict[str, SourcePackage] = {}
+        self.tool_index: dict[str, ToolPackage] = {}
+        self.package_index: dict[str, Package] = {}
+
+        self.generation = 0
+
+        self.snapshot = HRegistrySnapshot(self.config)
+        if not self.load_snapshot():
+            self.load_pkgsrc_dir()
+            self.load_sources()
+            self.load_tools()
+            self.load_packages()
+
+            self.save_snapshot()
 
     @property
     def stage_names(self):
-        names = []
-        for package in self.packages:
-            stage_names = [f"{package.name}[{k.name}]" for k in package.stages]
-            names = [*names, *stage_names]
-        for tool in self.tools:
-            stage_names = [f"{tool.name}[{k.name}]" for k in tool.stages]
-            names = [*names, *stage_names]
-
-        return names
+        return [name for name, handle in self.index.items() if handle.kind == HLookupKind.STAGE]
 
     @property
     def package_names(self):
-        names = []
-        for package in self.packages:
-            names.append(package.name)
-
-        return names
+        return list(self.package_index)
 
     @property
     def tool_names(self):
-        names = []
-        for tool in self.tools:
-            names.append(tool.name)
-
-        return names
+        return list(self.tool_index)
 
     @property
     def source_names(self):
-        names = []
-        for source in self.sources:
-            names.append(source.name)
-
-        return names
+        return list(self.source_index)
 
     def is_package(self, package):
-        if package in self.package_names:
-            return True
-
-        return False
+        return package in self.package_index
 
     def is_tool(self, tool):
-        if tool in self.tool_names:
-            return True
-
-        return False
+        return tool in self.tool_index
 
     def is_source(self, source):
-        if source in self.source_names:
-            return True
-
-        return False
+        return source in self.source_index
 
     def find_source(self, name):
-        for source in self.sources:
-            if source.name == name:
-                return source
-
-        return None
+        return self.source_index.get(name)
 
     def find_tool(self, name):
-        for tool in self.tools:
-            if tool.name == name:
-                return tool
-
-        return None
+        return self.tool_index.get(name)
 
     def find_package(self, name):
-        for package in self.packages:
-            if package.name == name:
-                return package
-
-        return None
+        return self.package_index.get(name)
+
+    def lookup_handle(self, lookup_name: str) -> HLookupHandle | None:
+        return self.index.get(lookup_name)
+
+    def lookup(self, lookup_name: str) -> Package | ToolPackage | SourcePackage | Stage | None:
+        handle = self.index.get(lookup_name)
+        if handle is None:
+            return None
+
+        return handle.target
+
+    def add_handle(self, lookup_name: str, kind: HLookupKind, target):
+        if lookup_name in self.index:
+            raise ValueError(f"Duplicate lookup name {lookup_name} in package registry")
+
+        self.index[lookup_name] = HLookupHandle(sys.intern(lookup_name), kind, target)
+
+    def add_source(self, source: SourcePackage):
+        self.add_handle(f"source[{source.name}]", HLookupKind.SOURCE, source)
+        self.source_index[source.name] = source
+        self.sources.append(source)
+
+    def add_tool(self, tool: ToolPackage):
+        self.add_handle(tool.name, HLookupKind.TOOL, tool)
+        for stage in tool.stages:
+            self.add_handle(f"{tool.name}[{stage.name}]", HLookupKind.STAGE, stage)
+
+        self.tool_index[tool.name] = tool
+        self.tools.append(tool)
+
+    def add_package(self, package: Package):
+        self.add_handle(package.name, HLookupKind.PACKAGE, package)
+        for stage in package.stages:
+            self.add_handle(f"{package.name}[{stage.name}]", HLookupKind.STAGE, stage)
+
+        self.package_index[package.name] = package
+        self.packages.append(package)
+
+    def build_index(self):
+        sources, tools, packages = self.sources, self.tools, self.packages
+
+        self.index = {}
+        self.source_index = {}
+        self.tool_index = {}
+        self.package_index = {}
+
+        self.sources = []
+        self.tools = []
+        self.packages = []
+
+        for source in sources:
+            self.add_source(source)
+        for tool in tools:
+            self.add_tool(tool)
+        for package in packages:
+            self.add_package(package)
+
+    def load_snapshot(self) -> bool:
+        state = self.snapshot.load()
+        if state is None:
+            return False
+
+        self.package_config = state["package_config"]
+        self.pkgsrc_files = state["pkgsrc_files"]
+        self.stages = state["stages"]
+        self.sources = state["sources"]
+        self.tools = state["tools"]
+        self.packages = state["packages"]
+
+        self.build_index()
+        return True
+
+    def save_snapshot(self):
+        self.snapshot.save({
+            "package_config": self.package_config,
+            "pkgsrc_files": self.pkgsrc_files,
+            "stages": self.stages,
+            "sources": self.sources,
+            "tools": self.tools,
+            "packages": self.packages,
+        })
 
     def load_config(self) -> None:
         with open("config.toml") as f:
             self.config = toml.load(f)
 
-    def load_schema(self, schema_file: str) -> object:
-        with open(schema_file) as f:
-            schema_json = json.load(f)
-            return schema_json["$id"], schema_json
-
     def load_schemas(self) -> None:
-        for dir, _, files in os.walk(self.config["hbuild"]["schema_dir"]):
-            for file in files:
-                schema_path = Path(dir, file).resolve().as_posix()
-                schema_id, schema_json = self.load_schema(schema_path)
-                schema_name = schema_id.split('/')[4]
+        self.validators = HSchemaValidators(self.config["hbuild"]["schema_dir"])
 
-                schema = DRAFT7.create_resource(schema_json)
-
-                self.registry = self.registry.with_resource(schema_id, schema)
-                self.schemas[schema_name] = schema_json
+        self.registry = self.validators.registry
+        self.schemas = self.validators.schemas
 
     def load_pkgsrc(self, pkgsrc_file: str) -> dict[str, str]:
         with open(pkgsrc_file) as f:
             return yaml.load(f, Loader=yaml.CLoader)
 
+    def load_pkgsrc_file(self, pkgsrc_path: str) -> HPkgsrcFile:
+        pkgsrc_yml: dict[str, str] = self.load_pkgsrc(pkgsrc_path)
+        self.validators.validate("pkgsrc", pkgsrc_yml)
+
+        return HPkgsrcFile(pkgsrc_path, pkgsrc_yml)
+
     def load_pkgsrc_dir(self) -> None:
-        for dent, _, files in os.walk(self.config["hbuild"]["pkgsrc_dir"]):
-            for file in files:
-                pkgsrc_path = Path(dent, file).resolve().as_posix()
-                pkgsrc_yml: dict[str, str] = self.load_pkgsrc(pkgsrc_path)
-
-                pkgsrc_validator = Draft7Validator(self.schemas["pkgsrc"], registry=self.registry)
-                pkgsrc_validator.validate(pkgsrc_yml)
-
-                build_config = HPackageConfig(
-                    Path(self.logs_dir),
-                    Path(self.sources_dir),
-                    None,
-                    Path(self.patches_dir),
-                    self.system_targets,
-                    Path(self.system_prefix),
-                    Path(self.system_root),
-                    Path(self.tools_dir),
-                    Path(self.packages_dir),
-                    Path(self.builds_dir),
-                    Path(self.works_dir),
-                    pkgsrc_yml
-                )
-
-                self.file_configs.append(build_config)
+        validate_config = self.config["hbuild"].get("validate", {})
+        results = validate_pkgsrc_files(self.config["hbuild"]["schema_dir"],
+                                        find_pkgsrc_files(self.config["hbuild"]["pkgsrc_dir"]),
+                                        workers=validate_config.get("workers", 0),
+                                        parallel_threshold=validate_config.get("parallel_threshold", PARALLEL_MIN_FILES),
+                                        validators=self.validators)
+
+        for result in results:
+            if result.error is not None:
+                raise ValueError(f"Invalid pkgsrc file {result.path}: {result.error}")
+
+            self.pkgsrc_files.append(HPkgsrcFile(result.path, result.pkgsrc_yml))
+
+    def check_deps(self):
+        for name, handle in self.index.items():
+            for dep in handle.target.deps():
+                if dep not in self.index:
+                    raise ValueError(f"Unable to resolve dependency {name} -> {dep}")
+
+    def pkgsrc_paths(self, names: list[str]) -> list[str]:
+        return [Path(self.config["hbuild"]["pkgsrc_dir"], name).resolve().as_posix() for name in names]
+
+    def pkgsrc_names(self, paths: list[str]) -> list[str]:
+        pkgsrc_dir = Path(self.config["hbuild"]["pkgsrc_dir"]).resolve()
+        return [Path(path).relative_to(pkgsrc_dir).as_posix() for path in paths]
+
+    def reload_pkgsrc_files(self, paths: list[str], generation: int | None = None) -> HRegistryChange:
+        paths = {Path(path).resolve().as_posix() for path in paths}
+
+        # the new state is built on a staged copy and swapped in at the end,
+        # so a broken recipe leaves the registry untouched and readers never
+        # see a half-loaded index
+        new_files = [self.load_pkgsrc_file(path) for path in sorted(paths) if os.path.isfile(path)]
+
+        staged = copy(self)
+        staged.pkgsrc_files = [f for f in self.pkgsrc_files if f.path not in paths] + new_files
+        staged.stages = [s for s in self.stages if s.pkgsrc_path not in paths]
+        staged.sources = [s for s in self.sources if s.pkgsrc_path not in paths]
+        staged.tools = [t for t in self.tools if t.pkgsrc_path not in paths]
+        staged.packages = [p for p in self.packages if p.pkgsrc_path not in paths]
+        staged.build_index()
+
+        staged.load_sources(new_files)
+        staged.load_tools(new_files)
+        staged.load_packages(new_files)
+        staged.check_deps()
+
+        relinks = []
+        for package in staged.tools + staged.packages:
+            source = staged.find_source(package.source_name)
+            if source is None:
+                raise ValueError(f"Could not find source {package.source_name} for package {package.name}")
+            relinks.append((package, source))
+
+        for package, source in relinks:
+            package.source_dir = source.source_dir
+
+        removed = {name for name, handle in self.index.items() if handle.target.pkgsrc_path in paths}
+        added = {name for name, handle in staged.index.items() if handle.target.pkgsrc_path in paths}
+
+        staged.generation = self.generation + 1 if generation is None else generation
+        staged.snapshot = HRegistrySnapshot(self.config)
+        staged.save_snapshot()
+
+        self.__dict__.update(staged.__dict__)
+        return HRegistryChange(self.generation, paths, removed, added)
 
     def load_steps(self, package: Package | ToolPackage | SourcePackage | Stage):
-        if isinstance(package, SourcePackage):
-            for step_yml in package.regenerate_ymls:
-                final_config = deepcopy(package.config)
-                final_config.pkgsrc_yml = step_yml
+        step_properties = package.pkgsrc_yml
 
-                package.regenerate_steps.append(Step(final_config, package.name))
+        if isinstance(package, SourcePackage):
+            for step_yml in step_properties.get("regenerate", []):
+                package.regenerate_steps.append(Step.from_yml(step_yml, package.name))
         if isinstance(package, ToolPackage):
-            for step_yml in package.configure_ymls:
-                final_config = deepcopy(package.config)
-                final_config.pkgsrc_yml = step_yml
-
-                package.configure_steps.append(Step(final_config, package.name))
-            for step_yml in package.compile_ymls:
-                final_config = deepcopy(package.config)
-                final_config.pkgsrc_yml = step_yml
-
-                package.compile_steps.append(Step(final_config, package.name))
-            for step_yml in package.install_ymls:
-                final_config = deepcopy(package.config)
-                final_config.pkgsrc_yml = step_yml
-
-                package.install_steps.append(Step(final_config, package.name))
+            for step_yml in step_properties.get("configure", []):
+                package.configure_steps.append(Step.from_yml(step_yml, package.name))
+            for step_yml in step_properties.get("compile", []):
+                package.compile_steps.append(Step.from_yml(step_yml, package.name))
+            for step_yml in step_properties.get("install", []):
+                package.install_steps.append(Step.from_yml(step_yml, package.name))
         if isinstance(package, Package):
-            for step_yml in package.configure_ymls:
-                final_config = deepcopy(package.config)
-                final_config.pkgsrc_yml = step_yml
-
-                package.configure_steps.append(Step(final_config, package.name))
-            for step_yml in package.build_ymls:
-                final_config = deepcopy(package.config)
-                final_config.pkgsrc_yml = step_yml
-
-                package.build_steps.append(Step(final_config, package.name))
+            for step_yml in step_properties.get("configure", []):
+                package.configure_steps.append(Step.from_yml(step_yml, package.name))
+            for step_yml in step_properties.get("build", []):
+                package.build_steps.append(Step.from_yml(step_yml, package.name))
         if isinstance(package, Stage):
-            for step_yml in package.compile_ymls:
-                final_config = deepcopy(package.config)
-                final_config.pkgsrc_yml = step_yml
-
-                package.compile_steps.append(Step(final_config, package.name))
-            for step_yml in package.build_ymls:
-                final_config = deepcopy(package.config)
-                final_config.pkgsrc_yml = step_yml
-
-                package.build_steps.append(Step(final_config, package.name))
-            for step_yml in package.install_ymls:
-                final_config = deepcopy(package.config)
-                final_config.pkgsrc_yml = step_yml
-
-                package.install_steps.append(Step(final_config, package.name))
+            for step_yml in step_properties.get("compile", []):
+                package.compile_steps.append(Step.from_yml(step_yml, package.name))
+            for step_yml in step_properties.get("build", []):
+                package.build_steps.append(Step.from_yml(step_yml, package.name))
+            for step_yml in step_properties.get("install", []):
+                package.install_steps.append(Step.from_yml(step_yml, package.name))
 
     def load_stages(self, package: ToolPackage | Package):
         if isinstance(package, ToolPackage):
-            for stage_yml in package.stage_ymls:
-                final_config = deepcopy(package.config)
-                final_config.pkgsrc_yml = stage_yml
-
-                stage = Stage(final_config, package, package.name)
+            for stage_yml in package.pkgsrc_yml.get("stages", []):
+                stage = Stage(self.package_config, stage_yml, package, package.name)
                 self.load_steps(stage)
 
                 package.stages.append(stage)
                 self.stages.append(stage)
 
-    def load_sources(self):
-        for build_config in self.file_configs:
-            if "source" in build_config.pkgsrc_yml:
-                final_config = deepcopy(build_config)
-                final_config.pkgsrc_yml = build_config.pkgsrc_yml["source"]
-
-                source_validator = Draft7Validator(self.schemas["source"], registry=self.registry)
-                source_validator.validate(build_config.pkgsrc_yml["source"])
-
-                source_package = SourcePackage(final_config)
+    def load_sources(self, pkgsrc_files: list[HPkgsrcFile] | None = None):
+        for pkgsrc_file in self.pkgsrc_files if pkgsrc_files is None else pkgsrc_files:
+            if "source" in pkgsrc_file.pkgsrc_yml:
+                source_package = SourcePackage(self.package_config, pkgsrc_file.pkgsrc_yml["source"], pkgsrc_file.path)
                 self.load_steps(source_package)
-                self.sources.append(source_package)
-
-    def load_tools(self):
-        for build_config in self.file_configs:
-            if "tools" in build_config.pkgsrc_yml:
-                for tool_yml in build_config.pkgsrc_yml["tools"]:
-                    final_config = deepcopy(build_config)
-                    final_config.pkgsrc_yml = tool_yml
+                self.add_source(source_package)
 
+    def load_tools(self, pkgsrc_files: list[HPkgsrcFile] | None = None):
+        for pkgsrc_file in self.pkgsrc_files if pkgsrc_files is None else pkgsrc_files:
+            if "tools" in pkgsrc_file.pkgsrc_yml:
+                for tool_yml in pkgsrc_file.pkgsrc_yml["tools"]:
                     source_name = tool_yml["from_source"]
                     source = self.find_source(source_name)
                     if source is None:
                         raise ValueError(f"Could not find source {source_name} for tool package {tool_yml['name']}")
-                    final_config.source_dir = source.source_dir
-
-                    tool_validator = Draft7Validator(self.schemas["tool"], registry=self.registry)
-                    tool_validator.validate(tool_yml)
 
-                    tool_package = ToolPackage(final_config)
+                    tool_package = ToolPackage(self.package_config, tool_yml, pkgsrc_file.path, source.source_dir)
                     self.load_steps(tool_package)
                     self.load_stages(tool_package)
-                    self.tools.append(tool_package)
-
-    def load_packages(self):
-        for build_config in self.file_configs:
-            if "packages" in build_config.pkgsrc_yml:
-                for package_yml in build_config.pkgsrc_yml["packages"]:
-                    final_config = deepcopy(build_config)
-                    final_config.pkgsrc_yml = package_yml
+                    self.add_tool(tool_package)
 
+    def load_packages(self, pkgsrc_files: list[HPkgsrcFile] | None = None):
+        for pkgsrc_file in self.pkgsrc_files if pkgsrc_files is None else pkgsrc_files:
+            if "packages" in pkgsrc_file.pkgsrc_yml:
+                for package_yml in pkgsrc_file.pkgsrc_yml["packages"]:
                     source_name = package_yml["from_source"]
                     source = self.find_source(source_name)
                     if source is None:
                         raise ValueError(f"Could not find source {source_name} for system package {package_yml['name']}")
-                    final_config.source_dir = source.source_dir
-
-                    package_validator = Draft7Validator(self.schemas["package"], registry=self.registry)
-                    package_validator.validate(package_yml)
 
-                    package = Package(final_config)
+                    package = Package(self.package_config, package_yml, pkgsrc_file.path, source.source_dir)
                     self.load_steps(package)
                     self.load_stages(package)
-                    self.packages.append(package)
\ No newline at end of file
+                    self.add_package(package)
@@ -1,28 +1,46 @@
-import queue
-import random
-import re
+import hashlib
+import json
+import os
+import socket
 import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
 from queue import Queue
-from threading import Thread
+from threading import Lock, Thread
 
 import kombu
 import pymysql
-from kombu import Exchange, Connection
-
+from kombu import Exchange, Connection, Producer
+from podman.domain.containers import Container as PodmanContainer
+
+from hbuild.apt import HAptRepository
+from hbuild.cache import HBuildCache, HRemoteCache, configure_hash, node_inputs, output_dirs, source_revision
+from hbuild.checkpoint import HCheckpoint
+from hbuild.containers import DEFAULT_MAX_POOL_SIZE, configure_podman
+from hbuild.deb import DEFAULT_COMPRESSION, DEFAULT_COMPRESSION_LEVEL, DEFAULT_PACK_WORKERS, HDebCompression, \
+    HDebPackager
+from hbuild.install import DEFAULT_INSTALL_WORKERS, configure_installer
+from hbuild.jobserver import configure_jobserver
+from hbuild.jobstate import HJobState
+from hbuild.logs import DEFAULT_MAX_PENDING, DEFAULT_PUBLISH_BYTES, DEFAULT_PUBLISH_LATENCY, DEFAULT_SAMPLE_INTERVAL, \
+    DEFAULT_TAIL_LINES, configure_log_publisher
 from hbuild.registry import HPackageRegistry
-
-import pika as mq
-
 from hbuild.source import SourcePackage
+from hbuild.spool import DEFAULT_FRAME_BYTES, DEFAULT_KEEP_BUILDS, HLogSpool, prune_spool, read_bytes, read_lines
 from hbuild.sql import HBuildLog
 from hbuild.stage import Stage
+from hbuild.template import CPU_COUNT
 from hbuild.tool import ToolPackage
 from hbuild.package import Package
 
-import os
-
 from hbuild.worker import RobustWorker
 
+DEFAULT_SLOTS = 1
+DEFAULT_SESSIONS = 2
+DEFAULT_HEARTBEAT_INTERVAL = 10.0
+
+CONFIGURE_MARKER = ".hbuild-configured"
 
 def format_lookup_name(package: SourcePackage | ToolPackage | Package | Stage) -> str:
     if isinstance(package, SourcePackage):
@@ -33,89 +51,426 @@ def format_lookup_name(package: SourcePackage | ToolPackage | Package | Stage) -
         return package.name
 
 class HBuildJob():
-    def __init__(self, requested_packages: list[Package | ToolPackage | SourcePackage | Stage]):
-        self.requested_packages = requested_packages
+    def __init__(self, job_id: str, lookup_name: str, package: Package | ToolPackage | SourcePackage | Stage,
+                 dep_hashes: dict[str, str | None], resume: bool):
+        self.job_id = job_id
+        self.lookup_name = lookup_name
+        self.package = package
+        self.dep_hashes = dep_hashes
+        self.resume = resume
+        self.history_id: int | None = None
+        self.state: HJobState | None = None
+        # restored from the cache or already up to date, not built here
+        self.cached = False
 
 class HBuildRunner():
     def __init__(self):
         self.registry = HPackageRegistry()
+        configure_podman(self.registry.config["hbuild"].get("podman", {}).get("max_pool_size", DEFAULT_MAX_POOL_SIZE))
+
+        install_config = self.registry.config["hbuild"].get("install", {})
+        configure_installer(workers=install_config.get("workers", DEFAULT_INSTALL_WORKERS),
+                            link=install_config.get("link", True))
+
+        # .debs are written by other processes while the slots build on
+        deb_config = self.registry.config["hbuild"].get("deb", {})
+        self.deb_compression = HDebCompression(deb_config.get("compression", DEFAULT_COMPRESSION),
+                                               deb_config.get("level", DEFAULT_COMPRESSION_LEVEL))
+        self.packager = HDebPackager(deb_config.get("workers", DEFAULT_PACK_WORKERS))
+        self.packaging: dict[str, Future] = {}
+
+        # every new .deb goes straight into the index of packages_dir
+        apt_config = self.registry.config["hbuild"].get("apt", {})
+        if apt_config.get("enabled", True):
+            self.apt = HAptRepository(Path(self.registry.config["hbuild"]["packages_dir"]).resolve().as_posix(),
+                                      apt_config.get("origin", "hbuild"), apt_config.get("label", "hbuild"))
+        else:
+            self.apt = None
+
+        cache_config = self.registry.config["hbuild"].get("cache", {})
+        if cache_config.get("enabled", True):
+            remote = HRemoteCache(cache_config["remote_url"]) if cache_config.get("remote_url") else None
+            self.cache = HBuildCache(self.registry.config["hbuild"]["cache_dir"], remote)
+        else:
+            self.cache = None
+
         self.queue = Queue()
-        self.name = f"runner-{random.randint(0, 1000)}"
+        self.name = f"runner-{socket.gethostname()}-{os.getpid()}"
+
+        # the dispatcher hands out one node per free slot
+        runner_config = self.registry.config["hbuild"].get("runner", {})
+        self.slots = max(1, runner_config.get("slots", DEFAULT_SLOTS))
+        self.assigned = 0
+        self.assigned_lock = Lock()
+
+        # stages of one package share its directories
+        self.package_locks: dict[str, Lock] = {}
+
+        # containers kept running for the next stage of their package
+        self.sessions: OrderedDict[str, PodmanContainer] = OrderedDict()
+        self.max_sessions = runner_config.get("sessions", DEFAULT_SESSIONS)
+
+        self.jobserver = configure_jobserver(Path(self.registry.config["hbuild"]["cache_dir"], "jobserver",
+                                                  f"{self.name}.fifo").resolve().as_posix(),
+                                             runner_config.get("jobs", 0) or CPU_COUNT, self.slots)
 
         self.rabbit_url = "amqp://mq:mq@localhost:5672"
 
-        self.sql_conn = pymysql.connect(host='localhost',
-                                     user='root',
-                                     password='sql',
-                                     database='sql',
-                                     cursorclass=pymysql.cursors.DictCursor)
+        logs_config = self.registry.config["hbuild"].get("logs", {})
+        configure_log_publisher(rabbit_url=self.rabbit_url,
+                                spool_file=Path(self.registry.config["hbuild"]["cache_dir"], "log-spool",
+                                                f"{self.name}.jsonl").resolve().as_posix(),
+                                max_bytes=logs_config.get("publish_bytes", DEFAULT_PUBLISH_BYTES),
+                                max_latency=logs_config.get("publish_latency", DEFAULT_PUBLISH_LATENCY),
+                                max_pending=logs_config.get("max_pending", DEFAULT_MAX_PENDING),
+                                sample_interval=logs_config.get("sample_interval", DEFAULT_SAMPLE_INTERVAL),
+                                tail_lines=logs_config.get("tail_lines", DEFAULT_TAIL_LINES))
+
+        # full build output stays here, one compressed file per build
+        self.spool_dir = Path(self.registry.config["hbuild"]["cache_dir"], "build-logs").resolve().as_posix()
+        self.spool_frame_bytes = logs_config.get("spool_frame_bytes", DEFAULT_FRAME_BYTES)
+        self.spool_keep = logs_config.get("spool_keep", DEFAULT_KEEP_BUILDS)
+
+        self.heartbeat_interval = runner_config.get("heartbeat_interval", DEFAULT_HEARTBEAT_INTERVAL)
 
-        self.thread = Thread(target = self.execute_jobs)
-        self.thread.start()
+        self.threads = [Thread(target = self.execute_jobs) for _ in range(self.slots)]
+        self.threads.append(Thread(target = self.heartbeat, daemon=True))
+        for thread in self.threads:
+            thread.start()
 
         exchange = Exchange("hbuild-exchange", type="direct")
-        queues: list[kombu.Queue] = [kombu.Queue("runners", exchange, routing_key="runners")]
+        reload_exchange = Exchange("hbuild-reload", type="fanout")
+        runners_exchange = Exchange("hbuild-runners", type="fanout")
+        queues: list[kombu.Queue] = [kombu.Queue(self.name, exchange, routing_key=self.name, exclusive=True),
+                                     kombu.Queue(exchange=reload_exchange, exclusive=True),
+                                     kombu.Queue(exchange=runners_exchange, exclusive=True)]
         with Connection(self.rabbit_url) as conn:
-            worker = RobustWorker(conn, queues, self.consume)
+            worker = RobustWorker(conn, queues, self.consume, on_ready_callback=self.announce)
             worker.run()
 
+    def publish(self, messages: list[str]):
+        exchange = Exchange("hbuild-exchange", type="direct")
+        with Connection(self.rabbit_url) as conn:
+            with conn.channel() as channel:
+                producer = Producer(channel)
+                for message in messages:
+                    producer.publish(message,
+                                     exchange=exchange,
+                                     routing_key="dispatch",
+                                     declare=[exchange])
+
+    def ready_message(self) -> str:
+        # absolute counts, the dispatcher can hear this any number of times
+        with self.assigned_lock:
+            return f"ready:{self.name}:{self.slots}:{self.assigned}"
+
+    def announce(self):
+        self.publish([self.ready_message()])
+
+    def heartbeat(self):
+        # a runner that stops sending these is dropped and its nodes requeued
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.announce()
+            except Exception as e:
+                print(f"Failed to send heartbeat: {e}")
+
     def lookup(self, name: str) -> Package | ToolPackage | SourcePackage | Stage | None:
-        if (matches := re.match('source\\[(.+)]', name)) is not None:
-            name = matches.group(1)
-            source_try = self.registry.find_source(name)
-            if source_try is not None:
-                return source_try
-            else:
-                raise Exception(f"Unknown source name: {name}, sent to runner (accident?)")
-        elif (source_try := self.registry.find_tool(name)) is not None:
-            return source_try
-        elif (source_try := self.registry.find_package(name)) is not None:
-            return source_try
-        elif (matches := re.match('(.+)\\[(.+)]', name)) is not None:
-            parent = self.lookup(matches.group(1))
-            return parent.find_stage(matches.group(2))
-        else:
+        package = self.registry.lookup(name)
+        if package is None:
             raise Exception(f"Unknown package name: {name}, sent to runner (accident?)")
 
+        return package
+
     def consume(self, raw_body, message):
         body = raw_body
         objects = body.split(":")
         operation =  objects[0]
         if operation == "execute":
-            requested_packages = objects[1].split(",")
-            resolved_packages = [self.lookup(name) for name in requested_packages]
+            _, job_id, lookup_name, mode, dep_hashes = body.split(":", maxsplit=4)
 
-            self.queue.put(HBuildJob(resolved_packages))
+            try:
+                package = self.lookup(lookup_name)
+            except Exception as e:
+                print(e)
+                self.publish([f"result:{self.name}:{job_id}:{lookup_name}:failure:0:built:"])
+                return
+
+            with self.assigned_lock:
+                self.assigned += 1
+            self.queue.put(HBuildJob(job_id, lookup_name, package, json.loads(dep_hashes), mode == "resume"))
+        elif operation == "announce":
+            self.announce()
+        elif operation == "spool":
+            _, history_id, unit, start, end = body.split(":", maxsplit=4)
+            result = self.read_spool(int(history_id), unit, int(start), int(end))
+
+            with Connection(self.rabbit_url) as conn:
+                with conn.channel() as channel:
+                    producer = Producer(channel)
+                    producer.publish(f"result_spool:{json.dumps(result)}",
+                                     routing_key=message.properties["reply_to"])
+        elif operation == "reload":
+            _, generation, pkgsrc_names = body.split(":", maxsplit=2)
+            self.reload(int(generation), json.loads(pkgsrc_names))
+
+    def read_spool(self, history_id: int, unit: str, start: int, end: int) -> dict:
+        spool_file = os.path.join(self.spool_dir, f"{history_id}.log.z")
+        if not os.path.exists(spool_file):
+            return {"error": f"No spooled log for build {history_id} on {self.name}"}
+
+        if unit == "bytes":
+            return read_bytes(spool_file, start, end)
+        elif unit == "lines":
+            return read_lines(spool_file, start, end)
+
+        return {"error": f"Unknown log range unit {unit}"}
+
+    def reload(self, generation: int, pkgsrc_names: list[str]):
+        try:
+            change = self.registry.reload_pkgsrc_files(self.registry.pkgsrc_paths(pkgsrc_names), generation)
+        except Exception as e:
+            print(f"Rejected pkgsrc reload of {', '.join(pkgsrc_names)}: {e}")
+            return
+
+        print(f"Reloaded package registry, {change}")
+
+    def package_lock(self, package: Package | ToolPackage | SourcePackage) -> Lock:
+        with self.assigned_lock:
+            return self.package_locks.setdefault(format_lookup_name(package), Lock())
+
+    def take_session(self, package: Package | ToolPackage | SourcePackage) -> PodmanContainer | None:
+        with self.assigned_lock:
+            return self.sessions.pop(format_lookup_name(package), None)
+
+    def keep_session(self, package: Package | ToolPackage, container: PodmanContainer | None):
+        if container is None:
+            return
+        with self.assigned_lock:
+            self.sessions[format_lookup_name(package)] = container
+
+    def trim_sessions(self):
+        while True:
+            with self.assigned_lock:
+                if len(self.sessions) <= self.max_sessions:
+                    return
+                name, container = self.sessions.popitem(last=False)
+
+            # a build takes its container out of the sessions, nothing else
+            # holds this one
+            HJobState(container).tidy()
+
+    def connect_sql(self) -> pymysql.Connection:
+        return pymysql.connect(host='localhost',
+                               user='root',
+                               password='sql',
+                               database='sql',
+                               cursorclass=pymysql.cursors.DictCursor)
 
     def execute_jobs(self):
+        # pymysql connections are not thread safe, one per slot
+        sql_conn: pymysql.Connection | None = None
+
         print("HBuild Runner ready for jobs")
         while True:
+            next_job: HBuildJob = self.queue.get()
+
+            output_hash = None
+            duration = 0.0
             try:
-                next_job: HBuildJob = self.queue.get()
-                HBuildLog.insert_history(self.sql_conn, self.name, [format_lookup_name(p) for p in next_job.requested_packages])
-                for resolved_package in next_job.requested_packages:
-                    if isinstance(resolved_package, Stage):
-                        self.build_package(resolved_package.package, resolved_package.name)
-                    else:
-                        self.build_package(resolved_package, None)
-            except queue.Empty:
-                pass
-            time.sleep(1)
+                # the server drops idle connections, a slot can wait for hours
+                if sql_conn is None:
+                    sql_conn = self.connect_sql()
+                else:
+                    sql_conn.ping(reconnect=True)
+
+                output_hash, duration = self.execute_job(next_job, sql_conn)
+            except Exception as e:
+                print(f"Failed to run {next_job.lookup_name}: {e}")
+            finally:
+                with self.assigned_lock:
+                    self.assigned -= 1
+                    # tokens held by a make that died are gone for good, top
+                    # the pipe back up whenever nothing is building
+                    if self.assigned == 0:
+                        self.jobserver.refill()
+
+                # without a result the dispatcher keeps the node running for good
+                status = "success" if output_hash is not None else "failure"
+                origin = "cached" if next_job.cached else "built"
+                try:
+                    self.publish([f"result:{self.name}:{next_job.job_id}:{next_job.lookup_name}:{status}:{duration:.3f}:{origin}:{output_hash or ''}",
+                                  self.ready_message()])
+                except Exception as e:
+                    print(f"Failed to report {next_job.lookup_name}: {e}")
+
+    def execute_job(self, job: HBuildJob, sql_conn: pymysql.Connection) -> tuple[str | None, float]:
+        history_id = HBuildLog.insert_history(sql_conn, self.name, [job.lookup_name])
+        job.history_id = history_id
+
+        package = job.package.package if isinstance(job.package, Stage) else job.package
+        with self.package_lock(package):
+            self.wait_packaging(package)
+
+            state = HJobState(self.take_session(package))
+            job.state = state
+            try:
+                state.log_spool = HLogSpool(os.path.join(self.spool_dir, f"{history_id}.log.z"),
+                                            self.spool_frame_bytes)
+
+                start = time.monotonic()
+                try:
+                    output_hash = self.build_node(job)
+                except Exception as e:
+                    print(f"Failed to build {job.lookup_name}: {e}")
+                    output_hash = None
+                duration = time.monotonic() - start
+            finally:
+                if state.log_spool is not None:
+                    state.log_spool.close()
+                    state.log_spool = None
+
+                if isinstance(job.package, Stage):
+                    self.keep_session(package, state.container)
+                else:
+                    state.tidy()
+
+        # the node is built by now, losing its statistics does not undo that
+        try:
+            self.trim_sessions()
+            prune_spool(self.spool_dir, self.spool_keep)
+
+            if len(state.step_stats) > 0:
+                HBuildLog.insert_step_stats(sql_conn, [stats.as_row(history_id) for stats in state.step_stats])
+        except Exception as e:
+            print(f"Failed to record {job.lookup_name}: {e}")
+
+        return output_hash, duration
+
+    def resolve_dep_hashes(self, job: HBuildJob) -> dict[str, str] | None:
+        dep_hashes = {}
+        for dep, dep_hash in job.dep_hashes.items():
+            if dep_hash is None:
+                state = self.cache.node_state(dep)
+                if state is None:
+                    return None
+                dep_hash = state["output_hash"]
+
+            dep_hashes[dep] = dep_hash
+
+        return dep_hashes
+
+    # returns the output hash of the node, "" when it cannot be cached, or
+    # None when the build failed
+    def build_node(self, job: HBuildJob) -> str | None:
+        node = job.package
+        package, stage_name = (node.package, node.name) if isinstance(node, Stage) else (node, None)
+
+        if self.cache is None:
+            return "" if self.build_checkpointed(job, package, stage_name, None, job.dep_hashes) is not None else None
+
+        dep_hashes = self.resolve_dep_hashes(job)
+
+        # sources are not archived, their contents follow from the inputs
+        if isinstance(node, SourcePackage):
+            return self.build_source_node(job, dep_hashes)
+
+        input_hash = self.cache.input_hash(job.lookup_name, node, dep_hashes) if dep_hashes is not None else None
+        roots = output_dirs(node)
+        entry = self.cache.lookup(input_hash) if input_hash is not None else None
+        if entry is not None:
+            print(f"Restoring {job.lookup_name} from cache ({input_hash[:12]})")
+            self.make_dir(package)
+            self.cache.restore(entry, roots)
+            self.finish_restore(package, job)
+
+            self.cache.record_node(job.lookup_name, input_hash, entry.output_hash)
+            job.cached = True
+            return entry.output_hash
+
+        if self.build_checkpointed(job, package, stage_name, input_hash, dep_hashes or {}) is None:
+            return None
+        if input_hash is None:
+            return ""
+
+        entry = self.cache.store(input_hash, job.lookup_name, roots)
+        self.cache.record_node(job.lookup_name, input_hash, entry.output_hash)
+        return entry.output_hash
+
+    def build_source_node(self, job: HBuildJob, dep_hashes: dict[str, str] | None) -> str | None:
+        node: SourcePackage = job.package
+        state = self.cache.node_state(job.lookup_name)
+        populated = os.path.isdir(node.source_dir) and len(os.listdir(node.source_dir)) > 0
+
+        revision = source_revision(node, False) if dep_hashes is not None else None
+        input_hash = self.cache.input_hash(job.lookup_name, node, dep_hashes, revision) \
+            if revision is not None else None
+        if input_hash is not None and state is not None and state["input_hash"] == input_hash and populated:
+            print(f"Source {job.lookup_name} is up to date ({input_hash[:12]})")
+            job.cached = True
+            return input_hash
+
+        # a clone does not go over an old checkout
+        if populated:
+            self.clean_package(node)
+
+        if self.build_package(node, job.state, None) is None:
+            return None
+
+        # what was actually fetched, the branch may have moved since
+        revision = source_revision(node, True) if dep_hashes is not None else None
+        if revision is None:
+            return ""
+
+        input_hash = self.cache.input_hash(job.lookup_name, node, dep_hashes, revision)
+        self.cache.record_node(job.lookup_name, input_hash, input_hash)
+        return input_hash
+
+    def build_checkpointed(self, job: HBuildJob, package: Package | ToolPackage, stage_name: str | None,
+                           input_hash: str | None, dep_hashes: dict[str, str | None]):
+        # without a cache key the recipe alone decides whether old progress applies
+        key = input_hash or hashlib.sha256(json.dumps(node_inputs(job.package), sort_keys=True).encode()).hexdigest()
+        roots = list(dict.fromkeys([*output_dirs(job.package).values(), package.build_dir]))
+
+        job.state.checkpoint = HCheckpoint(Path(self.registry.config["hbuild"]["cache_dir"], "checkpoints",
+                                              f"{job.lookup_name}.json").resolve().as_posix(),
+                                         key, roots, job.resume)
+        configure_key = configure_hash(package, dep_hashes) if stage_name is not None else None
+
+        values = None
+        try:
+            values = self.build_package(package, job.state, stage_name, configure_key, job)
+        finally:
+            if values is None:
+                job.state.checkpoint.fail()
+            else:
+                job.state.checkpoint.finish()
+            job.state.checkpoint = None
+
+        return values
+
+    def finish_restore(self, package: Package | ToolPackage, job: HBuildJob):
+        if isinstance(package, ToolPackage):
+            package.copy_tool()
+            os.sync()
+        else:
+            self.build_deb(package, job)
 
     def make_dir(self, package: Package | ToolPackage | SourcePackage):
         package.make_dirs()
 
-    def make_container(self, package: Package | ToolPackage | SourcePackage):
-        package.make_container()
+    def make_container(self, package: Package | ToolPackage | SourcePackage, state: HJobState):
+        package.make_container(state)
 
-    def build_source(self, package: SourcePackage):
-        prepare_resp = package.prepare()
+    def build_source(self, package: SourcePackage, state: HJobState):
+        prepare_resp = package.prepare(state)
         if isinstance(prepare_resp, Exception):
             print(f"Failed to prepare source {package.name}, exit message: {prepare_resp}")
             return
         os.sync()
 
-        regenerate_resp = package.regenerate()
+        regenerate_resp = package.regenerate(state)
         if isinstance(regenerate_resp, Exception):
             print(f"Failed to regenerate source {package.name}, exit message: {regenerate_resp}")
             return
@@ -123,10 +478,31 @@ class HBuildRunner():
 
         return prepare_resp, regenerate_resp
 
-    def build_tool(self, package: ToolPackage, stage_name: str):
+    def configure_package(self, package: Package | ToolPackage, state: HJobState, configure_key: str | None):
+        marker_file = os.path.join(package.build_dir, CONFIGURE_MARKER)
+        if configure_key is not None and os.path.exists(marker_file):
+            with open(marker_file) as f:
+                if f.read().strip() == configure_key:
+                    print(f"{package.name} is already configured ({configure_key[:12]})")
+                    if state.checkpoint is not None:
+                        state.checkpoint.pass_steps(len(package.configure_steps))
+                    return 0
+
+        # a configure that dies halfway leaves a tree nobody should trust
+        if os.path.exists(marker_file):
+            os.unlink(marker_file)
+
+        configure_resp = package.configure(state)
+        if configure_key is not None and not isinstance(configure_resp, Exception):
+            with open(marker_file, 'w') as f:
+                f.write(configure_key)
+
+        return configure_resp
+
+    def build_tool(self, package: ToolPackage, state: HJobState, stage_name: str, configure_key: str | None = None):
         stage = package.find_stage(stage_name)
 
-        configure_resp = package.configure()
+        configure_resp = self.configure_package(package, state, configure_key)
         if isinstance(configure_resp, Exception):
             print(f"Failed to configure {package.name}, exit message: {configure_resp}")
             return
@@ -134,14 +510,14 @@ class HBuildRunner():
         os.sync()
 
         if stage is not None:
-            compile_resp = package.compile(stage)
+            compile_resp = package.compile(stage, state)
             if isinstance(compile_resp, Exception):
                 print(f"Failed to build {package.name}[{stage.name}], exit message: {compile_resp}")
                 return
 
             os.sync()
 
-            install_resp = package.install(stage)
+            install_resp = package.install(stage, state)
             if isinstance(install_resp, Exception):
                 print(f"Failed to install {package.name}[{stage.name}], exit message: {install_resp}")
                 return
@@ -153,13 +529,13 @@ class HBuildRunner():
 
             return configure_resp, compile_resp, install_resp
         else:
-            compile_resp = package.compile(None)
+            compile_resp = package.compile(None, state)
             if isinstance(compile_resp, Exception):
                 print(f"Failed to build {package.name}, exit message: {compile_resp}")
                 return
 
             os.sync()
-            install_resp = package.install(None)
+            install_resp = package.install(None, state)
             if isinstance(install_resp, Exception):
                 print(f"Failed to install {package.name}, exit message: {install_resp}")
                 return
@@ -171,17 +547,17 @@ class HBuildRunner():
 
             return configure_resp, compile_resp, install_resp
 
-    def build_system(self, package: Package, stage_name: str):
+    def build_system(self, package: Package, state: HJobState, stage_name: str, configure_key: str | None = None):
         stage = package.find_stage(stage_name)
 
-        configure_resp = package.configure()
+        configure_resp = self.configure_package(package, state, configure_key)
         if isinstance(configure_resp, Exception):
             print(f"Failed to configure {package.name}, exit message: {configure_resp}")
             return
 
         os.sync()
         if stage is not None:
-            build_resp = package.build(stage)
+            build_resp = package.build(stage, state)
             if isinstance(build_resp, Exception):
                 print(f"Failed to build {package.name}[{stage.name}], exit code: {build_resp}")
                 return
@@ -190,7 +566,7 @@ class HBuildRunner():
 
             return configure_resp, build_resp
         else:
-            build_resp = package.build(None)
+            build_resp = package.build(None, state)
             if isinstance(build_resp, Exception):
                 print(f"Failed to build {package.name}, exit code: {build_resp}")
                 return
@@ -199,58 +575,112 @@ class HBuildRunner():
 
             return configure_resp, build_resp
 
-    def build_deb(self, package: Package):
-        package.copy_system()
-        os.sync()
+    def build_deb(self, package: Package, job: HBuildJob | None = None):
+        # one walk of the tree feeds the install, the control file and the .deb
+        manifest = package.scan_files()
 
-        package.make_deb({dep: self.lookup(dep).version for dep in package.pkg_deps()})
+        package.copy_system(manifest)
         os.sync()
 
-    def build_package(self, package: Package | ToolPackage | SourcePackage, stage_name: str):
+        control = package.make_control({dep: self.lookup(dep).version for dep in package.pkg_deps()},
+                                       manifest.installed_size)
+
+        # dependents only need the system root, the .deb is written while
+        # the next build runs
+        compression = package.deb_compression(self.deb_compression)
+        history_id = job.history_id if job is not None else None
+
+        future = self.packager.submit(manifest, control, package.deb_file, compression)
+        future.add_done_callback(lambda done: self.report_packaging(package, control, compression, history_id, done))
+        with self.assigned_lock:
+            self.packaging[package.name] = future
+
+    def report_packaging(self, package: Package, control: str, compression: HDebCompression,
+                         history_id: int | None, future: Future):
+        try:
+            result = future.result()
+            print(f"Packaged {package.name}: {result}")
+            row = result.as_row(history_id, package.name)
+
+            if self.apt is not None:
+                self.apt.add(control, result.deb_file)
+        except Exception as e:
+            print(f"Failed to package {package.name}: {e}")
+            row = (history_id, package.name, package.deb_file, str(compression), None, None, None, str(e))
+
+        # the node has long been reported by now, the build's history is
+        # where a bad .deb shows up
+        if history_id is None:
+            return
+        try:
+            sql_conn = self.connect_sql()
+            try:
+                HBuildLog.insert_packaging(sql_conn, row)
+            finally:
+                sql_conn.close()
+        except Exception as e:
+            print(f"Failed to record packaging of {package.name}: {e}")
+
+    def wait_packaging(self, package: Package | ToolPackage | SourcePackage):
+        # the packaging processes read the package tree, it cannot change
+        # under them
+        with self.assigned_lock:
+            future = self.packaging.pop(package.name, None) if isinstance(package, Package) else None
+
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+    def build_package(self, package: Package | ToolPackage | SourcePackage, state: HJobState, stage_name: str,
+                      configure_key: str | None = None, job: HBuildJob | None = None):
         self.make_dir(package)
-        self.make_container(package)
+        self.make_container(package, state)
 
         if isinstance(package, SourcePackage):
-            return self.build_source(package)
+            return self.build_source(package, state)
         elif isinstance(package, ToolPackage):
-            return self.build_tool(package, stage_name)
+            return self.build_tool(package, state, stage_name, configure_key)
         elif isinstance(package, Package):
-            values = self.build_system(package, stage_name)
-            self.build_deb(package)
+            values = self.build_system(package, state, stage_name, configure_key)
+            # a failed build must not reach the system root or the repository
+            if values is None:
+                return None
+            self.build_deb(package, job)
 
             return values
         raise Exception("Passed invalid object to build_package() !")
 
     def install_package(self, package: Package | ToolPackage | SourcePackage, stage_name: str):
-        if isinstance(package, Package):
-            if stage_name is None:
+        state = HJobState()
+        try:
+            if isinstance(package, Package):
                 self.make_dir(package)
-                self.make_container(package)
-                self.build_system(package, None)
+                self.make_container(package, state)
+                if self.build_system(package, state, stage_name) is None:
+                    return
                 self.build_deb(package)
+            elif isinstance(package, ToolPackage):
+                if stage_name is None:
+                    self.make_dir(package)
+                    self.make_container(package, state)
+                    self.build_tool(package, state, None)
+                else:
+                    self.make_dir(package)
+                    self.make_container(package, state)
+                    self.build_tool(package, state, stage_name)
+                package.copy_tool()
             else:
                 self.make_dir(package)
-                self.make_container(package)
-                self.build_system(package, stage_name)
-                self.build_deb(package)
-            package.copy_system()
-        elif isinstance(package, ToolPackage):
-            if stage_name is None:
-                self.make_dir(package)
-                self.make_container(package)
-                self.build_tool(package, None)
-            else:
-                self.make_dir(package)
-                self.make_container(package)
-                self.build_tool(package, stage_name)
-            package.copy_tool()
-        else:
-            self.make_dir(package)
-            self.make_container(package)
-            self.build_source(package)
+                self.make_container(package, state)
+                self.build_source(package, state)
+        finally:
+            state.tidy()
 
     def clean_package(self, package: Package | ToolPackage | SourcePackage):
+        self.wait_packaging(package)
         package.clean_dirs()
 
-    def kill_build(self, package: Package | ToolPackage | SourcePackage):
-        package.kill_build()
\ No newline at end of file
+    def kill_build(self, job: HBuildJob):
+        job.state.kill_build()
\ No newline at end of file
@@ -0,0 +1,276 @@
+import heapq
+import time
+import uuid
+from collections import OrderedDict, deque
+from enum import Enum
+
+class HNodeState(Enum):
+    WAITING = 1
+    READY = 2
+    RUNNING = 3
+    SUCCEEDED = 4
+    FAILED = 5
+    SKIPPED = 6
+
+class HBuildPlan():
+    __slots__ = ("order", "deps", "dependents", "groups")
+
+    def __init__(self, order: list[str], deps: dict[str, list[str]], groups: dict[str, str] | None = None):
+        self.order = tuple(order)
+        self.deps = {name: tuple(node_deps) for name, node_deps in deps.items()}
+        # stages of one package share a configured build dir, they go to one
+        # runner, one after the other
+        self.groups = groups if groups is not None else {}
+
+        dependents: dict[str, list[str]] = {name: [] for name in self.order}
+        for name, node_deps in self.deps.items():
+            for dep in node_deps:
+                dependents[dep].append(name)
+        self.dependents = {name: tuple(node_dependents) for name, node_dependents in dependents.items()}
+
+    def __len__(self):
+        return len(self.order)
+
+DEFAULT_PLAN_CACHE_SIZE = 64
+DEFAULT_NODE_WEIGHT = 60.0
+
+class HPlanCache():
+    def __init__(self, max_size: int = DEFAULT_PLAN_CACHE_SIZE):
+        self.max_size = max_size
+        self.plans: OrderedDict[tuple[frozenset[str], str], HBuildPlan] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: tuple[frozenset[str], str]) -> HBuildPlan | None:
+        plan = self.plans.get(key)
+        if plan is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.plans.move_to_end(key)
+        return plan
+
+    def put(self, key: tuple[frozenset[str], str], plan: HBuildPlan):
+        if self.max_size <= 0:
+            return
+
+        self.plans[key] = plan
+        self.plans.move_to_end(key)
+        while len(self.plans) > self.max_size:
+            self.plans.popitem(last=False)
+
+    def clear(self):
+        if len(self.plans) > 0:
+            self.invalidations += 1
+        self.plans.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self.plans),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+class HBuildJob():
+    def __init__(self, plan: HBuildPlan, weights: dict[str, float], default_weight: float = DEFAULT_NODE_WEIGHT,
+                 resume: bool = False):
+        self.id = uuid.uuid4().hex[:12]
+        self.plan = plan
+        # runners pick failed nodes up again from their first unfinished step
+        self.resume = resume
+
+        # longest path from each node to the end of the job, counting the
+        # node itself, so the chain that bounds the build starts first
+        self.ranks: dict[str, float] = {}
+        for name in reversed(plan.order):
+            longest_dependent = max((self.ranks[dependent] for dependent in plan.dependents[name]), default=0.0)
+            self.ranks[name] = weights.get(name, default_weight) + longest_dependent
+        self.critical_path = max(self.ranks.values(), default=0.0)
+
+        self.position = {name: position for position, name in enumerate(plan.order)}
+        self.pending = {name: len(plan.deps[name]) for name in plan.order}
+        self.states = {name: HNodeState.WAITING for name in plan.order}
+        self.ready: list[tuple[float, int, str]] = []
+
+        for name, count in self.pending.items():
+            if count == 0:
+                self.make_ready(name)
+
+    def make_ready(self, name: str):
+        self.states[name] = HNodeState.READY
+        heapq.heappush(self.ready, (-self.ranks[name], self.position[name], name))
+
+    def next_ready(self) -> str | None:
+        if len(self.ready) == 0:
+            return None
+
+        _, _, name = heapq.heappop(self.ready)
+        self.states[name] = HNodeState.RUNNING
+        return name
+
+    def succeed(self, name: str):
+        self.states[name] = HNodeState.SUCCEEDED
+        for dependent in self.plan.dependents[name]:
+            self.pending[dependent] -= 1
+            if self.pending[dependent] == 0 and self.states[dependent] == HNodeState.WAITING:
+                self.make_ready(dependent)
+
+    def fail(self, name: str):
+        self.states[name] = HNodeState.FAILED
+
+        skipped = deque(self.plan.dependents[name])
+        while len(skipped) > 0:
+            dependent = skipped.popleft()
+            if self.states[dependent] == HNodeState.WAITING:
+                self.states[dependent] = HNodeState.SKIPPED
+                skipped.extend(self.plan.dependents[dependent])
+
+    @property
+    def finished(self) -> bool:
+        return all(state in (HNodeState.SUCCEEDED, HNodeState.FAILED, HNodeState.SKIPPED)
+                   for state in self.states.values())
+
+    def summary(self) -> str:
+        counts = {state: 0 for state in HNodeState}
+        for state in self.states.values():
+            counts[state] += 1
+
+        return ", ".join(f"{count} {state.name.lower()}" for state, count in counts.items() if count > 0)
+
+DEFAULT_HEARTBEAT_TIMEOUT = 30.0
+
+class HBuildScheduler():
+    def __init__(self, heartbeat_timeout: float = DEFAULT_HEARTBEAT_TIMEOUT):
+        self.jobs: dict[str, HBuildJob] = {}
+
+        # what each runner last said about itself: its slots, how many of
+        # them were busy and when, counts rather than one entry per slot so a
+        # repeated ready changes nothing
+        self.slots: dict[str, int] = {}
+        self.busy: dict[str, int] = {}
+        self.last_seen: dict[str, float] = {}
+        self.heartbeat_timeout = heartbeat_timeout
+
+        self.running: dict[tuple[str, str], str] = {}
+        self.assigned: dict[str, int] = {}
+
+        # group -> runner building one of its nodes, and the last one that did
+        self.group_running: dict[str, str] = {}
+        self.affinity: dict[str, str] = {}
+
+    def submit(self, plan: HBuildPlan, weights: dict[str, float],
+               default_weight: float = DEFAULT_NODE_WEIGHT, resume: bool = False) -> HBuildJob:
+        job = HBuildJob(plan, weights, default_weight, resume)
+        self.jobs[job.id] = job
+
+        return job
+
+    def runner_ready(self, runner: str, slots: int, busy: int):
+        self.slots[runner] = slots
+        self.busy[runner] = busy
+        self.last_seen[runner] = time.monotonic()
+
+    def free_slots(self, runner: str) -> int:
+        # the runner has not seen executes still on their way, and we do not
+        # know about builds from before this dispatcher, take the larger
+        return self.slots.get(runner, 0) - max(self.busy.get(runner, 0), self.assigned.get(runner, 0))
+
+    @property
+    def idle_slots(self) -> int:
+        return sum(max(0, self.free_slots(runner)) for runner in self.slots)
+
+    def release(self, job_id: str, name: str) -> str | None:
+        runner = self.running.pop((job_id, name), None)
+        if runner is None:
+            return None
+
+        self.assigned[runner] -= 1
+        group = self.jobs[job_id].plan.groups.get(name)
+        if group is not None and self.group_running.get(group) == runner:
+            del self.group_running[group]
+
+        return runner
+
+    def complete(self, runner: str, job_id: str, name: str, success: bool) -> HBuildJob | None:
+        # a node given to another runner since, e.g. after this one was
+        # evicted, belongs to that one now
+        if self.running.get((job_id, name)) != runner:
+            return None
+        self.release(job_id, name)
+
+        job = self.jobs[job_id]
+        if success:
+            job.succeed(name)
+        else:
+            job.fail(name)
+
+        if job.finished:
+            del self.jobs[job_id]
+
+        return job
+
+    def requeue(self, job_id: str, name: str):
+        if self.release(job_id, name) is not None:
+            self.jobs[job_id].make_ready(name)
+
+    def evict(self, runner: str) -> list[tuple[str, str]]:
+        # whatever it was building is lost with it, the nodes go back in line
+        lost = [key for key, key_runner in self.running.items() if key_runner == runner]
+        for job_id, name in lost:
+            self.requeue(job_id, name)
+
+        for table in (self.slots, self.busy, self.last_seen, self.assigned):
+            table.pop(runner, None)
+        for group in [group for group, group_runner in self.affinity.items() if group_runner == runner]:
+            del self.affinity[group]
+
+        return lost
+
+    def stale_runners(self) -> list[str]:
+        now = time.monotonic()
+        return [runner for runner, last_seen in self.last_seen.items() if now - last_seen > self.heartbeat_timeout]
+
+    def take_slot(self, group: str | None) -> str | None:
+        # a sibling still building holds the group until it finishes
+        busy_runner = self.group_running.get(group) if group is not None else None
+        if busy_runner is not None:
+            return busy_runner if self.free_slots(busy_runner) > 0 else None
+
+        runner = self.affinity.get(group) if group is not None else None
+        if runner is None or self.free_slots(runner) <= 0:
+            runner = max(self.slots, key=self.free_slots, default=None)
+            if runner is None or self.free_slots(runner) <= 0:
+                return None
+
+        if group is not None:
+            self.group_running[group] = runner
+            self.affinity[group] = runner
+        return runner
+
+    def assignments(self) -> list[tuple[str, HBuildJob, str]]:
+        assigned = []
+        for job in list(self.jobs.values()):
+            deferred = []
+            while self.idle_slots > 0:
+                name = job.next_ready()
+                if name is None:
+                    break
+
+                runner = self.take_slot(job.plan.groups.get(name))
+                if runner is None:
+                    deferred.append(name)
+                    continue
+
+                self.running[(job.id, name)] = runner
+                self.assigned[runner] = self.assigned.get(runner, 0) + 1
+                assigned.append((runner, job, name))
+
+            for name in deferred:
+                job.make_ready(name)
+
+        return assigned
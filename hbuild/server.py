@@ -1,6 +1,7 @@
 import json
-import re
+import socket
 import time
+from threading import Thread
 
 import pika as mq
 import pymysql
@@ -9,6 +10,7 @@ from fastapi import HTTPException, BackgroundTasks, FastAPI
 from kombu import Exchange, Queue, Connection, Producer, Consumer
 from starlette.middleware.cors import CORSMiddleware
 
+from .index import HLookupKind
 from .models import BuildOrder
 from .package import Package
 from .registry import HPackageRegistry
@@ -16,6 +18,7 @@ from .source import SourcePackage
 from .sql import HBuildLog
 from .stage import Stage
 from .tool import ToolPackage
+from .worker import RobustWorker
 
 
 def format_lookup_name(package: SourcePackage | ToolPackage | Package | Stage) -> str:
@@ -26,12 +29,6 @@ def format_lookup_name(package: SourcePackage | ToolPackage | Package | Stage) -
     else:
         return package.name
 
-def deformat_lookup_name(name: str) -> str:
-    if (matches := re.match('source\\[(.+)]', name)) is not None:
-        return matches.group(1)
-    else:
-        return name
-
 
 class HBuildServer(Routable):
     def __init__(self):
@@ -48,19 +45,32 @@ class HBuildServer(Routable):
                                      database='sql',
                                      cursorclass=pymysql.cursors.DictCursor)
 
+        self.reload_thread = Thread(target=self.listen_reloads, daemon=True)
+        self.reload_thread.start()
+
+    def listen_reloads(self):
+        reload_exchange = Exchange("hbuild-reload", type="fanout")
+        queues = [Queue(exchange=reload_exchange, exclusive=True)]
+        with Connection(self.rabbit_url) as conn:
+            worker = RobustWorker(conn, queues, self.consume_reload)
+            worker.run()
+
+    def consume_reload(self, raw_body, message):
+        operation, generation, pkgsrc_names = raw_body.split(":", maxsplit=2)
+        if operation != "reload":
+            return
+
+        pkgsrc_names = json.loads(pkgsrc_names)
+        try:
+            change = self.registry.reload_pkgsrc_files(self.registry.pkgsrc_paths(pkgsrc_names), int(generation))
+        except Exception as e:
+            print(f"Rejected pkgsrc reload of {', '.join(pkgsrc_names)}: {e}")
+            return
+
+        print(f"Reloaded package registry, {change}")
+
     def lookup(self, name: str) -> Package | ToolPackage | SourcePackage | Stage | None:
-        source_try = self.registry.find_source(name)
-        if source_try is not None:
-            return source_try
-        elif (source_try := self.registry.find_tool(name)) is not None:
-            return source_try
-        elif (source_try := self.registry.find_package(name)) is not None:
-            return source_try
-        elif (matches := re.match('(.+)\\[(.+)]', name)) is not None:
-            parent = self.lookup(matches.group(1))
-            return parent.find_stage(matches.group(2))
-        else:
-            return None
+        return self.registry.lookup(name)
 
     @get('/')
     def get_root(self) -> str:
@@ -94,12 +104,12 @@ class HBuildServer(Routable):
             "packages": package_list
         }
 
-    @get('/api/graph')
-    def get_graph(self):
-        graph_json = None
+    def dispatch_rpc(self, request: str, routing_key: str = "dispatch", timeout: float | None = None):
+        result_json = None
+        result_operation = f"result_{request.split(':', maxsplit=1)[0]}"
 
-        def graph_callback(raw_body, message):
-            nonlocal graph_json
+        def rpc_callback(raw_body, message):
+            nonlocal result_json
 
             body = raw_body
             objects = body.split(":", maxsplit=1)
@@ -107,38 +117,99 @@ class HBuildServer(Routable):
             message.ack()
 
             operation = objects[0]
-            if operation == "result_graph":
-                graph_json = objects[1]
+            if operation == result_operation:
+                result_json = objects[1]
 
         conn = Connection(self.rabbit_url)
         reply_queue = Queue(name="amq.rabbitmq.reply-to")
-        with Consumer(conn, reply_queue, callbacks=[graph_callback], no_ack=True):
+        with Consumer(conn, reply_queue, callbacks=[rpc_callback], no_ack=True):
             producer = Producer(channel=conn)
-            producer.publish("graph",
+            producer.publish(request,
                              exchange=self.exchange,
-                             routing_key="dispatch",
+                             routing_key=routing_key,
                              declare=[self.exchange],
                              reply_to="amq.rabbitmq.reply-to")
-            conn.drain_events()
+            conn.drain_events(timeout=timeout)
 
-        return json.loads(graph_json)
+        return json.loads(result_json)
+
+    @get('/api/graph')
+    def get_graph(self):
+        return self.dispatch_rpc("graph")
+
+    @get('/api/stats')
+    def get_stats(self):
+        return self.dispatch_rpc("stats")
 
     @get('/api/history')
     def get_history(self):
         history = HBuildLog.select_history(self.sql_conn)
+
+        steps: dict[int, list[dict]] = {}
+        for step in HBuildLog.select_step_stats(self.sql_conn):
+            steps.setdefault(step["history_id"], []).append({
+                "package": step["package"],
+                "stage": step["stage"],
+                "command": step["command"],
+                "exit_code": step["exit_code"],
+                "wall_time": step["wall_time"],
+                "cpu_user": step["cpu_user"],
+                "cpu_system": step["cpu_system"],
+                "memory_peak": step["memory_peak"],
+                "container_peak": step["container_peak"],
+                "io_read": step["io_read"],
+                "io_write": step["io_write"],
+            })
+
+        packaging: dict[int, list[dict]] = {}
+        for deb in HBuildLog.select_packaging(self.sql_conn):
+            packaging.setdefault(deb["history_id"], []).append({
+                "package": deb["package"],
+                "deb_file": deb["deb_file"],
+                "compression": deb["compression"],
+                "elapsed": deb["elapsed"],
+                "input_bytes": deb["input_bytes"],
+                "output_bytes": deb["output_bytes"],
+                "ratio": deb["input_bytes"] / deb["output_bytes"] if deb["output_bytes"] else None,
+                "error": deb["error"],
+            })
+
         return {
             "past_jobs": [{
                 "id": item["id"],
                 "runner": item["runner"],
                 "packages": item["packages"].split(","),
                 "created_at": item["created_at"].strftime("%s"),
+                "steps": steps.get(item["id"], []),
+                "packaging": packaging.get(item["id"], []),
             } for item in history]
         }
 
+    @get('/api/history/{history_id}/log')
+    def get_history_log(self, history_id: int, unit: str = "lines", start: int = 0, end: int = 1000):
+        if unit not in ("lines", "bytes"):
+            raise HTTPException(status_code=400, detail=f"Unknown log range unit {unit}")
+        if start < 0 or end < start:
+            raise HTTPException(status_code=400, detail=f"Invalid log range {start}-{end}")
+
+        entry = HBuildLog.select_history_entry(self.sql_conn, history_id)
+        if entry is None:
+            raise HTTPException(status_code=404, detail=f"No build with id {history_id}")
+
+        # the full log only lives in the spool of the runner that built it
+        try:
+            result = self.dispatch_rpc(f"spool:{history_id}:{unit}:{start}:{end}", entry["runner"], timeout=10)
+        except socket.timeout:
+            raise HTTPException(status_code=504, detail=f"Runner {entry['runner']} did not answer")
+
+        if "error" in result:
+            raise HTTPException(status_code=404, detail=result["error"])
+
+        return result
+
     @get('/api/log/{name}')
     def get_log(self, name: str):
-        package_name = deformat_lookup_name(name)
-        if package_name not in self.registry.package_names + self.registry.tool_names + self.registry.source_names + self.registry.stage_names:
+        if self.lookup(name) is None:
             raise HTTPException(status_code=404, detail=f"{name} is not a system, tool, or source package")
 
         logs = HBuildLog.select_logs(self.sql_conn, name, None)
@@ -148,33 +219,34 @@ class HBuildServer(Routable):
 
     @get('/api/status/{name}')
     def get_status(self, name: str):
-        package_name = deformat_lookup_name(name)
-        if package_name not in self.registry.package_names + self.registry.tool_names + self.registry.source_names:
+        handle = self.registry.lookup_handle(name)
+        if handle is None or handle.kind == HLookupKind.STAGE:
             raise HTTPException(status_code=404, detail=f"{name} is not a system, tool, or source package")
 
-        package: Package | SourcePackage | ToolPackage = self.lookup(package_name)
+        # builds run on the runners, their steps are where the status is kept
+        last_step = HBuildLog.select_last_exit_code(self.sql_conn, format_lookup_name(handle.target))
         return {
-            "return_code": package.last_return_status if package.last_return_status is not None else 0
+            "return_code": last_step["exit_code"] if last_step is not None else 0
         }
 
     @post('/api/build', status_code=202)
     def post_build(self, req: BuildOrder) -> None:
         to_build = []
+        requested = set()
         for package in req.packages:
-            package_name = deformat_lookup_name(package.name)
-            if package_name in to_build:
-                raise HTTPException(status_code=400, detail=f"Duplicate package {package.name} in build order")
-            if package_name not in self.registry.package_names + self.registry.tool_names + self.registry.source_names + self.registry.stage_names:
-                raise HTTPException(status_code=404, detail=f"Package {package.name} does not exist or is not available.")
-            if package.stage:
-                to_build.append(f"{package.name}[{package.stage}]")
-            else:
-                to_build.append(package.name)
+            lookup_name = f"{package.name}[{package.stage}]" if package.stage else package.name
+            if lookup_name in requested:
+                raise HTTPException(status_code=400, detail=f"Duplicate package {lookup_name} in build order")
+            if self.lookup(lookup_name) is None:
+                raise HTTPException(status_code=404, detail=f"Package {lookup_name} does not exist or is not available.")
+
+            requested.add(lookup_name)
+            to_build.append(lookup_name)
 
         with Connection(self.rabbit_url) as conn:
             with conn.channel() as channel:
                 producer = Producer(channel)
-                producer.publish(f"build:{','.join(to_build)}",
+                producer.publish(f"build:{','.join(to_build)}{':resume' if req.resume else ''}",
                                  exchange=self.exchange,
                                  routing_key="dispatch",
                                  declare=[self.exchange])
@@ -0,0 +1,74 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+SNAPSHOT_FORMAT = 1
+
+class HRegistrySnapshot():
+    def __init__(self, config: dict, config_file: str = "config.toml"):
+        self.config_file = config_file
+        self.cache_dir = Path(config["hbuild"]["cache_dir"]).resolve().as_posix()
+        self.pkgsrc_dir = config["hbuild"]["pkgsrc_dir"]
+        self.schema_dir = config["hbuild"]["schema_dir"]
+
+        self.key = self.compute_key()
+
+    @property
+    def snapshot_file(self) -> str:
+        return Path(self.cache_dir, f"registry-{self.key}.pickle").as_posix()
+
+    def hash_file(self, digest, path: str, rel_path: str):
+        with open(path, 'rb') as f:
+            contents = f.read()
+
+        digest.update(f"{rel_path}:{len(contents)}:".encode())
+        digest.update(contents)
+
+    def hash_dir(self, digest, root_dir: str, suffix: str = ""):
+        for dent, subdirs, files in os.walk(root_dir):
+            # bytecode is rewritten by every import and every interpreter
+            subdirs[:] = sorted(subdir for subdir in subdirs if subdir != "__pycache__")
+            for file in sorted(files):
+                if not file.endswith(suffix):
+                    continue
+                path = os.path.join(dent, file)
+                self.hash_file(digest, path, os.path.relpath(path, root_dir))
+
+    def compute_key(self) -> str:
+        digest = hashlib.sha256()
+
+        # paths in the registry are resolved against the working directory,
+        # and the pickled objects are only valid for the code that made them
+        digest.update(f"{SNAPSHOT_FORMAT}:{os.getcwd()}:".encode())
+        self.hash_dir(digest, Path(__file__).parent.as_posix(), ".py")
+
+        self.hash_file(digest, self.config_file, "config.toml")
+        self.hash_dir(digest, self.schema_dir)
+        self.hash_dir(digest, self.pkgsrc_dir)
+
+        return digest.hexdigest()
+
+    def load(self) -> dict | None:
+        if not os.path.exists(self.snapshot_file):
+            return None
+
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"Ignoring unreadable registry snapshot {self.snapshot_file}: {e}")
+            return None
+
+    def save(self, state: dict):
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        tmp_file = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.snapshot_file)
+
+        for file in os.listdir(self.cache_dir):
+            path = Path(self.cache_dir, file).as_posix()
+            if file.startswith("registry-") and file.endswith(".pickle") and path != self.snapshot_file:
+                os.unlink(path)
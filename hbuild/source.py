@@ -4,11 +4,13 @@ from enum import Enum
 from pathlib import Path
 from urllib.parse import urlparse
 
-import podman
 from persistqueue import FIFOSQLiteQueue
-from podman.domain.containers import Container as PodmanContainer
 
+from .jobstate import HJobState
 from .step import Step
+from .template import make_context
+from .containers import container_running, podman_client
+from .jobserver import jobserver_volume
 from .config import HPackageConfig
 
 class SourceType(Enum):
@@ -21,10 +23,18 @@ class CloneType(Enum):
     TAG = 2
 
 class SourcePackage:
-    def __init__(self, config: HPackageConfig):
+    __slots__ = ("config", "pkgsrc_yml", "pkgsrc_path", "name", "subdir", "dir",
+                 "log_dir", "patch_dir", "source_dir",
+                 "version", "source_type", "url", "format", "git",
+                 "branch", "clone_type", "commit", "tag", "extract_strip", "patch_path_strip",
+                 "tools_required", "acquire_steps", "extract_steps", "patch_steps", "regenerate_steps")
+
+    def __init__(self, config: HPackageConfig, pkgsrc_yml: dict, pkgsrc_path: str):
         self.config = config
+        self.pkgsrc_yml = pkgsrc_yml
+        self.pkgsrc_path = pkgsrc_path
 
-        source_properties = config.pkgsrc_yml
+        source_properties = pkgsrc_yml
 
         self.name = source_properties["name"]
 
@@ -32,27 +42,23 @@ class SourcePackage:
             self.subdir = source_properties["subdir"]
             self.dir = os.path.join(self.subdir, self.name)
         else:
+            self.subdir = None
             self.dir = self.name
 
-        self.patches_dir = config.patches_dir
-        self.logs_dir = config.logs_dir
-        self.sources_dir = config.sources_dir
-
-        self.system_prefix = config.system_prefix
-        self.system_targets = config.system_targets
-        self.system_root = config.system_root
-
         self.log_dir = Path(config.logs_dir, f"source[{self.name}]").resolve().as_posix()
         self.patch_dir = Path(config.patches_dir, self.name).resolve().as_posix()
         self.source_dir = Path(config.sources_dir, self.dir).resolve().as_posix()
 
-        self.podman_client = podman.from_env()
-        self.podman_container: PodmanContainer | None = None
-
-        self.last_return_status = None
-
         self.version = source_properties["version"]
 
+        self.url = None
+        self.format = None
+        self.git = None
+        self.branch = None
+        self.clone_type = None
+        self.commit = None
+        self.tag = None
+
         if "url" in source_properties:
             self.source_type = SourceType.URL
             self.url = source_properties["url"]
@@ -65,7 +71,6 @@ class SourcePackage:
                 self.branch = source_properties["branch"]
                 self.clone_type = CloneType.BRANCH
             else:
-                self.branch = None
                 if "commit" in source_properties:
                     self.clone_type = CloneType.COMMIT
                     self.commit = source_properties["commit"]
@@ -93,20 +98,20 @@ class SourcePackage:
 
         if self.source_type == SourceType.GIT:
             if self.branch is None:
-                self.acquire_steps.append(Step({
+                self.acquire_steps.append(Step.from_yml({
                     "args": ["git", "clone", self.git, '/home/hbuild/source']
                 }, self.name))
             else:
-                self.acquire_steps.append(Step({
+                self.acquire_steps.append(Step.from_yml({
                     "args": ["git", "clone", "-b", self.branch, self.git, '/home/hbuild/source']
                 }, self.name))
 
             if self.clone_type == CloneType.COMMIT or self.clone_type == CloneType.TAG:
-                self.acquire_steps.append(Step({
+                self.acquire_steps.append(Step.from_yml({
                     "args": ["git", "checkout", self.commit if self.clone_type == CloneType.COMMIT else self.tag],
                 }, self.name))
         else:
-            self.acquire_steps.append(Step({
+            self.acquire_steps.append(Step.from_yml({
                 "args": ["wget", self.url, "-P", '/home/hbuild/source_root']
             }, self.name))
         
@@ -114,32 +119,54 @@ class SourcePackage:
             parsed_url = urlparse(self.url)
             output_file = os.path.basename(parsed_url.path)
             
-            self.extract_steps.append(Step({
+            self.extract_steps.append(Step.from_yml({
                 "args": ["tar", "-xvf" if self.format == "tar.xz" else "-xzvf", f"/home/hbuild/source_root/{output_file}",  "-C", '/home/hbuild/source', "--strip-components=1"]
             }, self.name))
 
-        self.patch_steps: list[Step] = [Step({
-            "args": "find @THIS_SOURCE_DIR@ -type f -name '*.patch' -print0 | xargs -0 -n 1 patch -p1",
+        self.patch_steps: list[Step] = [Step.from_yml({
+            "args": ["find @THIS_SOURCE_DIR@ -type f -name '*.patch' -print0 | xargs -0 -n 1 patch -p1"],
             "shell": True
         }, self.name)]
 
-        self.regenerate_ymls: list[dict[str, str]] = []
         self.regenerate_steps: list[Step] = []
 
-        if "regenerate" in source_properties:
-            regenerate_properties = source_properties["regenerate"]
-            for step_yml in regenerate_properties:
-                self.regenerate_ymls.append(step_yml)
+    @property
+    def podman_client(self):
+        return podman_client()
+
+    @property
+    def patches_dir(self):
+        return self.config.patches_dir
+
+    @property
+    def logs_dir(self):
+        return self.config.logs_dir
+
+    @property
+    def sources_dir(self):
+        return self.config.sources_dir
+
+    @property
+    def system_prefix(self):
+        return self.config.system_prefix
 
-    def acquire(self):
-        self.exec_steps(self.acquire_steps)
+    @property
+    def system_targets(self):
+        return self.config.system_targets
+
+    @property
+    def system_root(self):
+        return self.config.system_root
+
+    def acquire(self, state: HJobState):
+        return self.exec_steps(self.acquire_steps, state)
         
-    def extract(self):
-        self.exec_steps(self.extract_steps)
+    def extract(self, state: HJobState):
+        return self.exec_steps(self.extract_steps, state)
 
-    def apply_patches(self):
+    def apply_patches(self, state: HJobState):
         pass
-        #self.exec_steps(self.patch_steps)
+        #self.exec_steps(self.patch_steps, state)
 
     def deps(self):
         deps = []
@@ -148,10 +175,11 @@ class SourcePackage:
 
         return deps
 
-    def make_container(self):
-        if self.podman_container is not None:
-            pass
-        self.podman_container = self.podman_client.containers.run(
+    def make_container(self, state: HJobState):
+        # stages of one package run in the same container
+        if container_running(state.container):
+            return
+        state.container = self.podman_client.containers.run(
             'hbuild:latest',
             stdout=True,
             stderr=True,
@@ -195,21 +223,12 @@ class SourcePackage:
                         'extended_mode': ['z']
                     }
                 } if Path(self.patch_dir).exists() is True else {}
-            ),
+            ) | jobserver_volume(),
 
             detach=True,
             tty=True
         )
 
-    def kill_build(self):
-        self.podman_container.kill(signal='SIGKILL')
-
-    def tidy(self):
-        if self.podman_container is not None:
-            self.podman_container.kill(signal='SIGKILL')
-            self.podman_container.remove(force=True)
-            self.podman_container = None
-
     def make_dirs(self):
         os.makedirs(self.source_dir, exist_ok = True)
 
@@ -217,30 +236,32 @@ class SourcePackage:
         if os.path.exists(self.source_dir):
             shutil.rmtree(self.source_dir)
 
-    def prepare(self):
-        self.acquire()
-        self.extract()
-        self.apply_patches()
+    def prepare(self, state: HJobState):
+        acquire_resp = self.acquire(state)
+        if isinstance(acquire_resp, Exception):
+            return acquire_resp
 
-    def exec_steps(self, steps: list[Step]) -> int | Exception:
-        return_code: int | Exception = None
-        for step in steps:
-            return_code = step.exec(
-                '/home/hbuild/system_prefix',
-                self.system_targets,
-                '/home/hbuild/source_root',
-                '/home/hbuild/source_root',
+        extract_resp = self.extract(state)
+        if isinstance(extract_resp, Exception):
+            return extract_resp
+
+        self.apply_patches(state)
+        return extract_resp
 
-                '/home/hbuild/source',
-                '/home/hbuild/source',
+    def exec_steps(self, steps: list[Step], state: HJobState) -> int | Exception:
+        return_code: int | Exception = None
+        context = make_context('/home/hbuild/system_prefix',
+                               self.system_targets,
+                               '/home/hbuild/source_root',
+                               '/home/hbuild/source_root',
 
-                '/home/hbuild/source',
-                '/home/hbuild/system_root',
+                               '/home/hbuild/source',
+                               '/home/hbuild/source',
 
-                self.podman_container,
-                self,
-                None
-            )
+                               '/home/hbuild/source',
+                               '/home/hbuild/system_root')
+        for step in steps:
+            return_code = step.exec(context, state, self, None)
 
             if isinstance(return_code, Exception):
                 break
@@ -248,8 +269,8 @@ class SourcePackage:
         return return_code
 
 
-    def regenerate(self):
-        self.exec_steps(self.regenerate_steps)
+    def regenerate(self, state: HJobState):
+        return self.exec_steps(self.regenerate_steps, state)
 
     def __str__(self):
         return f"Source {self.name}[{self.version}]"
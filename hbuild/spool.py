@@ -0,0 +1,166 @@
+import bisect
+import os
+import struct
+import threading
+import zlib
+
+DEFAULT_FRAME_BYTES = 256 * 1024
+DEFAULT_KEEP_BUILDS = 200
+DEFAULT_MAX_READ = 4 * 1024 * 1024
+
+# raw offset, line number, compressed offset, compressed size of one frame
+INDEX_ENTRY = struct.Struct("<QQQI")
+
+class HSpoolFrame():
+    __slots__ = ("raw_offset", "line", "offset", "size")
+
+    def __init__(self, raw_offset: int, line: int, offset: int, size: int):
+        self.raw_offset = raw_offset
+        self.line = line
+        self.offset = offset
+        self.size = size
+
+class HLogSpool():
+    def __init__(self, spool_file: str, frame_bytes: int = DEFAULT_FRAME_BYTES):
+        self.spool_file = spool_file
+        self.index_file = f"{spool_file}.idx"
+        self.frame_bytes = frame_bytes
+
+        os.makedirs(os.path.dirname(spool_file), exist_ok=True)
+        self.data = open(spool_file, 'wb')
+        self.index = open(self.index_file, 'wb')
+        self.lock = threading.Lock()
+
+        self.buffer = bytearray()
+        self.raw_offset = 0
+        self.lines = 0
+        self.offset = 0
+
+    def write(self, text: str):
+        with self.lock:
+            self.buffer += text.encode('utf-8')
+            if len(self.buffer) >= self.frame_bytes:
+                self.flush_frame(False)
+
+    def flush(self):
+        with self.lock:
+            self.flush_frame(False)
+
+    def flush_frame(self, final: bool):
+        # frames end on a line break so a line range never starts halfway
+        # into a frame, only a runaway line without one gets cut
+        end = len(self.buffer)
+        if not final and len(self.buffer) < self.frame_bytes * 4:
+            end = self.buffer.rfind(b'\n') + 1
+
+        if end == 0:
+            return
+
+        raw = self.buffer[:end]
+
+        # every frame is a complete zlib stream, so a range read only has to
+        # inflate the frames it overlaps
+        frame = zlib.compress(raw, 6)
+        self.data.write(frame)
+        self.data.flush()
+
+        # the index entry goes last, readers never see a frame half written
+        self.index.write(INDEX_ENTRY.pack(self.raw_offset, self.lines, self.offset, len(frame)))
+        self.index.flush()
+
+        self.raw_offset += len(raw)
+        self.lines += raw.count(b'\n')
+        self.offset += len(frame)
+        del self.buffer[:end]
+
+    def close(self):
+        with self.lock:
+            self.flush_frame(True)
+            self.data.close()
+            self.index.close()
+
+def read_index(spool_file: str) -> list[HSpoolFrame]:
+    with open(f"{spool_file}.idx", 'rb') as f:
+        index = f.read()
+
+    complete = len(index) - len(index) % INDEX_ENTRY.size
+    return [HSpoolFrame(*entry) for entry in INDEX_ENTRY.iter_unpack(index[:complete])]
+
+def read_frames(spool_file: str, frames: list[HSpoolFrame]) -> bytes:
+    if len(frames) == 0:
+        return b""
+
+    with open(spool_file, 'rb') as f:
+        f.seek(frames[0].offset)
+        compressed = f.read(frames[-1].offset + frames[-1].size - frames[0].offset)
+
+    raw = bytearray()
+    for frame in frames:
+        start = frame.offset - frames[0].offset
+        raw += zlib.decompress(compressed[start:start + frame.size])
+
+    return bytes(raw)
+
+def read_bytes(spool_file: str, start: int, end: int, max_read: int = DEFAULT_MAX_READ) -> dict:
+    frames = read_index(spool_file)
+    end = min(end, start + max_read)
+
+    offsets = [frame.raw_offset for frame in frames]
+
+    first = max(0, bisect.bisect_right(offsets, start) - 1)
+    last = bisect.bisect_left(offsets, end)
+    selected = frames[first:last]
+
+    raw = read_frames(spool_file, selected)
+    base = selected[0].raw_offset if len(selected) > 0 else start
+    data = raw[max(0, start - base):max(0, end - base)]
+
+    return {
+        "start": start,
+        "end": start + len(data),
+        "text": data.decode('utf-8', errors='replace'),
+    }
+
+def read_lines(spool_file: str, start: int, end: int, max_read: int = DEFAULT_MAX_READ) -> dict:
+    frames = read_index(spool_file)
+    lines = [frame.line for frame in frames]
+
+    # line end - 1 is complete before the first frame starting at or past it
+    first = max(0, bisect.bisect_right(lines, start) - 1)
+    last = bisect.bisect_left(lines, end)
+
+    selected = frames[first:last]
+    raw = read_frames(spool_file, selected)
+    base = selected[0].line if len(selected) > 0 else start
+
+    # lines as the index counts them, splitlines would also split on the
+    # \r of progress output
+    pieces = raw.split(b'\n')
+    raw_lines = [piece + b'\n' for piece in pieces[:-1]]
+    if len(pieces[-1]) > 0:
+        raw_lines.append(pieces[-1])
+
+    result = []
+    size = 0
+    for line in raw_lines[max(0, start - base):max(0, end - base)]:
+        size += len(line)
+        if size > max_read:
+            break
+        result.append(line)
+
+    return {
+        "start": start,
+        "end": start + len(result),
+        "text": b"".join(result).decode('utf-8', errors='replace'),
+    }
+
+def prune_spool(spool_dir: str, keep: int = DEFAULT_KEEP_BUILDS):
+    # one spool per build, named after its history id
+    spools = sorted((int(name.split(".")[0]) for name in os.listdir(spool_dir)
+                     if name.endswith(".log.z") and name.split(".")[0].isdigit()))
+
+    for build_id in spools[:max(0, len(spools) - keep)]:
+        for suffix in (".log.z", ".log.z.idx"):
+            path = os.path.join(spool_dir, f"{build_id}{suffix}")
+            if os.path.exists(path):
+                os.unlink(path)
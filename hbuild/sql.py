@@ -8,6 +8,13 @@ class HBuildLog():
             cursor.execute(sql, (package, stage, log))
             conn.commit()
 
+    @staticmethod
+    def insert_logs(conn: Connection, rows: list[tuple[str, str, str]]):
+        with conn.cursor() as cursor:
+            sql = "INSERT INTO `sql`.`logs` (`package`, `stage`, `log`) VALUES (%s, %s, %s)"
+            cursor.executemany(sql, rows)
+            conn.commit()
+
     @staticmethod
     def select_logs(conn: Connection, package: str, stage: str):
         with conn.cursor() as cursor:
@@ -20,16 +27,86 @@ class HBuildLog():
             return cursor.fetchall()
 
     @staticmethod
-    def insert_history(conn: Connection, runner: str, packages: list[str]):
+    def insert_history(conn: Connection, runner: str, packages: list[str]) -> int:
         with conn.cursor() as cursor:
             sql = "INSERT INTO `sql`.`history` (`runner`, `packages`) VALUES (%s, %s)"
             packages_csq = ",".join(packages)
             cursor.execute(sql, (runner, packages_csq))
             conn.commit()
+            return cursor.lastrowid
 
     @staticmethod
     def select_history(conn: Connection):
         with conn.cursor() as cursor:
             sql = "SELECT * FROM `sql`.`history`"
             cursor.execute(sql)
+            return cursor.fetchall()
+
+    @staticmethod
+    def select_history_entry(conn: Connection, history_id: int):
+        with conn.cursor() as cursor:
+            sql = "SELECT * FROM `sql`.`history` WHERE `id` = %s"
+            cursor.execute(sql, (history_id,))
+            return cursor.fetchone()
+
+    @staticmethod
+    def insert_step_stats(conn: Connection, rows: list[tuple]):
+        with conn.cursor() as cursor:
+            sql = "INSERT INTO `sql`.`step_stats` (`history_id`, `package`, `stage`, `command`, `exit_code`, " \
+                  "`wall_time`, `cpu_user`, `cpu_system`, `memory_peak`, `container_peak`, `io_read`, `io_write`) " \
+                  "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+            cursor.executemany(sql, rows)
+            conn.commit()
+
+    @staticmethod
+    def select_step_stats(conn: Connection):
+        with conn.cursor() as cursor:
+            sql = "SELECT * FROM `sql`.`step_stats` ORDER BY `id`"
+            cursor.execute(sql)
+            return cursor.fetchall()
+
+    @staticmethod
+    def select_last_exit_code(conn: Connection, package: str):
+        # steps of a stage are recorded as package[stage]
+        with conn.cursor() as cursor:
+            sql = "SELECT `exit_code` FROM `sql`.`step_stats` " \
+                  "WHERE `package` = %s OR LEFT(`package`, CHAR_LENGTH(%s) + 1) = CONCAT(%s, '[') " \
+                  "ORDER BY `id` DESC LIMIT 1"
+            cursor.execute(sql, (package, package, package))
+            return cursor.fetchone()
+
+    @staticmethod
+    def insert_packaging(conn: Connection, row: tuple):
+        with conn.cursor() as cursor:
+            sql = "INSERT INTO `sql`.`packaging` (`history_id`, `package`, `deb_file`, `compression`, `elapsed`, " \
+                  "`input_bytes`, `output_bytes`, `error`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+            cursor.execute(sql, row)
+            conn.commit()
+
+    @staticmethod
+    def select_packaging(conn: Connection):
+        with conn.cursor() as cursor:
+            sql = "SELECT * FROM `sql`.`packaging` ORDER BY `id`"
+            cursor.execute(sql)
+            return cursor.fetchall()
+
+    @staticmethod
+    def insert_duration(conn: Connection, package: str, runner: str, duration: float, output_hash: str | None,
+                        cached: bool):
+        with conn.cursor() as cursor:
+            sql = "INSERT INTO `sql`.`durations` (`package`, `runner`, `duration`, `output_hash`, `cached`) " \
+                  "VALUES (%s, %s, %s, %s, %s)"
+            cursor.execute(sql, (package, runner, duration, output_hash, cached))
+            conn.commit()
+
+    @staticmethod
+    def select_durations(conn: Connection):
+        # the time of the last real build, the output of the last result
+        with conn.cursor() as cursor:
+            sql = "SELECT `latest`.`package`, `b`.`duration`, `o`.`output_hash` " \
+                  "FROM (SELECT `package`, MAX(`id`) AS `id`, MAX(CASE WHEN NOT `cached` THEN `id` END) AS `built_id` " \
+                  "FROM `sql`.`durations` GROUP BY `package`) `latest` " \
+                  "JOIN `sql`.`durations` `o` ON `o`.`id` = `latest`.`id` " \
+                  "LEFT JOIN `sql`.`durations` `b` ON `b`.`id` = `latest`.`built_id`"
+            cursor.execute(sql)
             return cursor.fetchall()
\ No newline at end of file
@@ -2,12 +2,16 @@ from .config import HPackageConfig
 from .step import Step
 
 class Stage:
-    def __init__(self, config: HPackageConfig, package, package_name: str):
+    __slots__ = ("config", "pkgsrc_yml", "package_name", "package", "name",
+                 "tools_required", "pkgs_required", "compile_steps", "install_steps", "build_steps")
+
+    def __init__(self, config: HPackageConfig, pkgsrc_yml: dict, package, package_name: str):
         self.config = config
+        self.pkgsrc_yml = pkgsrc_yml
         self.package_name = package_name
         self.package = package
 
-        source_properties = config.pkgsrc_yml
+        source_properties = pkgsrc_yml
 
         self.name = source_properties["name"]
 
@@ -21,29 +25,14 @@ class Stage:
         else:
             self.pkgs_required = []
 
-        self.compile_ymls: list[dict[str, str]] = []
-        self.install_ymls: list[dict[str, str]] = []
-        self.build_ymls: list[dict[str, str]] = []
-
         self.compile_steps: list[Step] = []
         self.install_steps: list[Step] = []
         self.build_steps: list[Step] = []
 
-        if "compile" in source_properties:
-            configure_properties = source_properties["compile"]
-            for step_yml in configure_properties:
-                self.compile_ymls.append(step_yml)
+    @property
+    def pkgsrc_path(self):
+        return self.package.pkgsrc_path
 
-        if "install" in source_properties:
-            configure_properties = source_properties["install"]
-            for step_yml in configure_properties:
-                self.install_ymls.append(step_yml)
-
-        if "build" in source_properties:
-            build_properties = source_properties["build"]
-            for step_yml in build_properties:
-                self.build_ymls.append(step_yml)
-    
     def deps(self):
         deps = []
         for tool in self.tools_required:
@@ -65,4 +54,4 @@ class Stage:
         return f"Stage {self.name}: {self.tools_required}, {self.pkgs_required}"
     
     def __repr__(self):
-        return self.__str__()
\ No newline at end of file
+        return self.__str__()
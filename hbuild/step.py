@@ -1,12 +1,16 @@
-from kombu import Connection, Producer, Exchange
-from multipledispatch import dispatch
-from podman.domain.containers import Container as PodmanContainer
-
+from dataclasses import dataclass, field
 from enum import Enum
-import multiprocessing
-import pika as mq
+import sys
+import time
+
+from .cgroup import HStepStats, read_cgroup_stats
+from .containers import exec_exit_code, exec_stream
+from .jobstate import HJobState
+from .logs import log_publisher
+from .template import HTemplate, compile_template
 
-from hbuild.config import HPackageConfig
+BASE_PATH = "/usr/local/bin:/usr/bin:/bin:/usr/local/games:/usr/games"
+RABBIT_URL = "amqp://mq:mq@localhost:5672"
 
 def format_lookup_name(package) -> str:
     from .source import SourcePackage
@@ -23,144 +27,100 @@ class StepWorkdirType(Enum):
     CUSTOM = 1
     BUILDDIR = 2
 
+@dataclass(frozen=True, slots=True)
 class Step:
-    @dispatch(dict, str)
-    def __init__(self, source_properties, package_name):
-        self.package_name = package_name
-        self.args: list[str] = source_properties["args"]
-        self.cpu_count = multiprocessing.cpu_count()
-
+    package_name: str
+    args: tuple[str, ...]
+    workdir_type: StepWorkdirType
+    workdir: str | None
+    environ: tuple[tuple[str, str], ...]
+    shell: bool
+
+    arg_templates: tuple[HTemplate, ...] = field(compare=False, repr=False)
+    environ_templates: tuple[tuple[str, HTemplate], ...] = field(compare=False, repr=False)
+    workdir_template: HTemplate | None = field(compare=False, repr=False)
+
+    @classmethod
+    def from_yml(cls, source_properties: dict, package_name: str) -> 'Step':
         if "workdir" in source_properties:
-            self.workdir_type = StepWorkdirType.CUSTOM
-            self.workdir: str = source_properties["workdir"]
+            workdir_type = StepWorkdirType.CUSTOM
+            workdir = source_properties["workdir"]
         else:
-            self.workdir_type = StepWorkdirType.BUILDDIR
-            self.workdir: str = None
+            workdir_type = StepWorkdirType.BUILDDIR
+            workdir = None
 
         if "environ" in source_properties:
-            self.environ: dict[str, str] = source_properties["environ"]
+            environ = tuple(source_properties["environ"].items())
         else:
-            self.environ: dict[str, str] = {}
+            environ = ()
 
         if "shell" in source_properties:
-            self.shell = source_properties["shell"]
+            shell = source_properties["shell"]
         else:
-            self.shell = False
-
-        self.rabbit_url = "amqp://mq:mq@localhost:5672"
+            shell = False
 
-    @dispatch(HPackageConfig, str)
-    def __init__(self, config: HPackageConfig, package_name):
-        self.config = config
+        # recipes repeat the same few commands and flags over and over
+        args = tuple(sys.intern(arg) for arg in source_properties["args"])
 
-        self.__init__(config.pkgsrc_yml, package_name)
+        try:
+            arg_templates = tuple(compile_template(arg) for arg in args)
+            environ_templates = tuple((env_var, compile_template(env_val)) for env_var, env_val in environ)
+            workdir_template = compile_template(workdir) if workdir is not None else None
+        except ValueError as e:
+            raise ValueError(f"Invalid step for {package_name}: {e}") from None
 
+        return cls(sys.intern(package_name), args, workdir_type, workdir, environ, shell,
+                   arg_templates, environ_templates, workdir_template)
 
-    def do_substitutions(self, system_prefix, system_targets, sources_dir, builds_dir, source_dir,  build_dir, collect_dir, system_root):
-        replaced_args = []
-        replaced_environ: dict[str, str]= {}
+    def do_substitutions(self, context: dict[str, str]):
+        replaced_args = [template.render(context) for template in self.arg_templates]
+        replaced_environ: dict[str, str] = {env_var: template.render(context)
+                                            for env_var, template in self.environ_templates}
 
-        base_workdir = build_dir
-        if self.workdir_type == StepWorkdirType.BUILDDIR:
-            replaced_workdir = base_workdir
+        if self.workdir_template is None:
+            replaced_workdir = context["THIS_BUILD_DIR"]
         else:
-            replaced_workdir = self.workdir
-
-        source_dir = source_dir
-        source_root = sources_dir
-        build_root = builds_dir
-
-        this_collect_dir = collect_dir
-
-        sysroot_dir = system_root
-        prefix_dir = system_prefix
-
-        parallelism = self.cpu_count
-
-        replaced_workdir = replaced_workdir.replace("@THIS_BUILD_DIR@", base_workdir)
-        replaced_workdir = replaced_workdir.replace("@THIS_SOURCE_DIR@", source_dir)
-        replaced_workdir = replaced_workdir.replace("@THIS_COLLECT_DIR@", this_collect_dir)
-
-        replaced_workdir = replaced_workdir.replace("@BUILD_ROOT@", build_root)
-        replaced_workdir = replaced_workdir.replace("@SOURCE_ROOT@", source_root)
-
-        replaced_workdir = replaced_workdir.replace("@SYSROOT_DIR@", sysroot_dir)
-
-        replaced_workdir = replaced_workdir.replace("@PREFIX@", prefix_dir)
-        replaced_workdir = replaced_workdir.replace("@TARGET@", system_targets["x86_64"])
-        replaced_workdir = replaced_workdir.replace("@PARALLELISM@", str(parallelism))
-
-        for arg in self.args:
-            arg = arg.replace("@THIS_SOURCE_DIR@", source_dir)
-            arg = arg.replace("@THIS_COLLECT_DIR@", this_collect_dir)
-            arg = arg.replace("@THIS_BUILD_DIR@", base_workdir)
-
-            arg = arg.replace("@BUILD_ROOT@", build_root)
-            arg = arg.replace("@SOURCE_ROOT@", source_root)
-            
-            arg = arg.replace("@SYSROOT_DIR@", sysroot_dir)
+            replaced_workdir = self.workdir_template.render(context)
 
-            arg = arg.replace("@PREFIX@", prefix_dir)
-            arg = arg.replace("@TARGET@", system_targets["x86_64"])
-            arg = arg.replace("@PARALLELISM@", str(parallelism))
-
-            replaced_args.append(arg)
-
-        for env_var, env_val in self.environ.items():
-            env_val = env_val.replace("@THIS_SOURCE_DIR@", source_dir)
-            env_val = env_val.replace("@THIS_COLLECT_DIR@", this_collect_dir)
-            env_val = env_val.replace("@THIS_BUILD_DIR@", base_workdir)
-
-            env_val = env_val.replace("@BUILD_ROOT@", build_root)
-            env_val = env_val.replace("@SOURCE_ROOT@", source_root)
-
-            env_val = env_val.replace("@SYSROOT_DIR@", sysroot_dir)
-
-            env_val = env_val.replace("@PREFIX@", prefix_dir)
-            env_val = env_val.replace("@TARGET@", system_targets["x86_64"])
-            env_val = env_val.replace("@PARALLELISM@", str(parallelism))
-
-            replaced_environ[env_var] = env_val     
-
-        base_path = "/usr/local/bin:/usr/bin:/bin:/usr/local/games:/usr/games"
+        prefix_dir = context["PREFIX"]
         if "PATH" in replaced_environ:
-            replaced_environ['PATH'] = f"{prefix_dir}/bin:{replaced_environ['PATH']}:{base_path}"
+            replaced_environ['PATH'] = f"{prefix_dir}/bin:{replaced_environ['PATH']}:{BASE_PATH}"
         else:
-            replaced_environ['PATH'] = f"{prefix_dir}/bin:{base_path}"
+            replaced_environ['PATH'] = f"{prefix_dir}/bin:{BASE_PATH}"
 
         replaced_environ['ACLOCAL_PATH'] = f"{prefix_dir}/share/aclocal"
 
+        # a recipe that sets its own MAKEFLAGS opts out of the shared jobserver
+        if "MAKEFLAGS" not in replaced_environ:
+            replaced_environ['MAKEFLAGS'] = context["MAKEFLAGS"]
+
         return replaced_args, replaced_environ, replaced_workdir
 
-    def exec(self, system_prefix, system_targets,  
-            sources_dir, builds_dir, source_dir,  
-            build_dir, collect_dir, system_root, 
-            container: PodmanContainer, package_object, stage_object):
-        args, environ, workdir = self.do_substitutions(system_prefix, system_targets,  
-                                                       sources_dir, builds_dir, source_dir,  
-                                                       build_dir, collect_dir, system_root)
+    def exec(self, context: dict[str, str], state: HJobState, package_object, stage_object):
+        args, environ, workdir = self.do_substitutions(context)
+        container = state.container
         lookup_name = format_lookup_name(package_object if stage_object is None else stage_object)
         stage_name = stage_object.name if stage_object is not None else ""
-        if self.shell is True:
-            _, mux = container.exec_run(cmd = ['/bin/bash', '-c', *args], environment = environ, workdir = workdir,
-                user='hbuild', tty=True, stream=True)
-        else:
-            _, mux = container.exec_run(cmd = args, environment = environ, workdir = workdir,
-                user='hbuild', tty=True, stream=True)
-            
+        cmd = ['/bin/bash', '-c', *args] if self.shell is True else args
+
+        before = read_cgroup_stats(container)
+        start = time.monotonic()
+        exec_id, mux = exec_stream(container, cmd, environ, workdir, 'hbuild')
+
+        # the dispatcher has one log queue per package, stages share it
+        log_stream = log_publisher().stream(format_lookup_name(package_object), lookup_name, stage_name,
+                                             state.log_spool)
         for chunk in mux:
-            decoded_chunk = chunk.decode('utf-8')
-            with Connection(self.rabbit_url) as conn:
-                with conn.channel() as channel:
-                    exchange = Exchange(lookup_name, type="direct")
-                    producer = Producer(channel)
-                    producer.publish(f"log:{lookup_name}:{stage_name}:{decoded_chunk}",
-                                     exchange=exchange,
-                                     routing_key=lookup_name,
-                                     declare=[exchange])
-
-        return_code = container.inspect()["State"]["ExitCode"]
-        package_object.last_return_status = return_code
+            log_stream.write(chunk)
+        log_stream.close()
+
+        return_code = exec_exit_code(container, exec_id)
+        wall_time = time.monotonic() - start
+        after = read_cgroup_stats(container)
+
+        state.step_stats.append(HStepStats(lookup_name, stage_name, " ".join(args), return_code,
+                                           before, after, wall_time))
+        state.last_return_status = return_code
         if return_code > 0:
             return Exception(f"Error running step for package {self.package_name}: exit {return_code}")
         
@@ -0,0 +1,81 @@
+import multiprocessing
+import re
+
+from .jobserver import jobserver
+
+CPU_COUNT = multiprocessing.cpu_count()
+
+PLACEHOLDER = re.compile(r"@([A-Z][A-Z0-9_]*)@")
+
+PLACEHOLDERS = frozenset({
+    "THIS_SOURCE_DIR",
+    "THIS_BUILD_DIR",
+    "THIS_COLLECT_DIR",
+    "BUILD_ROOT",
+    "SOURCE_ROOT",
+    "SYSROOT_DIR",
+    "PREFIX",
+    "TARGET",
+    "PARALLELISM",
+})
+
+class HTemplate():
+    __slots__ = ("source", "format", "names")
+
+    def __init__(self, source: str):
+        self.source = source
+
+        names = PLACEHOLDER.findall(source)
+        unknown = [name for name in names if name not in PLACEHOLDERS]
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown placeholder{'s' if len(unknown) > 1 else ''} "
+                             f"{', '.join(f'@{name}@' for name in unknown)} in {source!r}")
+
+        self.names = frozenset(names)
+        if len(self.names) == 0:
+            self.format = None
+        else:
+            # one str.format_map call does every substitution in a single pass
+            escaped = source.replace("{", "{{").replace("}", "}}")
+            self.format = PLACEHOLDER.sub(r"{\1}", escaped)
+
+    def render(self, context: dict[str, str]) -> str:
+        if self.format is None:
+            return self.source
+
+        return self.format.format_map(context)
+
+    def __repr__(self):
+        return f"HTemplate({self.source!r})"
+
+compiled_templates: dict[str, HTemplate] = {}
+
+def compile_template(source: str) -> HTemplate:
+    # recipes repeat the same arguments, so they share one compiled template
+    template = compiled_templates.get(source)
+    if template is None:
+        template = HTemplate(source)
+        compiled_templates[source] = template
+
+    return template
+
+def make_context(system_prefix: str, system_targets: dict[str, str], sources_dir: str, builds_dir: str,
+                 source_dir: str, build_dir: str, collect_dir: str, system_root: str) -> dict[str, str]:
+    server = jobserver()
+    context = {
+        "THIS_SOURCE_DIR": source_dir,
+        "THIS_BUILD_DIR": build_dir,
+        "THIS_COLLECT_DIR": collect_dir,
+        "BUILD_ROOT": builds_dir,
+        "SOURCE_ROOT": sources_dir,
+        "SYSROOT_DIR": system_root,
+        "PREFIX": system_prefix,
+        "TARGET": system_targets["x86_64"],
+        "PARALLELISM": str(server.tokens if server is not None else CPU_COUNT),
+    }
+
+    # not a placeholder, steps hand it to make through the environment so
+    # recipes no longer pass -j themselves, which would leave the jobserver
+    context["MAKEFLAGS"] = server.makeflags if server is not None else f"-j{CPU_COUNT}"
+
+    return context
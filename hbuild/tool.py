@@ -1,52 +1,48 @@
 from pathlib import Path
 
-import podman
-from podman.domain.containers import Container as PodmanContainer
 
 import os
 
 from enum import Enum
 import shutil
-import subprocess
 
 from .config import HPackageConfig
+from .jobstate import HJobState
 from .step import Step
+from .template import make_context
+from .containers import container_running, podman_client
+from .install import installer
+from .manifest import HManifestDB, remove_installed, report_shared
+from .jobserver import jobserver_volume
 from .source import SourcePackage
 from .stage import Stage
 
 from persistqueue import FIFOSQLiteQueue
 
 class ToolPackage:
-    def __init__(self, config: HPackageConfig):
+    __slots__ = ("config", "pkgsrc_yml", "pkgsrc_path", "name", "version",
+                 "log_dir", "work_dir", "build_dir", "tool_dir", "source_dir", "source_name",
+                 "tools_required", "pkgs_required",
+                 "configure_steps", "compile_steps", "install_steps", "stages")
+
+    def __init__(self, config: HPackageConfig, pkgsrc_yml: dict, pkgsrc_path: str, source_dir: str):
         self.config = config
+        self.pkgsrc_yml = pkgsrc_yml
+        self.pkgsrc_path = pkgsrc_path
 
-        source_properties = config.pkgsrc_yml
+        source_properties = pkgsrc_yml
 
         self.name = source_properties["name"]
         self.version = source_properties["version"]
 
-        self.logs_dir = config.logs_dir
-        self.sources_dir = config.sources_dir
-        self.builds_dir = config.builds_dir
-        self.tools_dir = config.tools_dir
-        self.works_dir = config.works_dir
-
-        self.log_dir = Path(self.logs_dir, self.name).resolve().as_posix()
-        self.work_dir = Path(self.works_dir, self.name).resolve().as_posix()
+        self.log_dir = Path(config.logs_dir, self.name).resolve().as_posix()
+        self.work_dir = Path(config.works_dir, self.name).resolve().as_posix()
         self.build_dir = Path(config.builds_dir, self.name).resolve().as_posix()
         self.tool_dir = Path(config.tools_dir, self.name).resolve().as_posix()
-        self.system_prefix = config.system_prefix
-        self.system_targets = config.system_targets
-        self.system_root = config.system_root
 
-        self.source_dir = config.source_dir
+        self.source_dir = source_dir
         self.source_name = source_properties["from_source"]
 
-        self.podman_client = podman.from_env()
-        self.podman_container: PodmanContainer = None
-
-        self.last_return_status = None
-
         if "tools-required" in source_properties:
             self.tools_required = source_properties["tools-required"]
         else:
@@ -57,35 +53,46 @@ class ToolPackage:
         else:
             self.pkgs_required = []
 
-        self.configure_ymls: list[dict[str, str]] = []
-        self.compile_ymls: list[dict[str, str]] = []
-        self.install_ymls: list[dict[str, str]] = []
-        self.stage_ymls: list[dict[str, str]] = []
-
         self.configure_steps: list[Step] = []
         self.compile_steps: list[Step]  = []
         self.install_steps: list[Step]  = []
         self.stages: list[Stage] = []
 
-        if "configure" in source_properties:
-            configure_properties = source_properties["configure"]
-            for step_yml in configure_properties:
-                self.configure_ymls.append(step_yml)
+    @property
+    def podman_client(self):
+        return podman_client()
+
+    @property
+    def logs_dir(self):
+        return self.config.logs_dir
+
+    @property
+    def sources_dir(self):
+        return self.config.sources_dir
+
+    @property
+    def builds_dir(self):
+        return self.config.builds_dir
+
+    @property
+    def tools_dir(self):
+        return self.config.tools_dir
+
+    @property
+    def works_dir(self):
+        return self.config.works_dir
 
-        if "compile" in source_properties:
-            configure_properties = source_properties["compile"]
-            for step_yml in configure_properties:
-                self.compile_ymls.append(step_yml)
+    @property
+    def system_prefix(self):
+        return self.config.system_prefix
 
-        if "install" in source_properties:
-            configure_properties = source_properties["install"]
-            for step_yml in configure_properties:
-                self.install_ymls.append(step_yml)
+    @property
+    def system_targets(self):
+        return self.config.system_targets
 
-        if "stages" in source_properties:
-            stages_properties = source_properties["stages"]
-            for stage_yml in stages_properties:
-                self.stage_ymls.append(stage_yml)
+    @property
+    def system_root(self):
+        return self.config.system_root
 
     @property
     def num_stages(self):
@@ -129,10 +136,11 @@ class ToolPackage:
         for stage in self.stages:
             stage.link_source(source_package)
 
-    def make_container(self):
-        if self.podman_container is not None:
-            pass        
-        self.podman_container = self.podman_client.containers.run(
+    def make_container(self, state: HJobState):
+        # stages of one package run in the same container
+        if container_running(state.container):
+            return
+        state.container = self.podman_client.containers.run(
             'hbuild:latest',
             stdout=True,
             stderr=True,
@@ -186,18 +194,12 @@ class ToolPackage:
                     'mode': 'ro',
                     'extended_mode': [ 'z']
                 },
-            },
+            } | jobserver_volume(),
 
             detach=True,
             tty=True
         )
 
-    def tidy(self):
-        if self.podman_container is not None:
-            self.podman_container.kill(signal='SIGKILL')
-            self.podman_container.remove(force=True)
-            self.podman_container = None
-
     def make_dirs(self):
         os.makedirs(self.work_dir, exist_ok=True)
         os.makedirs(self.tool_dir, exist_ok = True)
@@ -216,7 +218,8 @@ class ToolPackage:
                 os.rmdir(dent)
                 deleted.add(dent)
 
-    def clean_dirs(self):
+    def remove_unrecorded(self):
+        # installs from before manifests were kept
         pkg_root_dir = self.tool_dir
 
         for dent, _, files in os.walk(pkg_root_dir):
@@ -233,58 +236,67 @@ class ToolPackage:
 
                     if os.path.lexists(f_system_path):
                         os.unlink(f_system_path)
-                        
+
+        self.prune_prefix()
+
+    def clean_dirs(self):
+        if not remove_installed(HManifestDB(self.config.manifests_dir), self.name, self.system_prefix):
+            self.remove_unrecorded()
+
         if os.path.exists(self.build_dir):
             shutil.rmtree(self.build_dir)
         if os.path.exists(self.tool_dir):
             shutil.rmtree(self.tool_dir)
-        self.prune_prefix()
 
-    def exec_steps(self, steps: list[Step], stage: Stage | None) -> int | Exception:
+    def exec_steps(self, steps: list[Step], stage: Stage | None, state: HJobState) -> int | Exception:
         return_code: int | Exception = None
-        for step in steps:
-            step.exec(
-                '/home/hbuild/system_prefix',
-                self.system_targets,
-                '/home/hbuild/source_root',
-                '/home/hbuild/build_root',
+        context = make_context('/home/hbuild/system_prefix',
+                               self.system_targets,
+                               '/home/hbuild/source_root',
+                               '/home/hbuild/build_root',
 
-                '/home/hbuild/source',
-                '/home/hbuild/build',
+                               '/home/hbuild/source',
+                               '/home/hbuild/build',
 
-                '/home/hbuild/tool',
-                '/home/hbuild/system_root',
+                               '/home/hbuild/tool',
+                               '/home/hbuild/system_root')
+        for step in steps:
+            if state.checkpoint is not None and state.checkpoint.skip():
+                continue
 
-                self.podman_container,
-                self,
-                stage
-            )
+            return_code = step.exec(context, state, self, stage)
 
             if isinstance(return_code, Exception):
                 break
+
+            if state.checkpoint is not None:
+                state.checkpoint.advance()
         
         return return_code
 
-    def kill_build(self):
-        self.podman_container.kill(signal='SIGKILL')
+    def configure(self, state: HJobState):
+        return self.exec_steps(self.configure_steps, None, state)
 
-    def configure(self):
-        self.exec_steps(self.configure_steps, None)
-
-    def compile(self, stage: Stage = None):
+    def compile(self, stage: Stage | None, state: HJobState):
         if stage is None:
-            self.exec_steps(self.compile_steps, None)
+            return self.exec_steps(self.compile_steps, None, state)
         else:
-            self.exec_steps(stage.compile_steps, stage)
+            return self.exec_steps(stage.compile_steps, stage, state)
 
-    def install(self, stage: Stage = None):
+    def install(self, stage: Stage | None, state: HJobState):
         if stage is None:
-            self.exec_steps(self.install_steps, None)
+            return self.exec_steps(self.install_steps, None, state)
         else:            
-            self.exec_steps(stage.install_steps, stage)
+            return self.exec_steps(stage.install_steps, stage, state)
 
     def copy_tool(self):
-        subprocess.run(['rsync', '-aq',  f"{self.tool_dir}/", f"{self.system_prefix}"])
+        result = installer().install(self.tool_dir, self.system_prefix)
+        report_shared(self.name, HManifestDB(self.config.manifests_dir).record(self.name, self.system_prefix,
+                                                                                result.entries))
+
+        print(f"Installed {self.name}: {result}")
+        for error in result.errors:
+            print(f"Failed to install {self.name} file {error}")
 
     def __str__(self):
         return f"Tool {self.name}[{self.version}]"
@@ -0,0 +1,101 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import yaml
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import ValidationError
+from referencing import Registry
+from referencing.jsonschema import DRAFT7
+
+PARALLEL_MIN_FILES = 32
+
+class HSchemaValidators():
+    def __init__(self, schema_dir: str):
+        self.registry = Registry()
+        self.schemas: dict[str, dict] = {}
+        self.validators: dict[str, Draft7Validator] = {}
+
+        for dir, _, files in os.walk(schema_dir):
+            for file in files:
+                with open(Path(dir, file).resolve().as_posix()) as f:
+                    schema_json = json.load(f)
+
+                schema_id = schema_json["$id"]
+                schema_name = schema_id.split('/')[4]
+
+                self.registry = self.registry.with_resource(schema_id, DRAFT7.create_resource(schema_json))
+                self.schemas[schema_name] = schema_json
+
+        # compiled once, after every schema is registered so $refs resolve
+        for schema_name, schema_json in self.schemas.items():
+            self.validators[schema_name] = Draft7Validator(schema_json, registry=self.registry)
+
+    def validate(self, schema_name: str, document):
+        self.validators[schema_name].validate(document)
+
+class HValidationResult():
+    __slots__ = ("path", "pkgsrc_yml", "elapsed", "error")
+
+    def __init__(self, path: str, pkgsrc_yml: dict | None, elapsed: float, error: str | None):
+        self.path = path
+        self.pkgsrc_yml = pkgsrc_yml
+        self.elapsed = elapsed
+        self.error = error
+
+    def __str__(self):
+        return f"{self.elapsed * 1000:9.2f} ms  {self.path}" + (f": {self.error}" if self.error else "")
+
+def format_validation_error(e: Exception) -> str:
+    if isinstance(e, ValidationError):
+        location = "/".join(str(p) for p in e.absolute_path)
+        return f"{e.message} (at /{location})"
+
+    return str(e)
+
+def validate_pkgsrc_file(validators: HSchemaValidators, pkgsrc_path: str) -> HValidationResult:
+    start = time.perf_counter()
+    try:
+        with open(pkgsrc_path) as f:
+            pkgsrc_yml = yaml.load(f, Loader=yaml.CLoader)
+
+        validators.validate("pkgsrc", pkgsrc_yml)
+    except Exception as e:
+        return HValidationResult(pkgsrc_path, None, time.perf_counter() - start, format_validation_error(e))
+
+    return HValidationResult(pkgsrc_path, pkgsrc_yml, time.perf_counter() - start, None)
+
+worker_validators: HSchemaValidators | None = None
+
+def init_worker(schema_dir: str):
+    global worker_validators
+    worker_validators = HSchemaValidators(schema_dir)
+
+def validate_in_worker(pkgsrc_path: str) -> HValidationResult:
+    return validate_pkgsrc_file(worker_validators, pkgsrc_path)
+
+def validate_pkgsrc_files(schema_dir: str, paths: list[str], workers: int = 0,
+                          parallel_threshold: int = PARALLEL_MIN_FILES,
+                          validators: HSchemaValidators | None = None) -> list[HValidationResult]:
+    workers = workers if workers > 0 else os.cpu_count()
+    workers = min(workers, len(paths))
+
+    # a pool costs more to start than a small tree costs to validate
+    if workers <= 1 or len(paths) < parallel_threshold:
+        if validators is None:
+            validators = HSchemaValidators(schema_dir)
+        return [validate_pkgsrc_file(validators, path) for path in paths]
+
+    chunksize = max(1, len(paths) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(schema_dir,)) as pool:
+        return list(pool.map(validate_in_worker, paths, chunksize=chunksize))
+
+def find_pkgsrc_files(pkgsrc_dir: str) -> list[str]:
+    paths = []
+    for dent, _, files in os.walk(pkgsrc_dir):
+        for file in files:
+            paths.append(Path(dent, file).resolve().as_posix())
+
+    return paths
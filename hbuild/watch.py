@@ -0,0 +1,109 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from pathlib import Path
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_ISDIR = 0x40000000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+
+class HPkgsrcWatcher():
+    def __init__(self, pkgsrc_dir: str, settle_time: float = 0.5):
+        self.pkgsrc_dir = Path(pkgsrc_dir).resolve().as_posix()
+        self.settle_time = settle_time
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+
+        self.watches: dict[int, str] = {}
+        self.pending: set[str] = set()
+        self.last_event = 0.0
+
+        for dent, _, _ in os.walk(self.pkgsrc_dir):
+            self.add_watch(dent)
+
+    def add_watch(self, path: str):
+        wd = self.inotify_add_watch(self.fd, path.encode(), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch failed for {path}: {os.strerror(errno)}")
+
+        self.watches[wd] = path
+
+    def is_pkgsrc_file(self, name: str) -> bool:
+        # editor swap and backup files never reach the registry
+        return not name.startswith('.') and not name.endswith('~')
+
+    def read_events(self):
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, name_len = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset:offset + name_len].rstrip(b'\0').decode()
+                offset += name_len
+
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+
+                dir_path = self.watches.get(wd)
+                if dir_path is None or name == "":
+                    continue
+
+                path = os.path.join(dir_path, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.add_watch(path)
+                        for dent, _, files in os.walk(path):
+                            self.pending.update(os.path.join(dent, f) for f in files if self.is_pkgsrc_file(f))
+                        self.last_event = time.monotonic()
+                    continue
+
+                if self.is_pkgsrc_file(name):
+                    self.pending.add(path)
+                    self.last_event = time.monotonic()
+
+    def poll(self, timeout: float = 0) -> set[str]:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            self.read_events()
+
+        # wait for a burst of writes (e.g. an editor saving through a
+        # temporary file) to settle before reporting it
+        if len(self.pending) == 0 or time.monotonic() - self.last_event < self.settle_time:
+            return set()
+
+        changed = self.pending
+        self.pending = set()
+        return changed
+
+    def close(self):
+        os.close(self.fd)
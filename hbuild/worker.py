@@ -1,16 +1,57 @@
+import kombu
 from kombu import Connection, Exchange, Queue
 from kombu.mixins import ConsumerMixin
 class RobustWorker(ConsumerMixin):
-    def __init__(self, connection, queues, on_message_callback=None):
+    def __init__(self, connection, queues, on_message_callback=None, on_iteration_callback=None,
+                 on_ready_callback=None, auto_ack=True, prefetch_count=None, bulk_queues=None,
+                 bulk_prefetch_count=None):
         self.connection = connection
         self.queues = queues
         self.on_message_callback = on_message_callback
+        self.on_iteration_callback = on_iteration_callback
+        self.on_ready_callback = on_ready_callback
+        self.auto_ack = auto_ack
+        self.prefetch_count = prefetch_count
+
+        # consumed on a channel of their own, so a window full of their
+        # unacked messages does not hold up the other queues
+        self.bulk_queues = bulk_queues
+        self.bulk_prefetch_count = bulk_prefetch_count
+        self.bulk_consumer = None
 
     def get_consumers(self, Consumer, channel):
-        return [Consumer(queues=self.queues,
-                         callbacks=[self.on_message])]
+        consumers = [Consumer(queues=self.queues,
+                              callbacks=[self.on_message],
+                              prefetch_count=self.prefetch_count)]
+
+        self.bulk_consumer = None
+        if self.bulk_queues is not None:
+            self.bulk_consumer = kombu.Consumer(channel.connection.client.channel(),
+                                                queues=self.bulk_queues,
+                                                callbacks=[self.on_message],
+                                                prefetch_count=self.bulk_prefetch_count)
+            consumers.append(self.bulk_consumer)
+
+        return consumers
+
+    def add_bulk_queues(self, queues):
+        # kept in self.bulk_queues too, so a reconnect consumes them again
+        self.bulk_queues.extend(queues)
+        if self.bulk_consumer is not None:
+            for queue in queues:
+                self.bulk_consumer.add_queue(queue)
+            self.bulk_consumer.consume()
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        if self.on_ready_callback:
+            self.on_ready_callback()
+
+    def on_iteration(self):
+        if self.on_iteration_callback:
+            self.on_iteration_callback()
 
     def on_message(self, body, message):
         if self.on_message_callback:
             self.on_message_callback(body, message)
-        message.ack()
\ No newline at end of file
+        if self.auto_ack:
+            message.ack()
\ No newline at end of file
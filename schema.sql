@@ -11,4 +11,47 @@ CREATE TABLE `sql`.history(
     runner VARCHAR(64) NOT NULL,
     packages TEXT NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE `sql`.durations(
+    id int PRIMARY KEY NOT NULL AUTO_INCREMENT,
+    package VARCHAR(64) NOT NULL,
+    runner VARCHAR(64) NOT NULL,
+    duration DOUBLE NOT NULL,
+    output_hash CHAR(64) NULL,
+    cached BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX (package)
+);
+
+CREATE TABLE `sql`.step_stats(
+    id int PRIMARY KEY NOT NULL AUTO_INCREMENT,
+    history_id int NOT NULL,
+    package VARCHAR(64) NOT NULL,
+    stage VARCHAR(32) NULL,
+    command TEXT NOT NULL,
+    exit_code int NOT NULL,
+    wall_time DOUBLE NOT NULL,
+    cpu_user DOUBLE NULL,
+    cpu_system DOUBLE NULL,
+    memory_peak BIGINT NULL,
+    container_peak BIGINT NULL,
+    io_read BIGINT NULL,
+    io_write BIGINT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX (history_id)
+);
+
+CREATE TABLE `sql`.packaging(
+    id int PRIMARY KEY NOT NULL AUTO_INCREMENT,
+    history_id int NOT NULL,
+    package VARCHAR(64) NOT NULL,
+    deb_file TEXT NULL,
+    compression VARCHAR(32) NOT NULL,
+    elapsed DOUBLE NULL,
+    input_bytes BIGINT NULL,
+    output_bytes BIGINT NULL,
+    error TEXT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX (history_id)
 );
\ No newline at end of file
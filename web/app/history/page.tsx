@@ -1,7 +1,7 @@
 'use client'
 
 import fetcher from "@/app/fetcher";
-import { PackageHistoryList, PackageHistoryEntry } from '@/app/models' 
+import { PackageHistoryList, PackageHistoryEntry, StepStats, PackagingStats } from '@/app/models' 
 
 import useSWR from 'swr'
 import { HBuildState, HBuildPackageType } from '@/app/models'
@@ -38,6 +38,50 @@ const PackageList = ({ packages } : { packages: string[] }) => {
     </>
 }
 
+const formatBytes = (bytes: number | null) => {
+    if (bytes === null) {
+        return '-'
+    }
+
+    return `${(bytes / (1024 * 1024)).toFixed(1)} MiB`
+}
+
+const formatSeconds = (seconds: number | null) => seconds === null ? '-' : `${seconds.toFixed(1)}s`
+
+const StepList = ({ steps } : { steps: StepStats[] }) => {
+  const [open, setOpen] = useState(false);
+
+  const handlePress = () => setOpen(!open);
+
+    return <>
+        <Button onClick={handlePress} className="-ml-2.5 self-start" variant="text" color="inherit">
+            <ListAlt /> Steps
+            { open ? <ExpandLess /> : <ExpandMore /> }
+        </Button>
+        <Collapse in={open}  timeout="auto" unmountOnExit>
+            <List>
+                {steps.map((step, index) => (
+                    <ListItemText sx={{ pl: 4 }} key={index}
+                        primary={`${step.command} (exit ${step.exit_code})`}
+                        secondary={`wall ${formatSeconds(step.wall_time)}, user ${formatSeconds(step.cpu_user)}, sys ${formatSeconds(step.cpu_system)}, step peak ${step.memory_peak === null && step.container_peak !== null ? 'below earlier steps' : formatBytes(step.memory_peak)}, container peak ${formatBytes(step.container_peak)}, read ${formatBytes(step.io_read)}, written ${formatBytes(step.io_write)}`} />
+                ))}
+            </List>
+        </Collapse>
+    </>
+}
+
+const PackagingList = ({ packaging } : { packaging: PackagingStats[] }) => {
+    return <List>
+        {packaging.map((deb, index) => (
+            <ListItemText key={index}
+                primary={deb.error === null ? `Packaged ${deb.package} (${deb.compression})` : `Packaging ${deb.package} failed`}
+                secondary={deb.error === null
+                    ? `${formatSeconds(deb.elapsed)}, ${formatBytes(deb.input_bytes)} -> ${formatBytes(deb.output_bytes)} (${deb.ratio === null ? '-' : deb.ratio.toFixed(2)}x)`
+                    : deb.error} />
+        ))}
+    </List>
+}
+
 export default () => {
     const { data, error, isLoading } = useSWR<PackageHistoryList>(
         'http://localhost:8000/api/history',
@@ -62,6 +106,8 @@ export default () => {
                     <AccordionDetails className="flex flex-col">
                         <Typography component="span">Executed At {timestampToFormatted(historyItem.created_at)}</Typography>
                         <PackageList packages={historyItem.packages} />
+                        <StepList steps={historyItem.steps} />
+                        <PackagingList packaging={historyItem.packaging} />
                     </AccordionDetails>
                 </Accordion>
             ))}
@@ -29,11 +29,38 @@ type PackageInfoList = {
     packages: PackageInfo[]
 }
 
+type StepStats = {
+    package: string,
+    stage: string | null,
+    command: string,
+    exit_code: number,
+    wall_time: number,
+    cpu_user: number | null,
+    cpu_system: number | null,
+    memory_peak: number | null,
+    container_peak: number | null,
+    io_read: number | null,
+    io_write: number | null
+}
+
+type PackagingStats = {
+    package: string,
+    deb_file: string | null,
+    compression: string,
+    elapsed: number | null,
+    input_bytes: number | null,
+    output_bytes: number | null,
+    ratio: number | null,
+    error: string | null
+}
+
 type PackageHistoryEntry = {
     id: number,
     runner: string,
     packages: string[],
-    created_at: number
+    created_at: number,
+    steps: StepStats[],
+    packaging: PackagingStats[]
 }
 
 type PackageHistoryList = {
@@ -57,7 +84,9 @@ export type {
     PackageInfo,
 
     PackageHistoryList,
-    PackageHistoryEntry
+    PackageHistoryEntry,
+    StepStats,
+    PackagingStats,
 
     HBuildState,
     HBuildPackageType,
@@ -65,7 +65,7 @@ export default () => {
         throw Error('Failed to load package data')
     }
 
-    const postBuild = (item: PackageInfo) => {
+    const postBuild = (item: PackageInfo, resume: boolean = false) => {
         const req = {
             "build_to": item.type == "source" ? "build" : "install",
             "packages": [
@@ -73,7 +73,8 @@ export default () => {
                     "name": item.name,
                     "stage": null
                 }
-            ]
+            ],
+            "resume": resume
         }
 
         fetch(`http://localhost:8000/api/build`, {
@@ -144,6 +145,12 @@ export default () => {
                 >
                     Build Now
                 </Button>
+                <Button
+                    onClick={() => postBuild(currentPackage!, true)}
+                    color="primary"
+                >
+                    Resume
+                </Button>
                 <Button 
                     onClick={() => setOpenItem(false)}
                     color="error"